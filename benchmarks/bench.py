@@ -0,0 +1,199 @@
+"""
+Throughput and memory benchmark for the hot paths.
+
+Generates synthetic JPEGs (noise over a gradient, with GPS EXIF and a PGP key appended)
+from 0.1 to 50 megapixels. It then times encode_message, decode_message, extract_pgp_key,
+get_image_exif, get_image_location and compare_images on each one. Every measurement
+runs in a fresh process with the result cache disabled, so the peak RSS belongs to that
+operation alone. The fastest of --runs counts.
+
+    python benchmarks/bench.py --output bench.json
+    python benchmarks/bench.py --baseline bench.json --tolerance 0.2
+
+Exits with 1 if any operation is slower, or uses more memory, than the baseline allows.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+DEFAULT_SIZES = (0.1, 1, 5, 20, 50)  # megapixels
+OPERATIONS = ("encode", "decode", "steg", "exif", "map", "compare")
+DEFAULT_TOLERANCE = 0.2  # fraction slower or larger than the baseline still accepted
+MIN_SLACK_SECONDS = 0.005  # sub-millisecond timings are mostly noise
+MESSAGE = "benchmark " * 100  # about 1 KB
+PGP_KEY = (b"-----BEGIN PGP PUBLIC KEY BLOCK-----\n\n"
+           b"mQENBGBenchmarkKeyNotARealKeyJustArmorForTheScanner\n=abcd\n"
+           b"-----END PGP PUBLIC KEY BLOCK-----\n")
+GPS_INFO = {1: 'N', 2: (48.0, 51.0, 29.9), 3: 'E', 4: (2.0, 17.0, 40.2)}
+
+
+def image_paths(workdir, megapixels):
+    """(source JPEG, encoded PNG) for one size."""
+    name = f"{megapixels:g}mp"
+    return os.path.join(workdir, name + ".jpg"), os.path.join(workdir, name + "-encoded.png")
+
+def generate_image(path, megapixels, seed=0):
+    """Writes a reproducible 4:3 JPEG of about megapixels million pixels."""
+    import numpy as np
+    from PIL import Image
+
+    width = round((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = round(megapixels * 1e6 / width)
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 200, width, dtype=np.float32)[None, :, None] + \
+        np.linspace(0, 40, height, dtype=np.float32)[:, None, None]
+    pixels = (gradient + rng.integers(0, 16, size=(height, width, 3), dtype=np.uint8)).astype(np.uint8)
+    del gradient
+
+    exif = Image.Exif()
+    exif[0x010F] = "inspector-image benchmark"  # Make
+    exif[0x8825] = GPS_INFO
+    Image.fromarray(pixels).save(path, "JPEG", quality=90, exif=exif)
+    # Key blocks are often appended to the image file, which is where extract_pgp_key looks
+    with open(path, 'ab') as image_file:
+        image_file.write(PGP_KEY)
+
+def prepare(workdir, megapixels):
+    """Creates the inputs for one size unless a previous run left them in workdir."""
+    source, encoded = image_paths(workdir, megapixels)
+    if not os.path.exists(source):
+        generate_image(source, megapixels)
+    if not os.path.exists(encoded):
+        from modules.decode_encode import encode_message
+        encode_message(source, MESSAGE, encoded)
+
+def run_operation(operation, source, encoded):
+    from modules.decode_encode import decode_message, encode_message
+    from modules.shared import compare_images, extract_pgp_key, get_image_exif, get_image_location
+
+    if operation == "encode":
+        output = os.path.join(os.path.dirname(encoded), "output.png")
+        encode_message(source, MESSAGE, output)
+        os.remove(output)
+    elif operation == "decode":
+        if decode_message(encoded) != MESSAGE:
+            raise RuntimeError("decode_message returned the wrong message")
+    elif operation == "steg":
+        if not extract_pgp_key(source).startswith("-----BEGIN"):
+            raise RuntimeError("extract_pgp_key didn't find the key")
+    elif operation == "exif":
+        get_image_exif(source)
+    elif operation == "map":
+        if get_image_location(source)[0] is None:
+            raise RuntimeError("get_image_location didn't find the GPS position")
+    elif operation == "compare":
+        compare_images(source, encoded)
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def child_main(operation, workdir, megapixels):
+    """Runs one measurement and prints {"seconds", "peak_rss_mb"} as JSON."""
+    source, encoded = image_paths(workdir, megapixels)
+    # Import first, so module loading isn't part of the timing
+    import modules.decode_encode, modules.shared  # noqa: F401
+    if operation == "compare":
+        import cv2, skimage.metrics  # noqa: F401
+    start = time.perf_counter()
+    run_operation(operation, source, encoded)
+    seconds = time.perf_counter() - start
+    print(json.dumps({"seconds": seconds, "peak_rss_mb": peak_rss_mb()}))
+
+def measure(operation, workdir, megapixels):
+    env = dict(os.environ, INSPECTOR_NO_CACHE="1")
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", operation, workdir,
+                             str(megapixels)], capture_output=True, text=True, env=env, cwd=ROOT)
+    if result.returncode != 0:
+        raise RuntimeError(f"{operation} at {megapixels:g} MP failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def run_benchmarks(sizes, operations, workdir, runs):
+    results = []
+    for megapixels in sizes:
+        prepare(workdir, megapixels)
+        for operation in operations:
+            measurements = [measure(operation, workdir, megapixels) for _ in range(runs)]
+            seconds = min(measurement["seconds"] for measurement in measurements)
+            rss = [measurement["peak_rss_mb"] for measurement in measurements if measurement["peak_rss_mb"] is not None]
+            record = {"operation": operation, "megapixels": megapixels, "seconds": seconds,
+                      "peak_rss_mb": max(rss) if rss else None,
+                      "mp_per_s": megapixels / seconds if seconds else None}
+            results.append(record)
+            print(format_record(record), flush=True)
+    return results
+
+def format_record(record):
+    rss = f"{record['peak_rss_mb']:8.1f} MB" if record["peak_rss_mb"] is not None else "       n/a"
+    return (f"{record['operation']:<8} {record['megapixels']:>5g} MP {record['seconds']:9.3f} s "
+            f"{rss} {record['mp_per_s']:9.2f} MP/s")
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Returns the regressions: [(record, reason)] for results worse than the baseline by more than tolerance."""
+    previous = {(record["operation"], record["megapixels"]): record for record in baseline["results"]}
+    regressions = []
+    for record in results:
+        old = previous.get((record["operation"], record["megapixels"]))
+        if old is None:
+            continue
+        if record["seconds"] > old["seconds"] * (1 + tolerance) + MIN_SLACK_SECONDS:
+            regressions.append((record, f"time {record['seconds'] / old['seconds']:.2f}x the baseline"))
+        if record["peak_rss_mb"] and old["peak_rss_mb"] and record["peak_rss_mb"] > old["peak_rss_mb"] * (1 + tolerance):
+            regressions.append((record, f"peak RSS {record['peak_rss_mb'] / old['peak_rss_mb']:.2f}x the baseline"))
+    return regressions
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "--child":
+        sys.path.insert(0, ROOT)
+        child_main(sys.argv[2], sys.argv[3], float(sys.argv[4]))
+        return 0
+
+    parser = argparse.ArgumentParser(description="Benchmark the encode/decode/compare/metadata hot paths")
+    parser.add_argument("--sizes", type=float, nargs="+", default=DEFAULT_SIZES, help="Image sizes in megapixels")
+    parser.add_argument("--operations", nargs="+", choices=OPERATIONS, default=OPERATIONS, help="Operations to time")
+    parser.add_argument("--runs", type=int, default=3, help="Runs per measurement; the fastest one counts")
+    parser.add_argument("--workdir", help="Directory for the generated images, kept between runs (default: a temporary directory)")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file from an earlier --output run to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed slowdown or memory growth, as a fraction")
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="inspector-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        results = run_benchmarks(args.sizes, args.operations, workdir, args.runs)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        report = {"python": platform.python_version(), "platform": platform.platform(),
+                  "machine": platform.machine(), "cpus": os.cpu_count(), "results": results}
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), args.tolerance)
+        for record, reason in regressions:
+            print(f"REGRESSION {record['operation']} at {record['megapixels']:g} MP: {reason}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
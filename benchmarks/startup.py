@@ -0,0 +1,72 @@
+"""
+Cold-start regression check for the command-line tool.
+
+Runs each non-comparison command under ``python -X importtime`` and fails if it imports any
+of the heavy comparison dependencies (OpenCV, scikit-image, SciPy), or if the imports done
+by main.py take longer than the budget. Each command runs a few times and the fastest run
+counts, to keep the check stable on a busy machine.
+
+    python benchmarks/startup.py --budget-ms 300
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MAIN = os.path.join(ROOT, 'main.py')
+SAMPLE_IMAGE = os.path.join(ROOT, 'resources', 'image.jpeg')
+
+COMMANDS = [["-exif"], ["-steg"], ["-map"], ["-allpgp"], ["-carve"], ["-decode"]]
+HEAVY_MODULES = ("cv2", "skimage", "scipy")
+DEFAULT_BUDGET_MS = 300
+
+
+def parse_importtime(stderr):
+    """Returns [(module, nesting level, cumulative microseconds)] from -X importtime output."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), level, int(cumulative)))
+    return imports
+
+def measure(flags):
+    """Runs one command and returns (milliseconds spent importing for main.py, modules imported)."""
+    env = dict(os.environ, INSPECTOR_NO_CACHE="1")
+    result = subprocess.run([sys.executable, "-X", "importtime", MAIN, *flags, SAMPLE_IMAGE],
+                            capture_output=True, text=True, env=env, cwd=ROOT)
+    imports = parse_importtime(result.stderr)
+    # Everything up to and including `site` is interpreter startup, not ours
+    names = [name for name, _, _ in imports]
+    first = names.index("site") + 1 if "site" in names else 0
+    ours = imports[first:]
+    total_us = sum(cumulative for _, level, cumulative in ours if level == 0)
+    return total_us / 1000, {name for name, _, _ in ours}
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the cold-start import cost of main.py")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="Maximum import time per command")
+    parser.add_argument("--runs", type=int, default=3, help="Runs per command; the fastest one counts")
+    args = parser.parse_args()
+
+    failures = 0
+    for flags in COMMANDS:
+        runs = [measure(flags) for _ in range(args.runs)]
+        elapsed = min(ms for ms, _ in runs)
+        heavy = sorted({name.split('.')[0] for _, modules in runs for name in modules
+                        if name.split('.')[0] in HEAVY_MODULES})
+        status = "ok"
+        if heavy:
+            status = f"FAIL: imports {', '.join(heavy)}"
+        elif elapsed > args.budget_ms:
+            status = f"FAIL: over the {args.budget_ms:.0f} ms budget"
+        failures += status != "ok"
+        print(f"main.py {' '.join(flags):<8} {elapsed:8.1f} ms  {status}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
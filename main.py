@@ -1,49 +1,309 @@
 import argparse
+import json
+import os
+import sys
+import time
 from modules.decode_encode import decode_message
 from modules.decode_encode import encode_message
-from modules.shared import get_image_location
-from modules.shared import extract_pgp_key
-from modules.shared import get_image_exif
+from modules.decode_encode import encode_file
+from modules.decode_encode import decode_image_payload
+from modules.decode_encode import save_payload_file
+from modules.decode_encode import DEFAULT_COMPRESS_LEVEL
+from modules.decode_encode import MAX_BITS_PER_CHANNEL
+from modules.decode_encode import capacity_plan
+from modules.decode_encode import describe_capacity
+from modules.payload import PayloadError
+from modules.analysis import ImageAnalysis
+from modules import cache
+from modules import metrics
+from modules.carving import describe_embedded
+from modules.carving import extract_embedded
+from modules.carving import Embedded
+from modules.comparison import compare_images_tiled
+from modules.comparison import describe_comparison
+from modules.comparison import DEFAULT_TILE_SIZE
+from modules.comparison import rank_images
+from modules.steganalysis import describe_detection
+from modules.hashindex import HashIndex
+from modules.hashindex import find_similar
+from modules.hashindex import DEFAULT_MAX_DISTANCE
+from modules.geoexport import export_locations
+from modules.batch import collect_images
+from modules.batch import run_batch
+from modules.watch import Manifest
+from modules.watch import watch_images
+from modules.watch import DEFAULT_INTERVAL
+from modules.service import serve
+from modules.service import DEFAULT_HOST
+from modules.service import DEFAULT_PORT
 
 
+PROFILE_TOP_FUNCTIONS = 25  # functions listed by --profile, by cumulative time
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Image Inspector")
 
-    parser.add_argument("image", help="Path to the image file")
+    parser.add_argument("image", nargs="?", help="Path to the image file")
     parser.add_argument("-map", action="store_true", help="Extract location data from image")
     parser.add_argument("-steg", action="store_true", help="Extract hidden PGP key from image")
+    parser.add_argument("-allpgp", action="store_true", help="List every armored PGP block (keys, signatures, messages) with its byte offsets")
+    parser.add_argument("-carve", action="store_true", help="Find embedded or appended files (ZIP, 7z, PDF, images, ...)")
+    parser.add_argument("-carveout", help="Directory to extract the files found by -carve into", default=None)
     parser.add_argument("-decode", action="store_true", help="Decode a message from the image")
+    parser.add_argument("-detect", action="store_true", help="Estimate whether LSB data was embedded by any tool (chi-square, RS and sample pair analysis)")
     parser.add_argument("-encode",action="store_true", help="Encode a message into the image")
     parser.add_argument("-exif",action="store_true", help="Extract all EXIF data from the image")
+    parser.add_argument("-metadata", action="store_true", help="Print all EXIF tags and PNG text chunks as JSON")
+    parser.add_argument("-compare", metavar="OTHER", help="Compare the image with another one using tiled SSIM")
+    parser.add_argument("-rank", nargs="+", metavar="SOURCE", help="Rank the images in these directories, glob patterns or paths by similarity to the image")
+    parser.add_argument("-index", nargs="+", metavar="SOURCE", help="Add the images in these directories, glob patterns or paths to the near-duplicate index")
+    parser.add_argument("-similar", action="store_true", help="Find near duplicates of the image in the index, verified with SSIM")
+    parser.add_argument("-duplicates", action="store_true", help="List groups of near-duplicate images in the index")
+    parser.add_argument("-hashdb", help="Path of the near-duplicate index (default: next to the result cache)", default=None)
+    parser.add_argument("-distance", type=int, help="Maximum perceptual hash distance (of 64 bits) for -similar and -duplicates", default=DEFAULT_MAX_DISTANCE)
+    parser.add_argument("-tile", type=int, help="Tile size in pixels for -compare", default=DEFAULT_TILE_SIZE)
+    parser.add_argument("-refine", action="store_true", help="For -compare, run a coarse pass first and refine only differing tiles")
+    parser.add_argument("-align", action="store_true", help="For -compare, correct a translation between the images")
+    parser.add_argument("-diffout", help="For -compare, save the image with differing tiles outlined to this path", default=None)
     parser.add_argument("-message", help="The message to encode", default=None)
-    return parser.parse_args()
+    parser.add_argument("-file", help="Path of a file to embed instead of a text message", default=None)
+    parser.add_argument("-compress", type=int, choices=range(10), metavar="0-9", help="PNG compression level for -encode (default: 6)", default=DEFAULT_COMPRESS_LEVEL)
+    parser.add_argument("-bits", type=int, choices=range(1, MAX_BITS_PER_CHANNEL + 1), metavar=f"1-{MAX_BITS_PER_CHANNEL}", help="Low bits of each channel used by -encode (default: 1); more hold more but are more visible", default=1)
+    parser.add_argument("-alpha", action="store_true", help="For -encode, also use the alpha channel of images that have one")
+    parser.add_argument("-capacity", action="store_true", help="Print how many bytes the image can hold with each -bits and -alpha setting, and whether -message or -file fits")
+    parser.add_argument("-password", help="Scatter the bits of -encode over pixel positions derived from this password; -decode needs the same password", default=None)
+    parser.add_argument("-out", help="Directory to save an embedded file to when decoding", default=None)
+    parser.add_argument("-stream", action="store_true", help="Decode incrementally and stop at the closing delimiter")
+    parser.add_argument("-legacy", action="store_true", help="Use the original per-pixel encoder/decoder (for comparison)")
+    parser.add_argument("-batch", nargs="+", metavar="SOURCE", help="Directories, glob patterns or image paths to process in batch mode")
+    parser.add_argument("-filelist", help="File with one image path per line to process in batch mode", default=None)
+    parser.add_argument("-workers", type=int, help="Number of worker processes in batch, -rank and -serve mode, or threads for -compare (default: CPU count)", default=None)
+    parser.add_argument("-geoexport", metavar="OUTPUT", help="In batch mode, write the GPS positions of the images to a .geojson, .kml or .csv file")
+    parser.add_argument("-cluster", type=float, metavar="METERS", help="For -geoexport, group positions on a grid of cells this size", default=None)
+    parser.add_argument("-jsonl", help="Write batch results to this JSON Lines file instead of stdout", default=None)
+    parser.add_argument("-incremental", action="store_true", help="In batch mode, only analyze images that are new or changed since the last run, and append to -jsonl")
+    parser.add_argument("-watch", action="store_true", help="Like -incremental, then keep watching the sources and analyze images as they are added or changed")
+    parser.add_argument("-manifest", help="Manifest file that -incremental and -watch keep (default: next to the result cache)", default=None)
+    parser.add_argument("-interval", type=float, metavar="SECONDS", help=f"For -watch without inotify, seconds between scans (default: {DEFAULT_INTERVAL:g})", default=DEFAULT_INTERVAL)
+    parser.add_argument("-poll", action="store_true", help="For -watch, scan every -interval even where inotify is available, e.g. for network shares")
+    parser.add_argument("-serve", action="store_true", help="Run an HTTP/JSON service for the analyses instead of a single command")
+    parser.add_argument("-host", help=f"Address -serve listens on (default: {DEFAULT_HOST})", default=DEFAULT_HOST)
+    parser.add_argument("-port", type=int, help=f"Port -serve listens on (default: {DEFAULT_PORT})", default=DEFAULT_PORT)
+    parser.add_argument("-queue", type=int, help="For -serve, requests running or waiting at once before answering 503 (default: 2 per worker)", default=None)
+    parser.add_argument("-root", nargs="+", metavar="DIR", help="For -serve, only read and write local paths under these directories", default=[])
+    parser.add_argument("--no-cache", action="store_true", help="Don't read or write the result cache")
+    parser.add_argument("--cache-stats", action="store_true", help="Print result cache statistics")
+    parser.add_argument("--profile", action="store_true", help="Print the time spent in each stage and the slowest functions to stderr")
+    parser.add_argument("--pstats", metavar="OUTPUT", help="Save cProfile data to this file, for pstats or other profile viewers", default=None)
+    parser.add_argument("--metrics", metavar="OUTPUT", help="Write the stage timings and bytes read to this file, as Prometheus text (.prom, .txt) or JSON", default=None)
+    args = parser.parse_args()
+    if (args.serve or args.cache_stats or args.index or args.duplicates) and not (args.image or args.batch or args.filelist):
+        return args
+    if not (args.image or args.batch or args.filelist):
+        parser.error("an image path is required unless -batch or -filelist is given")
+    if (args.incremental or args.watch) and not (args.batch or args.filelist):
+        parser.error("-incremental and -watch need -batch or -filelist")
+    return args
+
+def batch_main(args):
+    if args.geoexport:
+        image_paths = collect_images(args.batch or [], args.filelist)
+        written, missing = export_locations(image_paths, args.geoexport, args.cluster, args.workers)
+        print(f"Wrote {written} {'clusters' if args.cluster else 'points'} to {args.geoexport} "
+              f"({len(image_paths) - len(missing)} of {len(image_paths)} images have a GPS position)", file=sys.stderr)
+        return 0
+    operations = [op for op in ("map", "steg", "allpgp", "carve", "decode", "detect", "exif", "metadata") if getattr(args, op)]
+    if not operations:
+        print("No batch operation specified. Use -map, -steg, -allpgp, -carve, -decode, -detect, -exif, or -metadata.", file=sys.stderr)
+        return 2
+    if args.incremental or args.watch:
+        return watch_main(args, operations)
+    image_paths = collect_images(args.batch or [], args.filelist)
+    if args.jsonl:
+        with open(args.jsonl, "w", encoding="utf-8") as output:
+            failed = run_batch(image_paths, operations, args.workers, output)
+    else:
+        failed = run_batch(image_paths, operations, args.workers)
+    return 1 if failed else 0
+
+def watch_main(args, operations):
+    with Manifest(args.manifest) as manifest:
+        if args.jsonl:
+            # Appended to, so the file is a stream of every change ever seen
+            with open(args.jsonl, "a", encoding="utf-8") as output:
+                failed = watch_images(args.batch or [], operations, manifest, output, args.filelist, args.workers,
+                                      args.interval, once=not args.watch, poll=args.poll)
+        else:
+            failed = watch_images(args.batch or [], operations, manifest, sys.stdout, args.filelist, args.workers,
+                                  args.interval, once=not args.watch, poll=args.poll)
+    return 1 if failed else 0
+
+def index_main(args):
+    with HashIndex(args.hashdb) as index:
+        if args.index:
+            hashed, errors = index.add(collect_images(args.index), args.workers)
+            for path, error in errors.items():
+                print(f"Skipped {path}: {error}", file=sys.stderr)
+            print(f"Indexed {hashed} new or changed images, {len(index)} in total")
+        if args.duplicates:
+            for group in index.duplicates(args.distance):
+                print("\n".join(group) + "\n")
+
+def print_cache_stats():
+    stats = cache.get_cache().stats()
+    print(f"Cache: {stats['entries']} entries, {stats['bytes']} bytes, "
+          f"hit rate {stats['hit_rate']:.1%} ({stats['hits']} hits, {stats['misses']} misses)",
+          file=sys.stderr)
 
 def main():
-        args = parse_args()
-        if args.map:
-            location = get_image_location(args.image)
-            print("Latitude:", location[0], "\nLongitude:", location[1])
-    
-        if args.steg:
-          pgp_key = extract_pgp_key(args.image)
-          print(pgp_key)
-
-        if args.decode:  
-            message = decode_message(args.image)
-            print(f"Hidden message: {message}")
-
-        if args.encode:
-            message = args.message
-            encode_message_result = encode_message(args.image, message)
-            print(encode_message_result)
-
-        if args.exif:
-            exif_data = get_image_exif(args.image)
-            print(f"EXIF data: {exif_data}")
+    args = parse_args()
+    if not (args.profile or args.pstats or args.metrics):
+        sys.exit(run(args))
+    sys.exit(profile_main(args))
+
+def profile_main(args):
+    """Runs the command with stage timings recorded and, for --profile and --pstats, under cProfile."""
+    import cProfile
+    import pstats
+
+    metrics.configure(enabled=True)
+    profiler = cProfile.Profile() if args.profile or args.pstats else None
+    started = time.perf_counter()
+    try:
+        return profiler.runcall(run, args) if profiler else run(args)
+    finally:
+        wall_seconds = time.perf_counter() - started
+        snapshot = metrics.snapshot()
+        if args.metrics:
+            metrics.write_metrics(snapshot, args.metrics, wall_seconds)
+        if args.profile:
+            print(metrics.describe(snapshot, wall_seconds), file=sys.stderr)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        if args.pstats:
+            profiler.dump_stats(args.pstats)
+
+def run(args):
+        if args.no_cache:
+            cache.configure(enabled=False)
+        if args.serve:
+            serve(args.host, args.port, args.workers, args.queue, args.root)
+            return
+        if args.index or args.duplicates:
+            index_main(args)
+        if not (args.image or args.batch or args.filelist):  # only index or --cache-stats options were given
+            if args.cache_stats:
+                print_cache_stats()
+            return
+        if args.batch or args.filelist:
+            status = batch_main(args)
+            if args.cache_stats:
+                print_cache_stats()
+            return status
+
+        # Read the file once and share it between the analyses
+        with ImageAnalysis(args.image, stream=args.stream) as analysis:
+            if args.map:
+                location = analysis.location()
+                print("Latitude:", location[0], "\nLongitude:", location[1])
+
+            if args.steg:
+              pgp_key = analysis.pgp_key()
+              print(pgp_key)
+
+            if args.allpgp:
+                blocks = analysis.pgp_blocks()
+                for block in blocks:
+                    print(f"PGP {block['label']} at bytes {block['start']}-{block['end']}")
+                if not blocks:
+                    print("No PGP blocks found")
+
+            if args.carve:
+                items = [Embedded(**item) for item in analysis.embedded()]
+                print(describe_embedded(items))
+                if args.carveout:
+                    for path in extract_embedded(args.image, args.carveout, items):
+                        print(f"Extracted {path}")
+
+            if args.decode:
+                if args.legacy:
+                    message = decode_message(args.image, legacy=True)
+                elif args.password is not None:
+                    message = decode_message(args.image, password=args.password)
+                else:
+                    message = analysis.hidden_message()
+                print(f"Hidden message: {message}")
+                if args.out and not args.legacy:
+                    try:
+                        payload = decode_image_payload(analysis.image, stream=args.stream, password=args.password)
+                    except PayloadError:
+                        payload = None
+                    if payload is not None and payload.name is not None:
+                        print(f"Embedded file saved to {save_payload_file(payload, args.out)}")
+
+            if args.detect:
+                print(describe_detection(analysis.detection()))
+
+            if args.capacity:
+                payload_size = None
+                if args.file:
+                    # The body of a file container: 2-byte name length, name, contents
+                    payload_size = 2 + len(os.path.basename(args.file).encode('utf-8')) + os.path.getsize(args.file)
+                elif args.message is not None:
+                    payload_size = len(args.message.encode('utf-8'))
+                print(describe_capacity(capacity_plan(args.image, args.password), payload_size))
+
+            if args.encode:
+                if args.file:
+                    encode_message_result = encode_file(args.image, args.file, compress_level=args.compress,
+                                                        password=args.password, bits_per_channel=args.bits,
+                                                        alpha=args.alpha)
+                else:
+                    message = args.message
+                    encode_message_result = encode_message(args.image, message, legacy=args.legacy,
+                                                           compress_level=args.compress, password=args.password,
+                                                           bits_per_channel=args.bits, alpha=args.alpha)
+                print(encode_message_result)
+
+            if args.exif:
+                exif_data = analysis.exif()
+                print(f"EXIF data: {exif_data}")
+
+            if args.metadata:
+                print(json.dumps(analysis.all_metadata(), indent=2))
+
+            if args.compare:
+                comparison = compare_images_tiled(args.image, args.compare, tile_size=args.tile,
+                                                  refine=args.refine, align=args.align, workers=args.workers)
+                print(describe_comparison(comparison))
+                if args.diffout:
+                    comparison.result_image.save(args.diffout)
+                    print(f"Difference image saved to {args.diffout}")
+
+            if args.rank:
+                ranking = rank_images(args.image, collect_images(args.rank), args.workers,
+                                      tile_size=args.tile, refine=args.refine, align=args.align)
+                for record in ranking:
+                    if "score" in record:
+                        print(f"{record['score']:.6f}  {record['path']}")
+                    else:
+                        print(f"   error  {record['path']}: {record['error']}")
+
+            if args.similar:
+                with HashIndex(args.hashdb) as index:
+                    matches = find_similar(args.image, index, args.distance, workers=args.workers,
+                                           tile_size=args.tile, refine=args.refine, align=args.align)
+                for match in matches:
+                    score = f"{match['score']:.6f}" if "score" in match else "   error"
+                    print(f"{score}  hash distance {match['phash_distance']:2}  {match['path']}")
+                if not matches:
+                    print("No similar images found in the index")
+
+        if args.cache_stats:
+            print_cache_stats()
 
         # If no operation was specified
-        if not (args.map or args.steg or args.decode or args.encode or args.exif):
+        if not (args.map or args.steg or args.allpgp or args.carve or args.decode or args.detect or args.encode or args.capacity or args.exif or args.metadata or args.compare or args.rank or args.similar or args.index or args.duplicates):
             print("No valid operation specified. Use -map, -steg, -decode, or -encode.")
 
 if __name__ == "__main__":
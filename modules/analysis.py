@@ -0,0 +1,182 @@
+import mmap
+import os
+from io import BytesIO
+from PIL import Image
+from modules import cache
+from modules import metrics
+from modules.carving import scan_buffer, SCAN_CHUNK_SIZE
+from modules.decode_encode import decode_image
+from modules import metadata
+from modules.shared import find_pgp_key, scan_pgp_blocks, location_from_exif, location_from_metadata
+from modules.shared import exif_summary, metadata_summary
+from modules.steganalysis import detect_image, DEFAULT_MAX_PIXELS
+
+
+MMAP_THRESHOLD = 16 * 1024 * 1024  # files at least this large are memory-mapped instead of read
+# Only parse the file header, which is cheaper than hashing the file for a cache key
+UNCACHED_OPERATIONS = ("map", "exif", "metadata")
+
+
+class ImageAnalysis:
+    """
+    Runs several analyses on one image while reading the file once and decoding its pixels
+    and EXIF data at most once. Everything is loaded lazily, so only the work the requested
+    analyzers need is done.
+
+        with ImageAnalysis("photo.jpg") as analysis:
+            result = analysis.run(["map", "steg", "decode", "exif"])
+    """
+
+    def __init__(self, image_path, stream=False):
+        self.image_path = image_path
+        self.stream = stream
+        self._file = None
+        self._data = None
+        self._image = None
+        self._digest = None
+        self._metadata = False  # None is a valid result: an unsupported format
+
+    @classmethod
+    def from_bytes(cls, data, name="<upload>", stream=False):
+        """An analysis of image bytes already in memory, e.g. an upload; name stands in for the path."""
+        analysis = cls(name, stream)
+        analysis._data = data
+        return analysis
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._image is not None:
+            self._image.close()
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        if self._file is not None:
+            self._file.close()
+        self._image = self._data = self._file = None
+
+    @property
+    def data(self):
+        """The raw file contents, as bytes or a read-only memory map for large files."""
+        if self._data is None:
+            with metrics.stage("analysis.read"):
+                self._file = open(self.image_path, 'rb')
+                size = os.fstat(self._file.fileno()).st_size
+                if size >= MMAP_THRESHOLD:
+                    self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    self._data = self._file.read()
+                    self._file.close()
+                    self._file = None
+            metrics.count("bytes_read", size)
+        return self._data
+
+    @property
+    def image(self):
+        """The image, opened from the bytes already in memory."""
+        if self._image is None:
+            # A memory map is already file-like, and BytesIO shares the buffer of a bytes object
+            source = self.data if isinstance(self.data, mmap.mmap) else BytesIO(self.data)
+            with metrics.stage("analysis.open"):
+                self._image = Image.open(source)  # pixels are decoded on first use, not for EXIF
+        return self._image
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = cache.data_digest(self.data)
+        return self._digest
+
+    def _cached(self, operation, params, compute):
+        # Timed including cache lookups, which is what the caller waits for
+        with metrics.stage(f"analysis.{operation}"):
+            # Same keys as the cached path-based functions, so results are shared with them
+            if not cache.is_enabled() or operation in UNCACHED_OPERATIONS:
+                return compute()
+            return cache.get_or_compute(operation, [self.digest], params, compute)
+
+    @property
+    def parsed_metadata(self):
+        """EXIF/PNG metadata parsed from the head of the file, or None for other formats."""
+        if self._metadata is False:
+            if self._data is None:
+                # Only the header is read, not the whole file as self.data would
+                self._metadata = metadata.read_metadata(self.image_path)
+            else:
+                self._metadata = metadata.metadata_from_buffer(self._data)
+        return self._metadata
+
+    def _location(self, decimal):
+        try:
+            if self.parsed_metadata is not None:
+                return location_from_metadata(self.parsed_metadata, decimal)
+            exif_bytes = self.image.info.get('exif')
+        except Exception as e:
+            return None, str(e)  # same contract as get_image_location
+        return location_from_exif(exif_bytes, decimal)
+
+    def location(self, decimal=False):
+        return self._cached("map", {"decimal": decimal}, lambda: self._location(decimal))
+
+    def all_metadata(self):
+        return self._cached("metadata", {}, lambda: metadata.to_json(self.parsed_metadata))
+
+    def pgp_key(self):
+        return self._cached("steg", {}, lambda: find_pgp_key(self.data))
+
+    def pgp_blocks(self):
+        blocks = self._cached("allpgp", {}, lambda: list(scan_pgp_blocks(self.data)))
+        return [block._asdict() for block in blocks]
+
+    def embedded(self):
+        items = self._cached("carve", {"chunk_size": SCAN_CHUNK_SIZE}, lambda: scan_buffer(self.data))
+        return [item._asdict() for item in items]
+
+    def hidden_message(self):
+        return self._cached("decode", {"legacy": False, "stream": self.stream},
+                            lambda: decode_image(self.image, stream=self.stream))
+
+    def detection(self):
+        return self._cached("detect", {"max_pixels": DEFAULT_MAX_PIXELS}, lambda: detect_image(self.image))
+
+    def _exif(self):
+        if self.parsed_metadata is not None:
+            return metadata_summary(self.parsed_metadata)
+        return exif_summary(self.image)
+
+    def exif(self):
+        return self._cached("exif", {}, self._exif)
+
+    def run(self, operations):
+        """
+        Runs the named analyzers ("map", "steg", "allpgp", "carve", "decode", "detect", "exif", "metadata") and returns one result dict.
+        Failures are collected under "errors" instead of aborting the remaining analyzers.
+        """
+        result = {"path": self.image_path}
+        for operation in operations:
+            try:
+                if operation == "map":
+                    location = self.location()
+                    if location[0] is None:
+                        raise ValueError(location[1])
+                    result[operation] = {"latitude": location[0], "longitude": location[1]}
+                else:
+                    result[operation] = ANALYZERS[operation](self)
+            except Exception as e:
+                result.setdefault("errors", {})[operation] = str(e)
+        return result
+
+
+ANALYZERS = {
+    "map": ImageAnalysis.location,
+    "steg": ImageAnalysis.pgp_key,
+    "allpgp": ImageAnalysis.pgp_blocks,
+    "carve": ImageAnalysis.embedded,
+    "decode": ImageAnalysis.hidden_message,
+    "detect": ImageAnalysis.detection,
+    "exif": ImageAnalysis.exif,
+    "metadata": ImageAnalysis.all_metadata,
+}
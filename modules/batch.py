@@ -0,0 +1,82 @@
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from modules import metrics
+from modules.analysis import ImageAnalysis
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.gif', '.webp')
+PROGRESS_INTERVAL = 1.0  # seconds between progress lines on stderr
+
+
+def collect_images(sources, file_list=None):
+    """Expands directories (recursively), glob patterns and a newline-separated file list into image paths."""
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, _, files in os.walk(source):
+                paths.extend(os.path.join(root, name) for name in files
+                             if name.lower().endswith(IMAGE_EXTENSIONS))
+        elif glob.has_magic(source):
+            paths.extend(path for path in glob.glob(source, recursive=True) if os.path.isfile(path))
+        else:
+            paths.append(source)
+
+    if file_list:
+        with open(file_list, encoding='utf-8') as listing:
+            paths.extend(line.strip() for line in listing if line.strip())
+
+    # Keep the first occurrence of each path, in order
+    return list(dict.fromkeys(paths))
+
+def analyze_image(image_path, operations):
+    """
+    Runs the operations on one image. Errors are recorded per operation instead of raised.
+    With metrics enabled, the worker's stage timings for this image are attached under
+    "metrics" for run_batch to add up.
+    """
+    if metrics.is_enabled():
+        metrics.reset()  # a forked worker starts with a copy of the parent's totals
+    try:
+        with ImageAnalysis(image_path) as analysis:
+            record = analysis.run(operations)
+    except Exception as e:  # e.g. the file can't be opened at all
+        record = {"path": image_path, "errors": {operation: str(e) for operation in operations}}
+    if metrics.is_enabled():
+        record["metrics"] = metrics.collect()
+    return record
+
+def run_batch(image_paths, operations, workers=None, output=sys.stdout):
+    """
+    Analyzes the images across a process pool and writes one JSON Lines record per image
+    as results complete. Progress and throughput go to stderr. Returns the number of
+    images that had at least one error.
+    """
+    total = len(image_paths)
+    done = failed = 0
+    started = last_report = time.monotonic()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyze_image, path, operations): path for path in image_paths}
+        for future in as_completed(futures):
+            try:
+                record = future.result()
+            except Exception as e:  # the worker itself died
+                record = {"path": futures[future], "errors": {"worker": str(e)}}
+            if "metrics" in record:
+                metrics.merge(record.pop("metrics"))
+            if "errors" in record:
+                failed += 1
+            output.write(json.dumps(record, default=str) + "\n")
+            done += 1
+
+            now = time.monotonic()
+            if now - last_report >= PROGRESS_INTERVAL or done == total:
+                rate = done / max(now - started, 1e-9)
+                print(f"[{done}/{total}] {rate:.1f} images/s, {failed} with errors", file=sys.stderr)
+                last_report = now
+    output.flush()
+    return failed
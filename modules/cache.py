@@ -0,0 +1,224 @@
+import functools
+import hashlib
+import hmac
+import inspect
+import os
+import pickle
+import secrets
+import sqlite3
+import time
+
+
+# Bump whenever the output of a cached operation changes, so stale results are never served
+TOOL_VERSION = "3"
+
+CACHE_DIRECTORY = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "inspector-image")
+DEFAULT_CACHE_PATH = os.path.join(CACHE_DIRECTORY, "results.sqlite")
+# Signs the stored values, so a cache file written by anyone else is never unpickled
+KEY_PATH = os.path.join(CACHE_DIRECTORY, "results.key")
+KEY_SIZE = 32
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Settings live in the environment so batch worker processes inherit them
+ENV_DISABLED = "INSPECTOR_NO_CACHE"
+ENV_PATH = "INSPECTOR_CACHE_PATH"
+ENV_MAX_BYTES = "INSPECTOR_CACHE_MAX_BYTES"
+
+_MISSING = object()
+
+
+def configure(enabled=None, path=None, max_bytes=None):
+    """Changes the cache settings for this process and any worker processes it starts."""
+    if enabled is not None:
+        if enabled:
+            os.environ.pop(ENV_DISABLED, None)
+        else:
+            os.environ[ENV_DISABLED] = "1"
+    if path is not None:
+        os.environ[ENV_PATH] = path
+    if max_bytes is not None:
+        os.environ[ENV_MAX_BYTES] = str(max_bytes)
+
+def is_enabled():
+    return not os.environ.get(ENV_DISABLED)
+
+def _load_key(path=KEY_PATH):
+    """The secret key of this user's cache, created readable by the owner only on first use."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, 'rb') as key_file:
+            key = key_file.read()
+        if len(key) != KEY_SIZE:
+            raise OSError(f"Invalid cache key file: {path}")
+        return key
+    key = secrets.token_bytes(KEY_SIZE)
+    with os.fdopen(descriptor, 'wb') as key_file:
+        key_file.write(key)
+    return key
+
+
+class ResultCache:
+    """
+    Results stored in SQLite under a key derived from the input's content hash, the operation
+    and its parameters, and TOOL_VERSION. Values are pickled and signed with the key in
+    key_path; entries whose signature doesn't match are dropped instead of unpickled. Least
+    recently used entries are evicted once the stored values exceed max_bytes.
+    """
+
+    def __init__(self, path=None, max_bytes=None, key_path=KEY_PATH):
+        self.path = path or os.environ.get(ENV_PATH) or DEFAULT_CACHE_PATH
+        self.key = _load_key(key_path)
+        self.max_bytes = int(max_bytes or os.environ.get(ENV_MAX_BYTES) or DEFAULT_MAX_BYTES)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, "
+                                "size INTEGER, last_access REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+
+    def _count(self, name):
+        self.connection.execute("INSERT INTO counters VALUES (?, 1) "
+                                "ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+    def _sign(self, data):
+        return hmac.new(self.key, data, hashlib.sha256).digest()
+
+    def get(self, key, default=None):
+        row = self.connection.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            signature, data = row[0][:KEY_SIZE], row[0][KEY_SIZE:]
+            if not hmac.compare_digest(signature, self._sign(data)):
+                self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                row = None
+        if row is None:
+            self._count("misses")
+            return default
+        self.connection.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        self._count("hits")
+        return pickle.loads(data)
+
+    def put(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        data = self._sign(data) + data
+        if len(data) > self.max_bytes:
+            return
+        self.connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                                (key, data, len(data), time.time()))
+        self._evict()
+
+    def _evict(self):
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop the least recently used entries until the store fits again
+        excess = total - self.max_bytes
+        freed = 0
+        stale = []
+        for key, size in self.connection.execute("SELECT key, size FROM entries ORDER BY last_access"):
+            stale.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self.connection.executemany("DELETE FROM entries WHERE key = ?", stale)
+
+    def stats(self):
+        counters = dict(self.connection.execute("SELECT name, value FROM counters"))
+        entries, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+        return {
+            "path": self.path,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
+
+    def clear(self):
+        self.connection.execute("DELETE FROM entries")
+        self.connection.execute("DELETE FROM counters")
+
+
+_cache = None
+_cache_pid = None
+
+def get_cache():
+    """The process-wide cache. SQLite connections can't cross a fork, so each process opens its own."""
+    global _cache, _cache_pid
+    if _cache is None or _cache_pid != os.getpid():
+        _cache = ResultCache()
+        _cache_pid = os.getpid()
+    return _cache
+
+
+_digests = {}
+
+def file_digest(path):
+    """SHA-256 of the file contents, remembered per (path, inode, size, mtime) within a process."""
+    stat = os.stat(path)
+    identity = (os.path.abspath(path), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    digest = _digests.get(identity)
+    if digest is None:
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as input_file:
+            for chunk in iter(lambda: input_file.read(HASH_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        digest = _digests[identity] = hasher.hexdigest()
+    return digest
+
+def data_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def make_key(operation, digests, params):
+    parts = [TOOL_VERSION, operation, *digests, repr(sorted(params.items()))]
+    return hashlib.sha256("\0".join(parts).encode('utf-8')).hexdigest()
+
+def get_or_compute(operation, digests, params, compute):
+    """Returns the cached result for the inputs, or computes and stores it."""
+    if not is_enabled():
+        return compute()
+    try:
+        cache = get_cache()
+        key = make_key(operation, digests, params)
+        result = cache.get(key, _MISSING)
+    except (sqlite3.Error, OSError):
+        return compute()  # a broken or locked cache must never break an analysis
+    if result is _MISSING:
+        result = compute()
+        try:
+            cache.put(key, result)
+        except (sqlite3.Error, pickle.PicklingError, TypeError):
+            pass
+    return result
+
+def cached(operation, path_args=1, ignore=()):
+    """
+    Caches a function whose first path_args arguments are file paths. The key covers the
+    contents of those files, the remaining arguments (with defaults applied) except those
+    named in ignore, which must not affect the result, and TOOL_VERSION.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        path_names = list(signature.parameters)[:path_args]
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return func(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = {name: value for name, value in bound.arguments.items() if name not in ignore}
+            try:
+                digests = [file_digest(params.pop(name)) for name in path_names]
+            except (OSError, TypeError):
+                return func(*args, **kwargs)  # let the function report the problem itself
+            return get_or_compute(operation, digests, params, lambda: func(*args, **kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,251 @@
+import mmap
+import os
+import re
+import struct
+import numpy as np
+from collections import namedtuple
+from modules.cache import cached
+from modules.decode_encode import unique_file_path
+
+
+# (type, file extension, magic bytes, regex the bytes after the magic must match)
+SIGNATURES = [
+    ("jpeg", "jpg", b"\xff\xd8\xff", rb"[\xc0-\xfe]"),
+    ("png", "png", b"\x89PNG\r\n\x1a\n", b""),
+    ("gif", "gif", b"GIF8", rb"[79]a"),
+    ("webp", "webp", b"RIFF", rb".{4}WEBP"),
+    ("bmp", "bmp", b"BM", rb".{4}\x00\x00\x00\x00.{4}[\x0c\x28\x38\x40\x6c\x7c]\x00\x00\x00"),
+    ("tiff", "tif", b"II*\x00", b""),
+    ("tiff", "tif", b"MM\x00*", b""),
+    ("zip", "zip", b"PK\x03\x04", b""),
+    ("7z", "7z", b"7z\xbc\xaf\x27\x1c", b""),
+    ("rar", "rar", b"Rar!\x1a\x07", rb"(?:\x00|\x01\x00)"),
+    ("gzip", "gz", b"\x1f\x8b\x08", b""),
+    ("bzip2", "bz2", b"BZh", rb"[1-9]1AY&SY"),
+    ("xz", "xz", b"\xfd7zXZ\x00", b""),
+    ("cab", "cab", b"MSCF\x00\x00\x00\x00", b""),
+    ("pdf", "pdf", b"%PDF-", rb"\d\.\d"),
+    ("sqlite", "sqlite", b"SQLite format 3\x00", b""),
+    ("elf", "elf", b"\x7fELF", rb"[\x01\x02][\x01\x02]\x01"),
+    ("pgp", "asc", b"-----BEGIN PGP ", rb"[A-Z ,/0-9]{1,64}-----"),
+    ("wav", "wav", b"RIFF", rb".{4}WAVE"),
+    ("avi", "avi", b"RIFF", rb".{4}AVI "),
+    ("ogg", "ogg", b"OggS\x00\x02", b""),
+    ("flac", "flac", b"fLaC\x00\x00\x00\x22", b""),
+    ("mp4", "mp4", b"ftyp", rb"(?:isom|iso2|mp41|mp42|avc1|M4V |M4A |qt  |heic|mif1)"),
+]
+EXTENSIONS = {name: extension for name, extension, _, _ in SIGNATURES}
+# The MP4 magic sits 4 bytes into the container, after the box size
+SIGNATURE_LEAD = {"mp4": 4}
+MAX_SIGNATURE = 96  # longest possible match of any signature above
+
+# Every magic starts with a fixed byte pair. A 64K-entry table of those pairs lets one
+# vectorized pass over each window find the few offsets worth checking against the full
+# signatures, instead of trying every signature at every offset.
+_CANDIDATES = {}
+for _name, _, _magic, _rest in SIGNATURES:
+    _pair = _magic[0] << 8 | _magic[1]
+    _CANDIDATES.setdefault(_pair, []).append((_name, re.compile(re.escape(_magic) + _rest, re.DOTALL)))
+PAIR_TABLE = np.zeros(1 << 16, dtype=bool)
+PAIR_TABLE[list(_CANDIDATES)] = True
+
+SCAN_CHUNK_SIZE = 4 * 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+
+Embedded = namedtuple("Embedded", ["type", "offset", "length"])
+
+
+def _jpeg_length(buffer, start):
+    # Walk the marker segments up to the first scan, then find the EOI after it. This skips
+    # EXIF thumbnails, which sit inside APP1 with their own SOI/EOI pair.
+    position = start + 2
+    size = len(buffer)
+    while position + 4 <= size:
+        if buffer[position] != 0xFF:
+            return None
+        marker = buffer[position + 1]
+        if marker == 0xFF:  # fill byte
+            position += 1
+            continue
+        if marker == 0xD9:
+            return position + 2 - start
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            position += 2
+            continue
+        segment_length = struct.unpack(">H", buffer[position + 2:position + 4])[0]
+        if marker == 0xDA:  # start of scan; stuffed data can't contain FF D9
+            end = buffer.find(b"\xff\xd9", position + 2 + segment_length)
+            return end + 2 - start if end != -1 else None
+        position += 2 + segment_length
+    return None
+
+def _png_length(buffer, start):
+    position = start + 8
+    size = len(buffer)
+    while position + 12 <= size:
+        chunk_length = struct.unpack(">I", buffer[position:position + 4])[0]
+        chunk_type = bytes(buffer[position + 4:position + 8])
+        position += 12 + chunk_length
+        if chunk_type == b"IEND":
+            return position - start if position <= size else None
+    return None
+
+def _zip_length(buffer, start):
+    end = buffer.find(b"PK\x05\x06", start)
+    if end == -1 or end + 22 > len(buffer):
+        return None
+    comment_length = struct.unpack("<H", buffer[end + 20:end + 22])[0]
+    return end + 22 + comment_length - start
+
+def _sevenzip_length(buffer, start):
+    if start + 32 > len(buffer):
+        return None
+    next_header_offset, next_header_size = struct.unpack("<QQ", buffer[start + 12:start + 28])
+    return 32 + next_header_offset + next_header_size
+
+def _pdf_length(buffer, start):
+    end = buffer.find(b"%%EOF", start)
+    return end + 5 - start if end != -1 else None
+
+def _riff_length(buffer, start):
+    return 8 + struct.unpack("<I", buffer[start + 4:start + 8])[0]
+
+def _bmp_length(buffer, start):
+    return struct.unpack("<I", buffer[start + 2:start + 6])[0]
+
+def _cab_length(buffer, start):
+    return struct.unpack("<I", buffer[start + 8:start + 12])[0]
+
+def _sqlite_length(buffer, start):
+    if start + 32 > len(buffer):
+        return None
+    page_size = struct.unpack(">H", buffer[start + 16:start + 18])[0]
+    page_count = struct.unpack(">I", buffer[start + 28:start + 32])[0]
+    return (65536 if page_size == 1 else page_size) * page_count or None
+
+def _pgp_length(buffer, start):
+    header_end = buffer.find(b"-----", start + 15)
+    label = bytes(buffer[start + 15:header_end])
+    end_marker = b"-----END PGP " + label + b"-----"
+    end = buffer.find(end_marker, header_end)
+    return end + len(end_marker) - start if end != -1 else None
+
+# Formats whose length can be read from their structure; the rest run to the next hit or EOF
+LENGTH_PARSERS = {
+    "jpeg": _jpeg_length,
+    "png": _png_length,
+    "zip": _zip_length,
+    "7z": _sevenzip_length,
+    "pdf": _pdf_length,
+    "webp": _riff_length,
+    "wav": _riff_length,
+    "avi": _riff_length,
+    "bmp": _bmp_length,
+    "cab": _cab_length,
+    "sqlite": _sqlite_length,
+    "pgp": _pgp_length,
+}
+
+
+def _iter_hits(buffer, chunk_size):
+    """Yields (type, offset) for every signature match, scanning bounded windows in one pass."""
+    size = len(buffer)
+    for window_start in range(0, size, chunk_size):
+        window_end = min(window_start + chunk_size, size)
+        # One extra byte so pairs straddling the window boundary are seen
+        window = np.frombuffer(buffer, dtype=np.uint8, count=min(window_end + 1, size) - window_start,
+                               offset=window_start)
+        pairs = window[:-1].astype(np.uint16) << 8 | window[1:]
+        for position in np.flatnonzero(PAIR_TABLE[pairs]) + window_start:
+            position = int(position)
+            for kind, signature in _CANDIDATES[int(pairs[position - window_start])]:
+                if signature.match(buffer, position, min(position + MAX_SIGNATURE, size)):
+                    offset = position - SIGNATURE_LEAD.get(kind, 0)
+                    if offset >= 0:
+                        yield kind, offset
+                    break
+        del window, pairs  # release the buffer export so an mmap can be closed
+
+def scan_buffer(buffer, chunk_size=SCAN_CHUNK_SIZE):
+    """
+    Returns an Embedded (type, offset, length) for every container found in buffer (bytes or
+    an mmap). Matches inside a container whose length is known are skipped, so a ZIP's local
+    headers or a JPEG's EXIF thumbnail aren't reported separately. length is None when the
+    format doesn't record its size and the end couldn't be determined.
+    """
+    found = []
+    covered_until = 0
+    size = len(buffer)
+    for kind, offset in _iter_hits(buffer, chunk_size):
+        if offset < covered_until:
+            continue
+        length = None
+        parser = LENGTH_PARSERS.get(kind)
+        if parser:
+            try:
+                length = parser(buffer, offset)
+            except (struct.error, IndexError):
+                length = None
+            if length is not None and (length <= 0 or offset + length > size):
+                length = None
+        if length is not None:
+            covered_until = offset + length
+        found.append(Embedded(kind, offset, length))
+    return found
+
+@cached("carve")
+def scan_file(image_path, chunk_size=SCAN_CHUNK_SIZE):
+    with open(image_path, 'rb') as image_file:
+        if os.fstat(image_file.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return scan_buffer(buffer, chunk_size)
+
+def _carve_end(items, index, size):
+    item = items[index]
+    if item.length is not None:
+        return item.offset + item.length
+    return items[index + 1].offset if index + 1 < len(items) else size
+
+def extract_embedded(image_path, output_dir, items=None, include_host=False):
+    """
+    Streams each embedded container to its own file in output_dir and returns the paths.
+    Containers of unknown length are cut at the next container or the end of the file. The
+    container at offset 0 is the image itself and is skipped unless include_host is set.
+    Existing files are never overwritten; a number is appended to the name instead.
+    """
+    if items is None:
+        items = scan_file(image_path)
+    os.makedirs(output_dir, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(image_path))[0]
+    written = []
+    with open(image_path, 'rb') as image_file:
+        size = os.fstat(image_file.fileno()).st_size
+        for index, item in enumerate(items):
+            if item.offset == 0 and not include_host:
+                continue
+            end = _carve_end(items, index, size)
+            output_path = unique_file_path(
+                os.path.join(output_dir, f"{base_name}_{item.offset:08x}.{EXTENSIONS[item.type]}"))
+            image_file.seek(item.offset)
+            remaining = end - item.offset
+            with open(output_path, 'wb') as output_file:
+                while remaining > 0:
+                    data = image_file.read(min(COPY_CHUNK_SIZE, remaining))
+                    if not data:
+                        break
+                    output_file.write(data)
+                    remaining -= len(data)
+            written.append(output_path)
+    return written
+
+def describe_embedded(items):
+    """Formats scan results as text, one container per line."""
+    if not items:
+        return "No embedded data found."
+    lines = []
+    for item in items:
+        length = f"{item.length} bytes" if item.length is not None else "unknown length"
+        note = " (the image itself)" if item.offset == 0 else ""
+        lines.append(f"{item.type} at offset {item.offset}, {length}{note}")
+    return "\n".join(lines)
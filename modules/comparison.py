@@ -0,0 +1,271 @@
+import math
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
+from PIL import Image
+from modules import metrics
+from modules.cache import cached
+
+
+DEFAULT_TILE_SIZE = 512
+WIN_SIZE = 7  # scikit-image's default SSIM window
+PAD = (WIN_SIZE - 1) // 2  # context each tile needs so its SSIM values match a full-frame run
+C1, C2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2  # SSIM stabilizing constants for 8-bit data
+DIFF_THRESHOLD = 0.95  # tiles scoring below this are outlined in the result image
+COARSE_MAX_SIDE = 1024  # size of the pyramid level used for the coarse pass
+PREVIEW_MAX_SIDE = 1024
+
+CompareResult = namedtuple("CompareResult", ["score", "heatmap", "result_image", "resized", "refined_tiles", "threshold"])
+TileScores = namedtuple("TileScores", ["score", "heatmap", "row_edges", "column_edges", "resized", "refined_tiles"])
+
+
+def _tile_edges(length, tile_size):
+    """Splits [PAD, length - PAD) into near-equal tiles, mirroring how SSIM ignores the borders."""
+    usable = length - 2 * PAD
+    count = max(1, math.ceil(usable / tile_size))
+    return [PAD + round(i * usable / count) for i in range(count + 1)]
+
+def _ssim_map(tile1, tile2):
+    """
+    The SSIM map exactly as scikit-image computes it with its default uniform 7x7 window,
+    but built on OpenCV box filters, which release the GIL so tiles can run on threads.
+    """
+    import cv2
+
+    window = (WIN_SIZE, WIN_SIZE)
+    blur = lambda image: cv2.blur(image, window, borderType=cv2.BORDER_REFLECT)
+    covariance_norm = WIN_SIZE ** 2 / (WIN_SIZE ** 2 - 1)  # sample covariance, as in scikit-image
+    mean1, mean2 = blur(tile1), blur(tile2)
+    variance1 = covariance_norm * (blur(tile1 * tile1) - mean1 * mean1)
+    variance2 = covariance_norm * (blur(tile2 * tile2) - mean2 * mean2)
+    covariance = covariance_norm * (blur(tile1 * tile2) - mean1 * mean2)
+    return ((2 * mean1 * mean2 + C1) * (2 * covariance + C2)
+            / ((mean1 * mean1 + mean2 * mean2 + C1) * (variance1 + variance2 + C2)))
+
+def _tile_ssim(gray1, gray2, top, bottom, left, right):
+    """Returns the sum of the SSIM map over one tile, computed in float32 with just enough context."""
+    height, width = gray1.shape
+    region_top, region_left = max(0, top - PAD), max(0, left - PAD)
+    region_bottom, region_right = min(height, bottom + PAD), min(width, right + PAD)
+
+    tile1 = gray1[region_top:region_bottom, region_left:region_right].astype(np.float32)
+    tile2 = gray2[region_top:region_bottom, region_left:region_right].astype(np.float32)
+    ssim_map = _ssim_map(tile1, tile2)
+    inner = ssim_map[top - region_top:bottom - region_top, left - region_left:right - region_left]
+    return float(inner.sum(dtype=np.float64))
+
+def _tile_sums(gray1, gray2, tiles, workers, progress=None):
+    """
+    _tile_ssim for each (top, bottom, left, right) in tiles, spread over a thread pool.
+    progress(fraction) is called as tiles complete; if it raises, queued tiles are dropped.
+    """
+    if workers == 1 or len(tiles) < 2:
+        results = (_tile_ssim(gray1, gray2, *tile) for tile in tiles)
+        executor = None
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        results = executor.map(lambda tile: _tile_ssim(gray1, gray2, *tile), tiles)
+    try:
+        sums = []
+        for tile_sum in results:
+            sums.append(tile_sum)
+            if progress:
+                progress(len(sums) / len(tiles))
+        return sums
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+def _load_gray(image_path):
+    import cv2
+
+    # Same conversion as compare_images; IMREAD_GRAYSCALE rounds JPEGs slightly differently
+    color = cv2.imread(image_path)
+    if color is None:
+        raise ValueError(f"Could not read image: {image_path}")
+    return cv2.cvtColor(color, cv2.COLOR_BGR2GRAY)
+
+def _align(gray1, gray2, align):
+    """Resizes the second image to the first one's size and optionally corrects a translation."""
+    import cv2
+
+    resized = gray1.shape != gray2.shape
+    if resized:
+        gray2 = cv2.resize(gray2, (gray1.shape[1], gray1.shape[0]), interpolation=cv2.INTER_AREA)
+    if align:
+        # Estimate the shift on a downscaled copy; phase correlation is robust to lighting changes
+        scale = min(1.0, COARSE_MAX_SIDE / max(gray1.shape))
+        small1 = cv2.resize(gray1, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA).astype(np.float32)
+        small2 = cv2.resize(gray2, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA).astype(np.float32)
+        (shift_x, shift_y), _ = cv2.phaseCorrelate(small1, small2)
+        matrix = np.float32([[1, 0, -shift_x / scale], [0, 1, -shift_y / scale]])
+        gray2 = cv2.warpAffine(gray2, matrix, (gray2.shape[1], gray2.shape[0]), borderMode=cv2.BORDER_REPLICATE)
+    return gray2, resized
+
+def _coarse_scores(gray1, gray2, row_edges, column_edges, workers):
+    """Per-tile SSIM on a downscaled pyramid level, used to skip tiles that clearly match."""
+    import cv2
+
+    scale = COARSE_MAX_SIDE / max(gray1.shape)
+    if scale >= 0.5:
+        return None  # too small for a coarse pass to save anything
+    small1 = cv2.resize(gray1, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    small2 = cv2.resize(gray2, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    height, width = small1.shape
+    tiles = []
+    for row in range(len(row_edges) - 1):
+        top = min(max(PAD, int(row_edges[row] * scale)), height - PAD - 1)
+        bottom = min(max(top + 1, int(row_edges[row + 1] * scale)), height - PAD)
+        for column in range(len(column_edges) - 1):
+            left = min(max(PAD, int(column_edges[column] * scale)), width - PAD - 1)
+            right = min(max(left + 1, int(column_edges[column + 1] * scale)), width - PAD)
+            tiles.append((top, bottom, left, right))
+    sums = _tile_sums(small1, small2, tiles, workers)
+    scores = [total / ((bottom - top) * (right - left)) for total, (top, bottom, left, right) in zip(sums, tiles)]
+    return np.array(scores, dtype=np.float32).reshape(len(row_edges) - 1, len(column_edges) - 1)
+
+def _preview(image_path, heatmap, row_edges, column_edges, threshold):
+    """A downscaled copy of the first image with the differing tiles outlined in red."""
+    import cv2
+
+    # Let the JPEG decoder downscale when it can, instead of decoding full size and shrinking
+    height, width = row_edges[-1] + PAD, column_edges[-1] + PAD
+    reduction = 1
+    while reduction < 8 and max(height, width) / (reduction * 2) >= PREVIEW_MAX_SIDE:
+        reduction *= 2
+    flags = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+             4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+    preview = cv2.imread(image_path, flags[reduction])
+    scale = min(1.0, PREVIEW_MAX_SIDE / max(preview.shape[:2]))
+    if scale < 1.0:
+        preview = cv2.resize(preview, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    factor_y, factor_x = preview.shape[0] / height, preview.shape[1] / width
+
+    for row, column in zip(*np.nonzero(1 - heatmap < threshold)):
+        top_left = (int(column_edges[column] * factor_x), int(row_edges[row] * factor_y))
+        bottom_right = (int(column_edges[column + 1] * factor_x) - 1, int(row_edges[row + 1] * factor_y) - 1)
+        cv2.rectangle(preview, top_left, bottom_right, (0, 0, 255), 2)
+    return Image.fromarray(cv2.cvtColor(preview, cv2.COLOR_BGR2RGB))
+
+def _score_grays(gray1, gray2, tile_size=DEFAULT_TILE_SIZE, refine=False, threshold=DIFF_THRESHOLD, workers=1,
+                 progress=None):
+    """
+    Tiled SSIM of two grayscale arrays of the same shape. Returns (score, heatmap, row
+    edges, column edges, number of tiles computed at full resolution).
+    """
+    if min(gray1.shape) < WIN_SIZE:
+        raise ValueError(f"Images must be at least {WIN_SIZE} pixels on each side")
+    row_edges = _tile_edges(gray1.shape[0], tile_size)
+    column_edges = _tile_edges(gray1.shape[1], tile_size)
+    coarse = None
+    if refine:
+        with metrics.stage("compare.coarse"):
+            coarse = _coarse_scores(gray1, gray2, row_edges, column_edges, workers)
+
+    shape = (len(row_edges) - 1, len(column_edges) - 1)
+    heatmap = np.zeros(shape, dtype=np.float32)
+    sums = np.zeros(shape, dtype=np.float64)
+    pending = []
+    for row in range(shape[0]):
+        for column in range(shape[1]):
+            area = (row_edges[row + 1] - row_edges[row]) * (column_edges[column + 1] - column_edges[column])
+            if coarse is not None and coarse[row, column] >= threshold:
+                sums[row, column] = float(coarse[row, column]) * area
+            else:
+                pending.append((row, column))
+    tiles = [(row_edges[row], row_edges[row + 1], column_edges[column], column_edges[column + 1])
+             for row, column in pending]
+    with metrics.stage("compare.ssim"):
+        for (row, column), tile_sum in zip(pending, _tile_sums(gray1, gray2, tiles, workers, progress)):
+            sums[row, column] = tile_sum
+
+    areas = np.outer(np.diff(row_edges), np.diff(column_edges))
+    heatmap[:] = 1 - sums / areas
+    score = float(sums.sum() / areas.sum())
+    return score, heatmap, row_edges, column_edges, len(pending)
+
+@cached("compare-scores", path_args=2, ignore=("workers", "progress"))
+def compare_scores(image_path_1, image_path_2, tile_size=DEFAULT_TILE_SIZE, refine=False, align=False,
+                   threshold=DIFF_THRESHOLD, workers=None, progress=None):
+    """
+    compare_images_tiled without the preview image. Returns TileScores, which holds only
+    numbers and the small heatmap, so it's cheap to cache.
+    """
+    with metrics.stage("compare.decode"):
+        gray1 = _load_gray(image_path_1)
+        gray2, resized = _align(gray1, _load_gray(image_path_2), align)
+    if metrics.is_enabled():
+        metrics.count("bytes_read", os.path.getsize(image_path_1) + os.path.getsize(image_path_2))
+    score, heatmap, row_edges, column_edges, refined_tiles = _score_grays(
+        gray1, gray2, tile_size, refine, threshold, workers or os.cpu_count() or 1, progress)
+    return TileScores(score, heatmap, row_edges, column_edges, resized, refined_tiles)
+
+def compare_images_tiled(image_path_1, image_path_2, tile_size=DEFAULT_TILE_SIZE, refine=False,
+                         align=False, threshold=DIFF_THRESHOLD, workers=None, progress=None):
+    """
+    SSIM comparison that works tile by tile in float32, so the intermediate SSIM buffers are
+    bounded by the tile size. Both images are still decoded in full (as 8-bit grayscale), so
+    peak memory grows with the image size. The global score matches compare_images to within
+    float32 precision. Images of different sizes are resized to match; align=True also corrects a
+    translation between them. Tiles are spread over a pool of workers threads (default: one
+    per CPU); workers=1 runs them in the calling thread. progress(fraction) is called as
+    full-resolution tiles complete and may raise to abandon the comparison.
+
+    With refine=True a coarse pass on a downscaled pyramid level runs first, and only tiles
+    scoring below threshold there are recomputed at full resolution.
+
+    Returns a CompareResult: the global score, a heatmap of per-tile differences (1 - SSIM),
+    a preview image with the differing tiles outlined, whether the second image was resized,
+    how many tiles were computed at full resolution, and the threshold used. The scores are
+    cached (see compare_scores); the preview is drawn on every call.
+    """
+    scores = compare_scores(image_path_1, image_path_2, tile_size, refine, align, threshold, workers, progress)
+    with metrics.stage("compare.postprocess"):
+        result_image = _preview(image_path_1, scores.heatmap, scores.row_edges, scores.column_edges, threshold)
+    return CompareResult(scores.score, scores.heatmap, result_image, scores.resized, scores.refined_tiles, threshold)
+
+_reference = None  # the grayscale reference of rank_images, loaded once per worker process
+
+def _load_reference(reference_path):
+    global _reference
+    try:
+        _reference = _load_gray(reference_path)
+    except Exception as e:  # reported by every comparison instead of breaking the pool
+        _reference = e
+
+def _rank_one(candidate_path, tile_size=DEFAULT_TILE_SIZE, refine=False, align=False, threshold=DIFF_THRESHOLD):
+    try:
+        if isinstance(_reference, Exception):
+            raise _reference
+        gray2, resized = _align(_reference, _load_gray(candidate_path), align)
+        score = _score_grays(_reference, gray2, tile_size, refine, threshold)[0]
+        return {"path": candidate_path, "score": score, "resized": resized}
+    except Exception as e:  # unreadable or too small; keep ranking the rest
+        return {"path": candidate_path, "error": str(e)}
+
+def rank_images(reference_path, candidate_paths, workers=None, **options):
+    """
+    Compares one reference image against many candidates across a process pool (one
+    comparison per process, single-threaded inside) and returns one record per candidate,
+    most similar first. Candidates that couldn't be compared come last with an "error".
+    Each worker decodes the reference once, and only scores are computed: no preview, no
+    cache entries. options (tile_size, refine, align, threshold) are as for compare_images_tiled.
+    """
+    candidates = [path for path in candidate_paths if os.path.abspath(path) != os.path.abspath(reference_path)]
+    records = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_load_reference, initargs=(reference_path,)) as executor:
+        futures = [executor.submit(_rank_one, path, **options) for path in candidates]
+        for future in as_completed(futures):
+            records.append(future.result())
+    records.sort(key=lambda record: (-record["score"], record["path"]) if "score" in record else (float('inf'), record["path"]))
+    return records
+
+def describe_comparison(result):
+    """Formats a CompareResult as text."""
+    differing = int(np.count_nonzero(1 - result.heatmap < result.threshold))
+    lines = [f"Image similarity score: {result.score}",
+             f"Differing tiles: {differing} of {result.heatmap.size}"]
+    if result.resized:
+        lines.append("The second image was resized to match the first.")
+    return "\n".join(lines)
@@ -1,5 +1,11 @@
 from PIL import Image
+import numpy as np
+import hashlib
 import os
+from io import BytesIO
+from modules import payload as container
+from modules import metrics
+from modules.cache import cached
 
 
 
@@ -18,7 +24,496 @@ def unique_file_path(base_path):
     
     return unique_path
 
-def encode_message(image_path, message, output_image_path=None):
+DELIMITER = "~~~"
+STREAM_CHUNK_PIXELS = 64 * 1024  # pixels per band read by the streaming decoder
+DEFAULT_COMPRESS_LEVEL = 6  # zlib level for encoded PNGs: 0 is fastest and largest, 9 smallest
+KEYED_SALT = b"inspector-image keyed LSB\0"
+KEYED_FIRST_BLOCK = 1024  # positions drawn in the first round; each round draws twice as many
+KEYED_MAX_BLOCK = 1 << 20
+MAX_BITS_PER_CHANNEL = 4
+SIXTEEN_BIT_MODES = ('I;16', 'I;16L', 'I;16B', 'I')  # 16-bit PNGs open as 'I'
+ALPHA_MODES = ('RGBA', 'RGBa', 'LA', 'La', 'PA')
+CHANNEL_NAMES = {1: "gray", 3: "RGB", 4: "RGBA"}
+
+
+def _has_alpha(img):
+    # Palette and gray images can mark a transparent color, which becomes alpha on conversion
+    return img.mode in ALPHA_MODES or (img.mode in ('P', 'L') and 'transparency' in img.info)
+
+def normalize_mode(img):
+    """
+    Converts images without separate R, G and B channels (palette, grayscale, ...) to RGB,
+    or to RGBA when they have transparency.
+    """
+    if img.mode in ('RGB', 'RGBA'):
+        return img
+    return img.convert('RGBA' if _has_alpha(img) else 'RGB')
+
+def _normalize_samples(img):
+    """
+    The image in a mode whose samples can carry payload bits: RGB or RGBA as in
+    normalize_mode, or 16-bit grayscale ('I;16'), which keeps its full depth instead of
+    being cut down to 8 bits.
+    """
+    if img.mode in SIXTEEN_BIT_MODES:
+        return Image.fromarray(np.clip(np.asarray(img), 0, 0xFFFF).astype(np.uint16))
+    return normalize_mode(img)
+
+def _samples(img, copy=False):
+    """The pixels of a normalized image as a (height, width, channels) array, also for gray images."""
+    pixels = np.array(img) if copy else np.asarray(img)
+    return pixels.reshape(pixels.shape[0], pixels.shape[1], -1)
+
+def _from_samples(pixels, mode):
+    if pixels.shape[2] == 1:
+        return Image.fromarray(pixels[..., 0])  # 'I;16' for uint16
+    return Image.fromarray(pixels, mode)
+
+def _layout_channels(img, alpha):
+    """
+    How many channels of each pixel carry payload bits: R, G and B, plus A with alpha=True,
+    or the single channel of a 16-bit grayscale image. Works from the header alone.
+    """
+    if alpha:
+        if not _has_alpha(img):
+            raise ValueError("The image has no alpha channel.")
+        return 4
+    return 1 if img.mode in SIXTEEN_BIT_MODES else 3
+
+def _layouts(img):
+    """
+    Every (bits per channel, alpha) combination an image can carry, the original one bit in
+    R, G and B first. The decoder tries them in this order; only the right one yields the
+    container's magic number.
+    """
+    alphas = (False, True) if _has_alpha(img) else (False,)
+    return [(bits, alpha) for alpha in alphas for bits in range(1, MAX_BITS_PER_CHANNEL + 1)]
+
+def _bytes_to_bits(data):
+    """Turns bytes into a flat array of bits, most significant bit first."""
+    return np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+
+def _to_groups(bits, bits_per_channel):
+    """Packs a flat bit array into values of bits_per_channel bits, most significant bit first."""
+    if bits_per_channel == 1:
+        return bits
+    padded = np.concatenate((bits, np.zeros(-len(bits) % bits_per_channel, dtype=np.uint8)))
+    weights = (1 << np.arange(bits_per_channel - 1, -1, -1)).astype(np.uint8)
+    return padded.reshape(-1, bits_per_channel) @ weights
+
+def _from_groups(values, bits_per_channel):
+    """The low bits_per_channel bits of each value as a flat bit array, most significant bit first."""
+    if bits_per_channel == 1:
+        return (values & 1).astype(np.uint8)
+    shifts = np.arange(bits_per_channel - 1, -1, -1)
+    return ((values[:, None] >> shifts) & 1).astype(np.uint8).reshape(-1)
+
+def _replace_low_bits(values, groups, bits_per_channel):
+    return (values >> bits_per_channel << bits_per_channel) | groups
+
+def _write_lsb(pixels, bits, bits_per_channel=1, channels=3):
+    """
+    Writes the bits into the low bits_per_channel bits of the first channels of each pixel
+    (R, G, B and, with channels=4, A), starting at pixel (0, 0).
+    """
+    groups = _to_groups(bits, bits_per_channel)
+    pixel_count = -(-len(groups) // channels)
+    selected = pixels.reshape(-1, pixels.shape[2])[:pixel_count, :channels]
+    values = selected.reshape(-1)  # a copy when unused channels are interleaved
+    values[:len(groups)] = _replace_low_bits(values[:len(groups)], groups, bits_per_channel)
+    selected[...] = values.reshape(selected.shape)
+
+def _read_lsb_bytes(pixels, byte_count=None):
+    """Packs the LSBs of the R, G and B channels into bytes, touching only the pixels needed."""
+    channels = pixels.reshape(-1, pixels.shape[2])
+    if byte_count is not None:
+        channels = channels[:-(-byte_count * 8 // 3)]
+    bits = (channels[:, :3] & 1).reshape(-1)
+    usable = len(bits) - len(bits) % 8
+    return np.packbits(bits[:usable]).tobytes()
+
+def _keyed_slots(password, capacity, count):
+    """
+    The first count LSB slots (indexes into the flattened R, G and B values) picked by a PRNG
+    seeded from the password. Slots are drawn in rounds of a fixed size schedule and
+    duplicates dropped, so the sequence doesn't depend on count: the decoder can generate the
+    header's slots first and the body's later, and both match what the encoder used.
+    """
+    digest = hashlib.sha256(KEYED_SALT + password.encode('utf-8')).digest()
+    rng = np.random.default_rng(np.frombuffer(digest, dtype=np.uint32).tolist())
+    slots = []
+    taken = np.empty(0, dtype=np.int64)  # sorted copy of the slots so far, for fast lookups
+    total = 0
+    block_size = KEYED_FIRST_BLOCK
+    while total < count:
+        block = rng.integers(0, capacity, size=block_size, dtype=np.int64)
+        values, first = np.unique(block, return_index=True)  # sorted, which keeps lookups cache-friendly
+        if len(taken):
+            new = taken[np.minimum(np.searchsorted(taken, values), len(taken) - 1)] != values
+            values, first = values[new], first[new]
+        slots.append(values[np.argsort(first)])  # back in drawing order
+        total += len(values)
+        taken = np.insert(taken, np.searchsorted(taken, values), values)
+        block_size = min(block_size * 2, KEYED_MAX_BLOCK)
+    return np.concatenate(slots)[:count] if slots else np.empty(0, dtype=np.int64)
+
+def _keyed_view(pixels, slots, channels):
+    """(flat pixel array, pixel indexes, channel indexes) addressing the slots."""
+    return pixels.reshape(-1, pixels.shape[2]), slots // channels, slots % channels
+
+def _write_keyed(pixels, bits, password, bits_per_channel=1, channels=3):
+    groups = _to_groups(bits, bits_per_channel)
+    slots = _keyed_slots(password, pixels.shape[0] * pixels.shape[1] * channels, len(groups))
+    flat, rows, columns = _keyed_view(pixels, slots, channels)
+    flat[rows, columns] = _replace_low_bits(flat[rows, columns], groups, bits_per_channel)
+
+def _read_keyed(pixels, password, byte_count, skip_bytes=0, bits_per_channel=1, channels=3):
+    """Gathers byte_count bytes starting skip_bytes in, touching only the slots they occupy."""
+    first_bit, end_bit = skip_bytes * 8, (skip_bytes + byte_count) * 8
+    first_slot = first_bit // bits_per_channel
+    slots = _keyed_slots(password, pixels.shape[0] * pixels.shape[1] * channels, -(-end_bit // bits_per_channel))
+    flat, rows, columns = _keyed_view(pixels, slots[first_slot:], channels)
+    bits = _from_groups(flat[rows, columns], bits_per_channel)
+    offset = first_slot * bits_per_channel
+    return np.packbits(bits[first_bit - offset:end_bit - offset]).tobytes()
+
+class _LSBReader:
+    """Extracts LSB bytes from an image a band of rows at a time, so decoding can stop early."""
+
+    def __init__(self, img, chunk_pixels=STREAM_CHUNK_PIXELS, progress=None):
+        self.img = normalize_mode(img)
+        self.progress = progress
+        self.width, self.height = self.img.size
+        self.rows_per_chunk = max(1, chunk_pixels // self.width)
+        self.row = 0
+        self.buffer = bytearray()
+        self._pending_bits = np.empty(0, dtype=np.uint8)
+
+    def read_chunk(self):
+        """Appends the next band of rows to the buffer. Returns False once the image is exhausted."""
+        if self.row >= self.height:
+            return False
+        bottom = min(self.row + self.rows_per_chunk, self.height)
+        pixels = np.asarray(self.img.crop((0, self.row, self.width, bottom)))
+        self.row = bottom
+        bits = np.concatenate((self._pending_bits, (pixels[..., :3] & 1).reshape(-1)))
+        usable = len(bits) - len(bits) % 8
+        self.buffer += np.packbits(bits[:usable]).tobytes()
+        self._pending_bits = bits[usable:]
+        if self.progress:
+            self.progress(self.row / self.height)
+        return True
+
+    def fill(self, size):
+        """Reads until at least `size` bytes are buffered. Returns the number of bytes available."""
+        while len(self.buffer) < size and self.read_chunk():
+            pass
+        return len(self.buffer)
+
+def _decode_delimited_stream(reader):
+    """Returns the text between a leading delimiter and the first closing one, or None."""
+    marker = DELIMITER.encode('latin-1')
+    if reader.fill(len(marker)) < len(marker) or reader.buffer[:len(marker)] != marker:
+        return None  # encode_message always starts the payload at pixel (0, 0)
+
+    search_from = len(marker)
+    while True:
+        end = reader.buffer.find(marker, search_from)
+        if end != -1:
+            return reader.buffer[len(marker):end].decode('latin-1')
+        # The closing delimiter may straddle two chunks
+        search_from = max(len(marker), len(reader.buffer) - len(marker) + 1)
+        if not reader.read_chunk():
+            return None
+
+def _open_image(source):
+    """Opens a path, bytes or a binary file-like object as a PIL image."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        metrics.count("bytes_read", len(source))
+        return Image.open(BytesIO(source))
+    img = Image.open(source)
+    if isinstance(source, (str, os.PathLike)) and metrics.is_enabled():
+        metrics.count("bytes_read", os.path.getsize(source))
+    return img
+
+def _capacity_bits(img, bits_per_channel, alpha, password):
+    """Payload bits the layout can hold, from the image header alone."""
+    slots = img.width * img.height * _layout_channels(img, alpha)
+    if password is not None:
+        slots //= 2  # beyond this, drawing unused positions gets slow
+    return slots * bits_per_channel
+
+def encode_image(source, data, output, compress_level=DEFAULT_COMPRESS_LEVEL, progress=None, password=None,
+                 bits_per_channel=1, alpha=False):
+    """
+    Hides data in the image read from source (a path, bytes or a binary file-like object)
+    and writes the result as PNG to output (a path or a writable binary file-like object).
+    The image is decoded once in memory; only the rows the payload reaches are copied out,
+    modified and pasted back, and the PNG is written in one pass. With a password the bits
+    are scattered over positions picked by a PRNG seeded from it, which needs the whole
+    image and can use at most half of its capacity. Raises ValueError if the image is too
+    small. progress(fraction) is called between steps, up to the start of the save, and may
+    raise to cancel.
+
+    bits_per_channel (1-4) low bits of every R, G and B value carry the payload, and of A
+    too with alpha=True. 16-bit grayscale images keep their depth and carry it in their one
+    channel. Palette and gray images become RGB, or RGBA if they have transparency.
+    """
+    if not 1 <= bits_per_channel <= MAX_BITS_PER_CHANNEL:
+        raise ValueError(f"Bits per channel must be between 1 and {MAX_BITS_PER_CHANNEL}.")
+    with metrics.stage("encode.open"):
+        img = _open_image(source)
+    width, height = img.size
+    channels = _layout_channels(img, alpha)
+    payload_bits = len(data) * 8
+    # Checked from the header alone, before any pixels are decoded
+    capacity = _capacity_bits(img, bits_per_channel, alpha, password)
+    if payload_bits > capacity:
+        raise ValueError(f"The payload needs {payload_bits} bits but the image only holds {capacity}.")
+
+    with metrics.stage("encode.decode"):
+        img = _normalize_samples(img)
+        img.load()
+    if progress:
+        progress(0.4)
+
+    with metrics.stage("encode.embed"):
+        bits = _bytes_to_bits(data)
+        if password is not None:
+            pixels = _samples(img, copy=True)
+            _write_keyed(pixels, bits, password, bits_per_channel, channels)
+            img = _from_samples(pixels, img.mode)
+        else:
+            rows = min(height, -(-payload_bits // (bits_per_channel * channels * width)))
+            band = _samples(img.crop((0, 0, width, rows)), copy=True)
+            _write_lsb(band, bits, bits_per_channel, channels)
+            img.paste(_from_samples(band, img.mode), (0, 0))
+    # The last chance to cancel: once the file is written, the task has done its work
+    if progress:
+        progress(0.5)
+
+    with metrics.stage("encode.save"):
+        img.save(output, 'PNG', compress_level=compress_level)
+
+def _encode_payload(image, data, output_image_path=None, progress=None, compress_level=DEFAULT_COMPRESS_LEVEL,
+                    password=None, bits_per_channel=1, alpha=False):
+    if output_image_path is None:
+        if not isinstance(image, (str, os.PathLike)):
+            return "Failed to encode the message. An output path or file is required when the image isn't a file path."
+        directory, filename = os.path.split(image)
+        name = os.path.splitext(filename)[0]
+        output_image_path = os.path.join(directory, f"encoded_{name}.png")
+
+    if isinstance(output_image_path, (str, os.PathLike)):
+        # Generate a unique file path to avoid overwriting existing files
+        output_image_path = unique_file_path(output_image_path)
+        destination = output_image_path
+    else:
+        destination = "the output file"
+
+    try:
+        encode_image(image, data, output_image_path, compress_level, progress, password, bits_per_channel, alpha)
+    except ValueError as e:
+        return f"Failed to encode the entire message. {e}"
+    return f"Message encoded successfully. Output image saved to {destination}"
+
+def encode_message(image_path, message, output_image_path=None, legacy=False, progress=None,
+                   compress_level=DEFAULT_COMPRESS_LEVEL, password=None, bits_per_channel=1, alpha=False):
+    """
+    Hides a text message (or raw bytes) in an image. image_path may also be bytes or a binary
+    file-like object, and output_image_path a writable binary file-like object. A password
+    scatters the payload over keyed pseudo-random positions. bits_per_channel and alpha
+    trade invisibility for capacity; see encode_image.
+    """
+    if legacy:
+        return _encode_message_legacy(image_path, message, output_image_path)
+    if isinstance(message, bytes):
+        data = container.pack_file("", message)
+    else:
+        data = container.pack_text(message)
+    return _encode_payload(image_path, data, output_image_path, progress, compress_level, password,
+                           bits_per_channel, alpha)
+
+def encode_file(image_path, file_path, output_image_path=None, progress=None, compress_level=DEFAULT_COMPRESS_LEVEL,
+                password=None, bits_per_channel=1, alpha=False):
+    with open(file_path, 'rb') as payload_file:
+        data = payload_file.read()
+    return _encode_payload(image_path, container.pack_file(os.path.basename(file_path), data),
+                           output_image_path, progress, compress_level, password, bits_per_channel, alpha)
+
+def capacity_plan(source, password=None):
+    """
+    The largest message each layout can hold in the image, from its header alone: one
+    {"bits_per_channel", "alpha", "channels", "capacity_bytes"} per layout, where
+    capacity_bytes excludes the container header. A password halves the capacity.
+    """
+    img = _open_image(source)
+    return [{"bits_per_channel": bits, "alpha": alpha, "channels": _layout_channels(img, alpha),
+             "capacity_bytes": max(0, _capacity_bits(img, bits, alpha, password) // 8 - container.HEADER_SIZE)}
+            for bits, alpha in _layouts(img)]
+
+def describe_capacity(plan, payload_size=None):
+    """Formats a capacity_plan as text; with the payload size, also whether and how it fits."""
+    lines = []
+    for layout in plan:
+        line = (f"{layout['bits_per_channel']} bits/channel {CHANNEL_NAMES[layout['channels']]:<4} "
+                f"{layout['capacity_bytes']:>14,} bytes")
+        if payload_size is not None:
+            if payload_size > layout["capacity_bytes"]:
+                line += "  too small"
+            else:
+                share = payload_size / layout["capacity_bytes"] if layout["capacity_bytes"] else 1
+                line += f"  fits, in {share:.1%} of the pixels"
+        lines.append(line)
+    return "\n".join(lines)
+
+def _read_container(reader):
+    """Reads exactly the header and body of a payload container. Returns None if there is none."""
+    if reader.fill(container.HEADER_SIZE) < container.HEADER_SIZE:
+        return None
+    try:
+        kind, length, checksum = container.parse_header(bytes(reader.buffer[:container.HEADER_SIZE]))
+    except container.PayloadError:
+        return None
+    end = container.HEADER_SIZE + length
+    if reader.fill(end) < end:
+        raise container.PayloadError("Payload is longer than the image capacity")
+    return container.unpack(kind, bytes(reader.buffer[container.HEADER_SIZE:end]), checksum)
+
+def _read_layout_bytes(img, bits_per_channel, channels, byte_count):
+    """The first byte_count bytes written in a layout, decoding only the rows they occupy."""
+    sample_count = -(-byte_count * 8 // bits_per_channel)
+    rows = min(img.height, -(-sample_count // (channels * img.width)))
+    band = _samples(img.crop((0, 0, img.width, rows)))
+    values = band.reshape(-1, band.shape[2])[:, :channels].reshape(-1)[:sample_count]
+    return np.packbits(_from_groups(values, bits_per_channel)).tobytes()[:byte_count]
+
+def _decode_layouts(img, layouts):
+    """Reads a container written in the first of the layouts that has one. Returns None if none does."""
+    for bits_per_channel, alpha in layouts:
+        channels = _layout_channels(img, alpha)
+        try:
+            kind, length, checksum = container.parse_header(
+                _read_layout_bytes(img, bits_per_channel, channels, container.HEADER_SIZE))
+        except container.PayloadError:
+            continue
+        end = container.HEADER_SIZE + length
+        if end * 8 > _capacity_bits(img, bits_per_channel, alpha, None):
+            raise container.PayloadError("Payload is longer than the image capacity")
+        body = _read_layout_bytes(img, bits_per_channel, channels, end)[container.HEADER_SIZE:]
+        return container.unpack(kind, body, checksum)
+    return None
+
+def _decode_keyed(img, password):
+    """
+    Reads a container from the keyed positions of whichever layout has one: the header
+    first, then exactly its body.
+    """
+    pixels = _samples(img)
+    for bits_per_channel, alpha in _layouts(img):
+        channels = _layout_channels(img, alpha)
+        capacity_bytes = _capacity_bits(img, bits_per_channel, alpha, password) // 8
+        if capacity_bytes < container.HEADER_SIZE:
+            continue
+        try:
+            header = _read_keyed(pixels, password, container.HEADER_SIZE, 0, bits_per_channel, channels)
+            kind, length, checksum = container.parse_header(header)
+        except container.PayloadError:
+            continue  # not this layout, or a different password
+        if container.HEADER_SIZE + length > capacity_bytes:
+            raise container.PayloadError("Payload is longer than the image capacity")
+        body = _read_keyed(pixels, password, length, container.HEADER_SIZE, bits_per_channel, channels)
+        return container.unpack(kind, body, checksum)
+    return None
+
+def decode_image_payload(img, stream=False, progress=None, password=None):
+    """
+    Returns the Payload hidden in an opened image, detecting the format automatically: the
+    length-prefixed container first, then the original "~~~" delimiters. Returns None if
+    nothing is found. progress(fraction) is called after each band of rows and may raise to
+    stop decoding. With a password only a keyed payload is looked for, reading just the
+    positions it occupies. Every bits-per-channel and alpha layout is tried, so the
+    encoder's settings needn't be known.
+    """
+    with metrics.stage("decode.decode"):
+        img.load()  # every reader below needs the pixels; loading here times the decoding alone
+    with metrics.stage("decode.extract"):
+        return _find_payload(img, stream, progress, password)
+
+def _find_payload(img, stream, progress, password):
+    img = _normalize_samples(img)
+    if password is not None:
+        return _decode_keyed(img, password)
+    if img.mode == 'I;16':
+        return _decode_layouts(img, _layouts(img))  # the "~~~" format never had 16-bit images
+    reader = _LSBReader(img, progress=progress)
+    payload = _read_container(reader)
+    if payload is not None:
+        return payload
+    # The streaming reader covers the original layout; the others have no streaming variant
+    payload = _decode_layouts(img, _layouts(img)[1:])
+    if payload is not None:
+        return payload
+
+    marker = DELIMITER.encode('latin-1')
+    if reader.buffer[:len(marker)] == marker or stream:
+        message = _decode_delimited_stream(reader)
+    else:
+        # Older images may have the delimiters anywhere, so search all of them
+        if progress:
+            while reader.read_chunk():  # band by band, so progress can be reported
+                pass
+            message = reader.buffer.decode('latin-1')
+        else:
+            message = _read_lsb_bytes(np.asarray(reader.img)).decode('latin-1')
+        if DELIMITER in message:
+            message = message[message.find(DELIMITER) + len(DELIMITER):message.rfind(DELIMITER)]
+        else:
+            message = None
+    if message is None:
+        return None
+    return container.Payload(container.KIND_TEXT, None, message)
+
+def _open_for_decoding(image_path):
+    with metrics.stage("decode.open"):
+        return _open_image(image_path)
+
+def decode_payload(image_path, stream=False, password=None):
+    return decode_image_payload(_open_for_decoding(image_path), stream=stream, password=password)
+
+def decode_image(img, stream=False, progress=None, password=None):
+    """Decodes the hidden message of an opened image into the text shown to the user."""
+    try:
+        payload = decode_image_payload(img, stream=stream, progress=progress, password=password)
+    except container.PayloadError as e:
+        return f"Hidden message is corrupted: {e}"
+    if payload is None:
+        return "No hidden message found."
+    with metrics.stage("decode.postprocess"):
+        return container.describe(payload)
+
+@cached("decode", ignore=("progress",))
+def _decode_message(image_path, legacy=False, stream=False, progress=None):
+    if legacy:
+        return _decode_message_legacy(image_path)
+    return decode_image(_open_for_decoding(image_path), stream=stream, progress=progress)
+
+def decode_message(image_path, legacy=False, stream=False, progress=None, password=None):
+    if password is not None:
+        # Never cached, so neither the message nor a hash of the password ends up on disk
+        return decode_image(_open_for_decoding(image_path), password=password)
+    return _decode_message(image_path, legacy=legacy, stream=stream, progress=progress)
+
+def save_payload_file(payload, directory):
+    """Writes an embedded file payload into directory and returns its path."""
+    os.makedirs(directory, exist_ok=True)
+    name = os.path.basename(payload.name) or "payload.bin"
+    output_path = unique_file_path(os.path.join(directory, name))
+    with open(output_path, 'wb') as output_file:
+        output_file.write(payload.data)
+    return output_path
+
+def _encode_message_legacy(image_path, message, output_image_path=None):
     intermediate_image_path = None
     original_ext = os.path.splitext(image_path)[1].lower()
     
@@ -30,7 +525,7 @@ def encode_message(image_path, message, output_image_path=None):
     else:
         image_to_encode = image_path
 
-    img = Image.open(image_to_encode)
+    img = normalize_mode(Image.open(image_to_encode))  # getpixel needs channel tuples
     encoded = img.copy()
     width, height = img.size
     delimiter = "~~~"
@@ -70,8 +565,8 @@ def encode_message(image_path, message, output_image_path=None):
         os.remove(intermediate_image_path)
         return "Failed to encode the entire message."
 
-def decode_message(image_path):
-    img = Image.open(image_path)
+def _decode_message_legacy(image_path):
+    img = normalize_mode(Image.open(image_path))
     width, height = img.size
     binary_message = ""
     
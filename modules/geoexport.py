@@ -0,0 +1,118 @@
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+import numpy as np
+from modules.shared import get_image_location
+
+
+FORMATS = ("geojson", "kml", "csv")
+LOCATE_CHUNK = 256  # images per task sent to a worker process
+METERS_PER_DEGREE = 111_320  # along a meridian
+MAX_CLUSTER_PATHS = 20  # image paths listed per cluster; the count covers the rest
+
+
+def _locate(image_path):
+    location = get_image_location(image_path, decimal=True)
+    if location[0] is None:
+        return image_path, None, None, location[1]
+    return image_path, location[0], location[1], None
+
+def locate_images(image_paths, workers=None):
+    """
+    Reads the GPS position of every image across a process pool. Returns ([(path, latitude,
+    longitude)], {path: reason} for images without a usable position).
+    """
+    points, missing = [], {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for path, lat, lon, reason in executor.map(_locate, image_paths, chunksize=LOCATE_CHUNK):
+            if reason is None:
+                points.append((path, lat, lon))
+            else:
+                missing[path] = reason
+    return points, missing
+
+def cluster_points(points, cell_meters):
+    """
+    Groups points on a grid of roughly cell_meters square cells and returns one cluster per
+    occupied cell, largest first: {"latitude", "longitude"} (the centroid), "count" and up
+    to MAX_CLUSTER_PATHS "paths". Columns are widened away from the equator so cells keep
+    about the same ground size.
+    """
+    if not points:
+        return []
+    paths = [path for path, _, _ in points]
+    coordinates = np.array([(lat, lon) for _, lat, lon in points], dtype=np.float64)
+    lat, lon = coordinates[:, 0], coordinates[:, 1]
+
+    cell_lat = cell_meters / METERS_PER_DEGREE
+    rows = np.floor(lat / cell_lat)
+    row_center = np.radians((rows + 0.5) * cell_lat)
+    cell_lon = cell_lat / np.maximum(np.cos(row_center), 0.01)
+    columns = np.floor(lon / cell_lon)
+
+    cells, labels = np.unique(np.stack([rows, columns], axis=1), axis=0, return_inverse=True)
+    labels = labels.reshape(-1)
+    counts = np.bincount(labels, minlength=len(cells))
+    centroid_lat = np.bincount(labels, weights=lat, minlength=len(cells)) / counts
+    centroid_lon = np.bincount(labels, weights=lon, minlength=len(cells)) / counts
+
+    members = {}
+    for index in np.argsort(labels, kind='stable'):
+        cluster_paths = members.setdefault(int(labels[index]), [])
+        if len(cluster_paths) < MAX_CLUSTER_PATHS:
+            cluster_paths.append(paths[index])
+
+    clusters = [{"latitude": float(centroid_lat[cell]), "longitude": float(centroid_lon[cell]),
+                 "count": int(counts[cell]), "paths": members[cell]} for cell in range(len(cells))]
+    clusters.sort(key=lambda cluster: -cluster["count"])
+    return clusters
+
+def points_as_clusters(points):
+    """One single-image 'cluster' per point, so unclustered exports share the writers."""
+    return [{"latitude": lat, "longitude": lon, "count": 1, "paths": [path]} for path, lat, lon in points]
+
+def write_geojson(clusters, output):
+    features = [{
+        "type": "Feature",
+        # GeoJSON positions are longitude first
+        "geometry": {"type": "Point", "coordinates": [cluster["longitude"], cluster["latitude"]]},
+        "properties": {"count": cluster["count"], "paths": cluster["paths"]},
+    } for cluster in clusters]
+    json.dump({"type": "FeatureCollection", "features": features}, output)
+
+def write_kml(clusters, output):
+    output.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<kml xmlns="http://www.opengis.net/kml/2.2"><Document>\n')
+    for cluster in clusters:
+        name = cluster["paths"][0] if cluster["count"] == 1 else f"{cluster['count']} images"
+        output.write(f"<Placemark><name>{escape(name)}</name>"
+                     f"<description>{escape(chr(10).join(cluster['paths']))}</description>"
+                     f"<Point><coordinates>{cluster['longitude']},{cluster['latitude']}</coordinates></Point>"
+                     "</Placemark>\n")
+    output.write("</Document></kml>\n")
+
+def write_csv(clusters, output):
+    writer = csv.writer(output)
+    writer.writerow(["latitude", "longitude", "count", "paths"])
+    for cluster in clusters:
+        writer.writerow([cluster["latitude"], cluster["longitude"], cluster["count"], ";".join(cluster["paths"])])
+
+WRITERS = {"geojson": write_geojson, "kml": write_kml, "csv": write_csv}
+
+def export_format(output_path):
+    """Picks the format from the file extension, defaulting to GeoJSON."""
+    extension = output_path.rsplit('.', 1)[-1].lower() if '.' in output_path else ''
+    return extension if extension in FORMATS else "geojson"
+
+def export_locations(image_paths, output_path, cell_meters=None, workers=None, file_format=None):
+    """
+    Writes the positions of the images to output_path as GeoJSON, KML or CSV, clustered on
+    a grid of cell_meters cells when given. Returns (number of features written, {path:
+    reason} for images without a position).
+    """
+    points, missing = locate_images(image_paths, workers)
+    clusters = cluster_points(points, cell_meters) if cell_meters else points_as_clusters(points)
+    with open(output_path, 'w', encoding='utf-8', newline='') as output:
+        WRITERS[file_format or export_format(output_path)](clusters, output)
+    return len(clusters), missing
@@ -1,14 +1,46 @@
 import tkinter as tk
-import requests
 from io import BytesIO
-import re
 import os
-from tkinter import filedialog, messagebox, Text, Scrollbar
+from tkinter import filedialog, messagebox, Text, Scrollbar, ttk
 from PIL import Image, ImageTk, ImageOps
 import tkinter.simpledialog as simpledialog
 import configparser
-from decode_encode import encode_message, decode_message
-from shared import get_image_location, extract_pgp_key, get_decimal_from_dms, get_image_exif, compare_images
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # so modules.* imports resolve when run as a script
+from modules.decode_encode import encode_message, decode_message
+from modules.carving import scan_file, describe_embedded
+from modules.comparison import compare_images_tiled, describe_comparison
+from modules.shared import get_image_location, extract_pgp_key, get_image_exif, compare_images
+from modules.tasks import TaskRunner
+from modules import metrics
+from modules.maps import MapFetcher, DEFAULT_BASE_URL, DEFAULT_MAP_CACHE_DIR
+
+TILED_COMPARE_PIXELS = 4_000_000  # compare images larger than this tile by tile
+TASK_POLL_MS = 100  # how often the Tk thread picks up finished tasks and progress
+
+def without_progress(func):
+    """Adapts a function that takes no progress callback for TaskRunner."""
+    return lambda *args, progress=None, **kwargs: func(*args, **kwargs)
+
+def fetch_map_image(fetcher, lat, lon, zoom, progress=None):
+    data = fetcher.fetch(lat, lon, zoom)
+    if data is None:
+        return None
+    img = Image.open(BytesIO(data))
+    img.load()
+    return img
+
+def compare_paths(image_path_1, image_path_2, progress=None):
+    """Runs the comparison suited to the images; returns (result image, text)."""
+    # Large images and images of different sizes go through the tiled comparison, which
+    # keeps memory bounded and resizes the second image to match the first
+    with Image.open(image_path_1) as img1, Image.open(image_path_2) as img2:
+        tiled = img1.size != img2.size or img1.width * img1.height > TILED_COMPARE_PIXELS
+    if tiled:
+        result = compare_images_tiled(image_path_1, image_path_2, refine=True, progress=progress)
+        return result.result_image, describe_comparison(result)
+    result_image, score = compare_images(image_path_1, image_path_2, progress=progress)
+    return result_image, f"Image similarity score: {score}"
 
 class ImageInspectorApp(tk.Tk):
     def __init__(self):
@@ -38,6 +70,10 @@ class ImageInspectorApp(tk.Tk):
         # Setup widgets
         self.setup_widgets()
 
+        # Long-running work runs on a background thread; results come back through poll_tasks
+        self.tasks = TaskRunner()
+        self.after(TASK_POLL_MS, self.poll_tasks)
+
     def setup_widgets(self):
         # Image path entry
         self.image_path_var = tk.StringVar(self.left_frame)
@@ -51,8 +87,17 @@ class ImageInspectorApp(tk.Tk):
         tk.Button(self.center_frame, text="Extract GPS Location", command=self.extract_gps).pack(anchor='center', pady=5)
         tk.Button(self.center_frame, text="Extract PGP Key", command=self.extract_pgp).pack(anchor='center', pady=5)
         tk.Button(self.center_frame, text="Show EXIF Data", command=self.show_exif_data).pack(anchor='center', pady=5)
+        tk.Button(self.center_frame, text="Scan Embedded Data", command=self.scan_embedded).pack(anchor='center', pady=5)
         tk.Button(self.center_frame, text="Compare Images", command=self.compare).pack(anchor='center', pady=5)
 
+        # Progress of the running task, with a way to stop it
+        self.progress_bar = ttk.Progressbar(self.center_frame, length=150, maximum=1.0)
+        self.progress_bar.pack(anchor='center', pady=(20, 5))
+        self.status_var = tk.StringVar(self.center_frame, value="Ready")
+        tk.Label(self.center_frame, textvariable=self.status_var, wraplength=150).pack(anchor='center')
+        self.cancel_button = tk.Button(self.center_frame, text="Cancel", command=self.cancel_task, state='disabled')
+        self.cancel_button.pack(anchor='center', pady=5)
+
         # Output Text Widget in the right frame
         self.text_frame = tk.Frame(self.right_frame)
         self.text_frame.pack(fill="both", expand=True)
@@ -65,10 +110,62 @@ class ImageInspectorApp(tk.Tk):
 
         self.output_text.config(yscrollcommand=scrollbar.set)
     
+    def run_task(self, description, func, *args, on_done=None, **kwargs):
+        """Queues func on the worker thread; on_done(result) runs on the Tk thread afterwards."""
+        func = metrics.timed(f"gui.task.{description}")(func)
+        self.tasks.submit(description, func, *args, on_done=on_done, on_error=self.task_failed, **kwargs)
+        self.update_task_status()
+
+    def task_failed(self, error):
+        messagebox.showerror("Error", str(error))
+
+    def cancel_task(self):
+        self.tasks.cancel_current()
+        self.status_var.set("Cancelling...")
+
+    def poll_tasks(self):
+        self.tasks.poll()
+        self.update_task_status()
+        self.after(TASK_POLL_MS, self.poll_tasks)
+
+    def update_task_status(self):
+        current = self.tasks.current
+        queued = len(self.tasks.queued)
+        if current is None and not queued:
+            self.progress_bar.stop()
+            self.progress_bar.configure(mode='determinate', value=0)
+            self.cancel_button.configure(state='disabled')
+            if self.status_var.get() != "Ready":
+                self.status_var.set("Ready")
+            return
+        self.cancel_button.configure(state='normal' if current else 'disabled')
+        status = f"{current.description}..." if current else "Starting..."
+        if current and current.cancelled:
+            status = "Cancelling..."
+        if queued:
+            status += f" ({queued} queued)"
+        self.status_var.set(status)
+        if current is not None and current.fraction is not None:
+            self.progress_bar.stop()
+            self.progress_bar.configure(mode='determinate', value=current.fraction)
+        elif str(self.progress_bar.cget('mode')) != 'indeterminate':
+            # No progress reports from this task: just show that something is happening
+            self.progress_bar.configure(mode='indeterminate')
+            self.progress_bar.start()
+
+    def show_output(self, text):
+        self.output_text.delete('1.0', tk.END)  # Clear existing output
+        self.output_text.insert(tk.END, text)
+
     def load_config(self):
         config = configparser.ConfigParser()
         config.read(os.path.join(os.path.dirname(__file__), '..', 'config.ini'))
         self.api_key = config['Geoapify']['api_key']
+        # Optional settings: a different map server, where maps are cached, and offline mode
+        self.map_fetcher = MapFetcher(self.api_key,
+                                      base_url=config.get('Geoapify', 'base_url', fallback=DEFAULT_BASE_URL),
+                                      cache_dir=config.get('Geoapify', 'cache_dir', fallback=DEFAULT_MAP_CACHE_DIR),
+                                      offline=config.getboolean('Geoapify', 'offline', fallback=False))
 
 
     def select_image(self):
@@ -105,13 +202,6 @@ class ImageInspectorApp(tk.Tk):
             messagebox.showerror("Error", "First image not selected.")
             return
         
-        # Check if the images have the same dimensions
-        img1 = Image.open(image_path_1)
-        img2 = Image.open(second_image_path)
-        if img1.size != img2.size:
-            messagebox.showerror("Error", "Input images must have the same dimensions.")
-            return
-        
         # Clear previous second image selection
         if self.second_image_label:
             self.second_image_label.destroy()
@@ -121,15 +211,18 @@ class ImageInspectorApp(tk.Tk):
         self.display_second_image(second_image_path)
 
         # Perform comparison
-        result_image, score = compare_images(image_path_1, second_image_path)
-        self.output_text.delete('1.0', tk.END)
-        similarity_text = f"Image similarity score: {score}"
-        self.output_text.insert(tk.END, similarity_text)
+        self.run_task("Comparing images", compare_paths, image_path_1, second_image_path,
+                      on_done=self.show_comparison)
+
+    def show_comparison(self, result):
+        result_image, similarity_text = result
+        self.show_output(similarity_text)
         if result_image:
             self.display_comparison_result(result_image)
         else:
             messagebox.showerror("Comparison Error", "Error occurred during image comparison.")
 
+    @metrics.timed("gui.render")
     def display_comparison_result(self, result_image_pil):
         # Convert PIL image to ImageTk.PhotoImage
         result_photo = ImageTk.PhotoImage(result_image_pil)
@@ -147,6 +240,7 @@ class ImageInspectorApp(tk.Tk):
         # Ensure the updated or new image is kept by setting it as an attribute of the label
         self.comparison_result_label.image = result_photo
 
+    @metrics.timed("gui.preview")
     def display_image(self, file_path):
         img = Image.open(file_path)
         img = self.correct_image_orientation(img)  # Correct the image orientation
@@ -163,6 +257,7 @@ class ImageInspectorApp(tk.Tk):
         # Keep a reference to the new image to prevent garbage-collection
         self.image_preview_label.image = img_tk
 
+    @metrics.timed("gui.preview")
     def display_second_image(self, image_path):
         img = Image.open(image_path)
         img = self.correct_image_orientation(img)  # Correct the image orientation if needed
@@ -185,9 +280,8 @@ class ImageInspectorApp(tk.Tk):
          # Prompt for the message using a dialog
             message = simpledialog.askstring("Encode Message", "Enter the message to encode:")
             if message:
-                result = encode_message(image_path, message)  # Proceed with encoding
-                self.output_text.delete('1.0', tk.END)  # Clear existing output
-                self.output_text.insert(tk.END, "Encode Result:\n" + result)
+                self.run_task("Encoding", encode_message, image_path, message,
+                              on_done=lambda result: self.show_output("Encode Result:\n" + result))
             else:
              messagebox.showinfo("Encode Message", "Encoding cancelled or no message entered.")
         else:
@@ -197,96 +291,71 @@ class ImageInspectorApp(tk.Tk):
         image_path = self.entry_image_path.get()
         if image_path:
             self.clear_map_display()  # Clear the map if it exists
-            message = decode_message(image_path)  # Adjusted to class method call
-            self.output_text.delete('1.0', tk.END)  # Clear existing output
-            self.output_text.insert(tk.END, "Decoded Message:\n" + message)
+            self.run_task("Decoding", decode_message, image_path,
+                          on_done=lambda message: self.show_output("Decoded Message:\n" + message))
         else:
             messagebox.showerror("Error", "Image path is required.")
 
-    def parse_dms_to_tuple(self, dms_str):
-        # Ignore negative signs for minutes and seconds by using the absolute value
-        match = re.match(r"(\d+)° (\d+)' ([\d.]+)\" ([NSEW])", dms_str)
-        if match:
-            degrees, minutes, seconds, direction = match.groups()
-            # Use absolute values for minutes and seconds to ensure positivity
-            dms_tuple = ((int(degrees), 1), (abs(int(minutes)), 1), (abs(float(seconds)), 1))
-            #print(f"Parsed DMS tuple: {dms_tuple}, Direction: {direction}")
-            return dms_tuple, direction
-        else:
-            print(f"Failed to parse DMS string: {dms_str}")
-        return None, None
-
-    
     def extract_gps(self):
         image_path = self.entry_image_path.get()
         if image_path:
             self.clear_gui_elements()  # Clear the output and map if they exist
-            location_str = get_image_location(image_path)
-            #print(f"Extracted GPS string: {location_str}")  # Debug print
-            if location_str:
-                # Extract numeric values and direction reference from DMS strings
-                lat_str, lon_str = location_str
-                lat_dms, lat_ref = self.parse_dms_to_tuple(lat_str)
-                lon_dms, lon_ref = self.parse_dms_to_tuple(lon_str)
-                #print(f"lat_dms: {lat_dms}, lon_dms: {lon_dms}")  # Debug print
-                #print(f"lat_ref: {lat_ref}, lon_ref: {lon_ref}")  # Debug print
-
-                # Convert DMS to decimal degrees using the shared function
-                lat_decimal = get_decimal_from_dms(lat_dms, lat_ref)
-                lon_decimal = get_decimal_from_dms(lon_dms, lon_ref)
-                #print(f"lat_decimal: {lat_decimal}, lon_decimal: {lon_decimal}")  # Debug print
-
-                if lat_decimal is not None and lon_decimal is not None:
-                    self.show_map(lat_decimal, lon_decimal)
-                    
-                else:
-                    messagebox.showinfo("GPS Location", "Invalid GPS data format.", message="Invalid GPS data format.")
-            else:
-                messagebox.showinfo("GPS Location", "No GPS data found.")
+            self.run_task("Reading GPS data", without_progress(get_image_location), image_path, decimal=True,
+                          on_done=self.show_location)
         else:
             messagebox.showerror("Error", "Image path is required.")
+
+    def show_location(self, location):
+        lat_decimal, lon_decimal = location
+        if lat_decimal is not None:
+            self.show_map(lat_decimal, lon_decimal)
+        else:
+            messagebox.showinfo("GPS Location", lon_decimal)  # the reason there is no location
         
     def show_map(self, lat, lon):
-        api_key = self.api_key  # Replace with your actual Geoapify API key in the config.ini file
         zoom_level = simpledialog.askstring("Zoom Level", "Enter map zoom level (1-20):", initialvalue=self.zoom_level)
         if zoom_level:
             self.zoom_level = zoom_level
-        # Construct the request URL for Geoapify Static Maps API
-        url = f"https://maps.geoapify.com/v1/staticmap?style=osm-liberty&width=400&height=400&center=lonlat:{lon},{lat}&zoom={zoom_level}&marker=lonlat:{lon},{lat};type:awesome&scaleFactor=1&apiKey={api_key}"
-    
-        try:
-            response = requests.get(url)
-            if response.status_code == 200:
-             # Convert the response content into an image
-                image_data = BytesIO(response.content)
-                img = Image.open(image_data)
-                img_tk = ImageTk.PhotoImage(img)
-            
-                # Display the image in the Tkinter window
-                if hasattr(self, 'map_label') and self.map_label.winfo_exists():
-                    self.clear_gui_elements()  # Clear the output and map if they exist
-                    self.map_label.configure(image=img_tk)
-                    self.map_label.image = img_tk  # Keep a reference to prevent garbage-collection
-                else:
-                    self.map_label = tk.Label(self.right_frame, image=img_tk)
-                    self.map_label.pack()
-                    self.output_text.insert(tk.END, f"Latitude: {lat}\nLongitude: {lon}\n")
-
-                self.map_label.image = img_tk  # Keep a reference to prevent garbage-collection
-            else:
-                self.output_text.insert(tk.END, f"Latitude: {lat}\nLongitude: {lon}\n")
-                messagebox.showerror("Error", "Failed to retrieve the map image. check your API key and internet connection.")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to display map: {e}")
+        # Maps come from the Geoapify Static Maps API, or the cache if this spot was shown before
+        self.run_task("Fetching map", fetch_map_image, self.map_fetcher, lat, lon, zoom_level,
+                      on_done=lambda img: self.display_map(img, lat, lon))
+
+    @metrics.timed("gui.render")
+    def display_map(self, img, lat, lon):
+        if img is None:
+            self.output_text.insert(tk.END, f"Latitude: {lat}\nLongitude: {lon}\n")
+            messagebox.showerror("Error", self.map_fetcher.last_error)
+            return
+        img_tk = ImageTk.PhotoImage(img)
+
+        # Display the image in the Tkinter window
+        if hasattr(self, 'map_label') and self.map_label.winfo_exists():
+            self.clear_gui_elements()  # Clear the output and map if they exist
+            self.map_label.configure(image=img_tk)
+            self.map_label.image = img_tk  # Keep a reference to prevent garbage-collection
+        else:
+            self.map_label = tk.Label(self.right_frame, image=img_tk)
+            self.map_label.pack()
+            self.output_text.insert(tk.END, f"Latitude: {lat}\nLongitude: {lon}\n")
+
+        self.map_label.image = img_tk  # Keep a reference to prevent garbage-collection
 
 
     def extract_pgp(self):
         image_path = self.entry_image_path.get()
         if image_path:
             self.clear_map_display()  # Clear the map if it exists
-            pgp_key = extract_pgp_key(image_path)  # Adjusted to class method call
-            self.output_text.delete('1.0', tk.END)  # Clear existing output
-            self.output_text.insert(tk.END, "PGP Key:\n" + pgp_key)
+            self.run_task("Searching for PGP keys", without_progress(extract_pgp_key), image_path,
+                          on_done=lambda pgp_key: self.show_output("PGP Key:\n" + pgp_key))
+        else:
+            messagebox.showerror("Error", "Image path is required.")
+
+    def scan_embedded(self):
+        image_path = self.entry_image_path.get()
+        if image_path:
+            self.clear_map_display()  # Clear the map if it exists
+            self.run_task("Scanning for embedded data", without_progress(scan_file), image_path,
+                          on_done=lambda embedded: self.show_output("Embedded Data:\n" + describe_embedded(embedded)))
         else:
             messagebox.showerror("Error", "Image path is required.")
 
@@ -314,9 +383,8 @@ class ImageInspectorApp(tk.Tk):
     def show_exif_data(self):
         image_path = self.entry_image_path.get()
         if image_path:
-            exif_data = get_image_exif(image_path)
-            self.output_text.delete('1.0', tk.END)
-            self.output_text.insert(tk.END, exif_data)
+            self.run_task("Reading EXIF data", without_progress(get_image_exif), image_path,
+                          on_done=self.show_output)
         else:
             messagebox.showerror("Error", "Image path is required.")
 
@@ -326,3 +394,5 @@ if __name__ == "__main__":
     # root = tk.Tk()
     app = ImageInspectorApp()
     app.mainloop()
+    if metrics.is_enabled():  # INSPECTOR_METRICS=1 prints where the session's time went
+        print(metrics.describe(metrics.snapshot()), file=sys.stderr)
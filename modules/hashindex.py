@@ -0,0 +1,283 @@
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from modules.cache import DEFAULT_CACHE_PATH
+from modules.steganalysis import dct_matrix
+
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(DEFAULT_CACHE_PATH), "hashes.sqlite")
+HASH_SIZE = 8  # 8x8 bits = 64-bit fingerprints
+HASH_BITS = HASH_SIZE * HASH_SIZE
+MIN_BAND_BITS = 4  # narrower bands match most of the index, so a full scan is faster
+PHASH_SIZE = 32  # the DCT runs on a 32x32 thumbnail
+DEFAULT_MAX_DISTANCE = 10  # Hamming distance (of 64 bits) still considered a near duplicate
+DEFAULT_TOP = 10  # candidates verified with SSIM
+HASH_CHUNK = 64  # images per task sent to a worker process
+
+DCT = dct_matrix(PHASH_SIZE)
+# Masks of the bit-parallel popcount
+M1, M2, M4, H01 = (np.uint64(mask) for mask in (0x5555555555555555, 0x3333333333333333,
+                                                 0x0F0F0F0F0F0F0F0F, 0x0101010101010101))
+
+
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+def _to_signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def hamming(hash_1, hash_2):
+    return bin(hash_1 ^ hash_2).count("1")
+
+def hamming_array(hashes, value):
+    """Hamming distances between an array of 64-bit hashes and one hash."""
+    # Bit counts of pairs, then nibbles, then bytes, summed into the top byte by the multiply
+    bits = hashes ^ np.uint64(value)
+    bits = bits - ((bits >> np.uint64(1)) & M1)
+    bits = (bits & M2) + ((bits >> np.uint64(2)) & M2)
+    bits = (bits + (bits >> np.uint64(4))) & M4
+    return ((bits * H01) >> np.uint64(56)).astype(np.int64)
+
+def image_hashes(img):
+    """Returns (pHash, dHash) of a PIL image as 64-bit integers."""
+    # JPEGs can be decoded straight to a reduced size, which is most of the cost saved
+    img.draft('L', (PHASH_SIZE * 2, PHASH_SIZE * 2))
+    gray = img.convert('L')
+
+    pixels = np.asarray(gray.resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (DCT @ pixels @ DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    # The DC term only reflects overall brightness, so leave it out of the median
+    phash = _bits_to_int(low > np.median(low.ravel()[1:]))
+
+    small = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS), dtype=np.int16)
+    dhash = _bits_to_int(small[:, 1:] > small[:, :-1])
+    return phash, dhash
+
+def _hash_files(paths):
+    results = []
+    for path in paths:
+        try:
+            with Image.open(path) as img:
+                results.append((path, *image_hashes(img), None))
+        except Exception as e:  # unreadable files are reported, not indexed
+            results.append((path, None, None, str(e)))
+    return results
+
+
+class MultiIndex:
+    """
+    Multi-index hashing over an array of 64-bit hashes, for one search radius. Every hash is
+    split into max_distance + 1 bands of bits; a hash within max_distance of another must
+    match it exactly in at least one band, so only the hashes sharing a band are compared,
+    with a vectorized XOR and popcount. Radii too large for useful bands scan everything.
+    """
+
+    def __init__(self, hashes, max_distance):
+        self.hashes = hashes
+        self.max_distance = max_distance
+        # (shift, mask, sorted band values, hash indexes in that order, position of each hash
+        # in it, end of the run of equal values at each position)
+        self.bands = []
+        count = max_distance + 1
+        if HASH_BITS // count < MIN_BAND_BITS:
+            return
+        edges = np.linspace(0, HASH_BITS, count + 1).astype(int)
+        for start, stop in zip(edges[:-1], edges[1:]):
+            shift, mask = np.uint64(start), np.uint64((1 << int(stop - start)) - 1)
+            values = (hashes >> shift) & mask
+            order = np.argsort(values, kind='stable')  # equal values stay in index order
+            positions = np.empty_like(order)
+            positions[order] = np.arange(len(order))
+            values = values[order]
+            self.bands.append((shift, mask, values, order, positions, np.searchsorted(values, values, side='right')))
+
+    def search(self, value):
+        """Returns (indexes, distances) of the hashes within max_distance of value."""
+        if self.bands:
+            value = np.uint64(value)
+            candidates = []
+            for shift, mask, values, order, _, _ in self.bands:
+                band = (value >> shift) & mask
+                candidates.append(order[np.searchsorted(values, band):np.searchsorted(values, band, side='right')])
+            indexes = np.unique(np.concatenate(candidates))
+        else:
+            indexes = np.arange(len(self.hashes))
+        distances = hamming_array(self.hashes[indexes], value)
+        within = distances <= self.max_distance
+        return indexes[within], distances[within]
+
+    def matches_after(self, index):
+        """
+        Indexes above index whose hashes are within max_distance of its hash, each found once
+        per band it shares, for visiting every pair once.
+        """
+        if self.bands:
+            # Hashes sharing a band value follow this one in that band's order, up to the end of the run
+            candidates = np.concatenate([order[positions[index] + 1:ends[positions[index]]]
+                                         for _, _, _, order, positions, ends in self.bands])
+        else:
+            candidates = np.arange(index + 1, len(self.hashes))
+        return candidates[hamming_array(self.hashes[candidates], self.hashes[index]) <= self.max_distance]
+
+
+class HashIndex:
+    """
+    Persistent pHash/dHash fingerprints for a set of images, stored in SQLite. Files are
+    re-hashed only when their size or modification time changes.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_INDEX_PATH
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, size INTEGER, "
+                                "mtime INTEGER, phash INTEGER, dhash INTEGER)")
+        self._entries = None
+        self._indexes = {}
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def add(self, image_paths, workers=None):
+        """
+        Hashes new and changed images across a process pool and stores them. Returns
+        (number of images hashed, {path: error} for images that couldn't be read).
+        """
+        known = {path: (size, mtime) for path, size, mtime in
+                 self.connection.execute("SELECT path, size, mtime FROM images")}
+        stale = {}
+        errors = {}
+        for path in image_paths:
+            path = os.path.abspath(path)
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                errors[path] = str(e)
+                continue
+            if known.get(path) != (stat.st_size, stat.st_mtime_ns):
+                stale[path] = (stat.st_size, stat.st_mtime_ns)
+
+        paths = list(stale)
+        chunks = [paths[i:i + HASH_CHUNK] for i in range(0, len(paths), HASH_CHUNK)]
+        hashed = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for results in executor.map(_hash_files, chunks):
+                rows = []
+                for path, phash, dhash, error in results:
+                    if error is not None:
+                        errors[path] = error
+                        continue
+                    rows.append((path, *stale[path], _to_signed(phash), _to_signed(dhash)))
+                with self.connection:
+                    self.connection.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)", rows)
+                hashed += len(rows)
+        self._entries = None
+        self._indexes = {}
+        return hashed, errors
+
+    def prune(self):
+        """Forgets images that no longer exist. Returns how many were removed."""
+        missing = [(path,) for (path,) in self.connection.execute("SELECT path FROM images")
+                   if not os.path.exists(path)]
+        with self.connection:
+            self.connection.executemany("DELETE FROM images WHERE path = ?", missing)
+        self._entries = None
+        self._indexes = {}
+        return len(missing)
+
+    def entries(self):
+        """(paths, pHashes, dHashes) of the indexed images, the hashes as uint64 arrays; loaded on first use."""
+        if self._entries is None:
+            rows = self.connection.execute("SELECT path, phash, dhash FROM images").fetchall()
+            self._entries = ([path for path, _, _ in rows],
+                             np.array([phash for _, phash, _ in rows], dtype=np.int64).view(np.uint64),
+                             np.array([dhash for _, _, dhash in rows], dtype=np.int64).view(np.uint64))
+        return self._entries
+
+    def multi_index(self, max_distance):
+        """MultiIndex over the pHashes for max_distance, built on first use."""
+        if max_distance not in self._indexes:
+            self._indexes[max_distance] = MultiIndex(self.entries()[1], max_distance)
+        return self._indexes[max_distance]
+
+    def query(self, phash, dhash, max_distance=DEFAULT_MAX_DISTANCE, limit=None):
+        """
+        Returns [(path, pHash distance, dHash distance)] for indexed images within
+        max_distance of the pHash, closest first (dHash breaks ties).
+        """
+        paths, _, dhashes = self.entries()
+        indexes, distances = self.multi_index(max_distance).search(phash)
+        dhash_distances = hamming_array(dhashes[indexes], dhash)
+        matches = [(paths[index], int(distance), int(dhash_distance))
+                   for index, distance, dhash_distance in zip(indexes, distances, dhash_distances)]
+        matches.sort(key=lambda match: (match[1], match[2], match[0]))
+        return matches[:limit] if limit else matches
+
+    def query_image(self, image_path, max_distance=DEFAULT_MAX_DISTANCE, limit=None):
+        with Image.open(image_path) as img:
+            phash, dhash = image_hashes(img)
+        image_path = os.path.abspath(image_path)
+        matches = [match for match in self.query(phash, dhash, max_distance) if match[0] != image_path]
+        return matches[:limit] if limit else matches
+
+    def duplicates(self, max_distance=DEFAULT_MAX_DISTANCE):
+        """Groups of indexed images whose pHashes are within max_distance of each other, largest first."""
+        paths = self.entries()[0]
+        index = self.multi_index(max_distance)
+        parent = list(range(len(paths)))
+
+        def find(item):
+            while parent[item] != item:
+                parent[item] = parent[parent[item]]
+                item = parent[item]
+            return item
+
+        for item in range(len(paths)):
+            for other in index.matches_after(item).tolist():
+                root, other_root = find(item), find(other)
+                if root != other_root:
+                    parent[other_root] = root
+        groups = {}
+        for item, path in enumerate(paths):
+            groups.setdefault(find(item), []).append(path)
+        return sorted((sorted(group) for group in groups.values() if len(group) > 1), key=lambda group: (-len(group), group[0]))
+
+
+def find_similar(image_path, index, max_distance=DEFAULT_MAX_DISTANCE, top=DEFAULT_TOP, verify=True,
+                 workers=None, **options):
+    """
+    Looks up near duplicates of image_path in a HashIndex and, with verify=True, runs SSIM
+    (compare_images_tiled, with options passed on) on the top candidates only. Returns one
+    record per candidate with "path", "phash_distance", "dhash_distance" and, when verified,
+    "score" or "error"; verified records are ordered by SSIM score.
+    """
+    matches = index.query_image(image_path, max_distance, limit=top)
+    records = [{"path": path, "phash_distance": phash_distance, "dhash_distance": dhash_distance}
+               for path, phash_distance, dhash_distance in matches]
+    if not verify or not records:
+        return records
+
+    from modules.comparison import rank_images
+
+    by_path = {record["path"]: record for record in records}
+    ranked = []
+    for result in rank_images(image_path, list(by_path), workers, **options):
+        record = by_path[result.pop("path")]
+        record.update(result)
+        ranked.append(record)
+    return ranked
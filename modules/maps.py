@@ -0,0 +1,146 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from modules.cache import DEFAULT_CACHE_PATH
+
+
+DEFAULT_BASE_URL = "https://maps.geoapify.com/v1/staticmap"
+DEFAULT_MAP_CACHE_DIR = os.path.join(os.path.dirname(DEFAULT_CACHE_PATH), "maps")
+DEFAULT_SIZE = (400, 400)
+DEFAULT_TIMEOUT = (5, 15)  # seconds to connect, seconds to read
+DEFAULT_RETRIES = 3
+COORDINATE_PRECISION = 4  # decimal places kept in cache keys and requests, about 10 m
+MEMORY_ITEMS = 32
+DEFAULT_MAX_DISK_BYTES = 64 * 1024 * 1024
+
+
+class MapFetcher:
+    """
+    Fetches static map images from Geoapify over one pooled session, with timeouts and
+    retries. Images are cached in memory and on disk, both least recently used first, keyed
+    by the rounded coordinates, zoom level and size, so photos taken at the same place
+    don't hit the network again. In offline mode only cached maps are returned.
+    """
+
+    def __init__(self, api_key, base_url=DEFAULT_BASE_URL, cache_dir=DEFAULT_MAP_CACHE_DIR, offline=False,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, memory_items=MEMORY_ITEMS,
+                 max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.timeout = timeout
+        self.memory_items = memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.last_error = None
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=("GET",), raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def cache_key(self, lat, lon, zoom, size=DEFAULT_SIZE):
+        return (round(lat, COORDINATE_PRECISION), round(lon, COORDINATE_PRECISION), str(zoom), *size)
+
+    def url(self, lat, lon, zoom, size=DEFAULT_SIZE):
+        width, height = size
+        return (f"{self.base_url}?style=osm-liberty&width={width}&height={height}&center=lonlat:{lon},{lat}"
+                f"&zoom={zoom}&marker=lonlat:{lon},{lat};type:awesome&scaleFactor=1&apiKey={self.api_key}")
+
+    def _disk_path(self, key):
+        name = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, name + ".png")
+
+    def _remember(self, key, data):
+        with self._lock:
+            self._memory[key] = data
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def _read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as map_file:
+                data = map_file.read()
+            os.utime(path)  # the modification time doubles as the last access time
+        except OSError:
+            return None
+        return data
+
+    def _write_disk(self, key, data):
+        if not self.cache_dir:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._disk_path(key)
+            temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary_path, 'wb') as map_file:
+                map_file.write(data)
+            os.replace(temporary_path, path)
+            self._evict_disk()
+        except OSError:
+            pass  # a full or read-only cache directory must not break map display
+
+    def _evict_disk(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".png"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def fetch(self, lat, lon, zoom, size=DEFAULT_SIZE):
+        """
+        Returns the PNG bytes of the map centered on (lat, lon), or None if it isn't cached
+        and can't be downloaded; last_error then says why.
+        """
+        key = self.cache_key(lat, lon, zoom, size)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+        data = self._read_disk(key)
+        if data is not None:
+            self._remember(key, data)
+            return data
+
+        if self.offline:
+            self.last_error = "The map isn't cached and offline mode is on."
+            return None
+        try:
+            # Rounded only for the key: the marker goes where the photo was taken
+            response = self.session.get(self.url(lat, lon, zoom, size), timeout=self.timeout)
+        except requests.RequestException as e:
+            self.last_error = f"Failed to retrieve the map image: {e}"
+            return None
+        if response.status_code != 200:
+            self.last_error = (f"Failed to retrieve the map image (HTTP {response.status_code}). "
+                               "Check your API key and internet connection.")
+            return None
+        data = response.content
+        self._remember(key, data)
+        self._write_disk(key, data)
+        return data
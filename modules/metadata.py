@@ -0,0 +1,252 @@
+import mmap
+import os
+import struct
+import zlib
+from collections import namedtuple
+from io import BytesIO
+from PIL.ExifTags import TAGS, GPSTAGS
+from modules import metrics
+
+
+# Only the head of a file is read: JPEG segments up to the first scan, PNG chunks up to the
+# first IDAT. This is enough for all EXIF and text metadata and never touches pixel data.
+JPEG_SOI = b"\xff\xd8"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+TIFF_HEADERS = (b"II*\x00", b"MM\x00*")
+EXIF_HEADER = b"Exif\x00\x00"
+
+# Pointer tags that link IFD0 to its sub-IFDs
+EXIF_IFD_POINTER = 0x8769
+GPS_IFD_POINTER = 0x8825
+INTEROP_IFD_POINTER = 0xA005
+MAKERNOTE_TAG = 0x927C
+MAX_IFD_ENTRIES = 1024
+
+# TIFF field type -> (struct format per value, size per value)
+FIELD_TYPES = {
+    1: ("B", 1),    # BYTE
+    2: ("s", 1),    # ASCII
+    3: ("H", 2),    # SHORT
+    4: ("I", 4),    # LONG
+    5: ("II", 8),   # RATIONAL
+    6: ("b", 1),    # SBYTE
+    7: ("s", 1),    # UNDEFINED
+    8: ("h", 2),    # SSHORT
+    9: ("i", 4),    # SLONG
+    10: ("ii", 8),  # SRATIONAL
+    11: ("f", 4),   # FLOAT
+    12: ("d", 8),   # DOUBLE
+    13: ("I", 4),   # IFD
+}
+IFD_ENTRY = {endian: struct.Struct(endian + "HHI4s") for endian in "<>"}  # tag, type, count, value/offset
+
+
+class Rational(namedtuple("Rational", ["numerator", "denominator"])):
+    """An EXIF rational. Indexes like piexif's (numerator, denominator) tuples, prints like PIL."""
+
+    __slots__ = ()
+
+    def __float__(self):
+        return self.numerator / self.denominator if self.denominator else float('nan')
+
+    def __str__(self):
+        return str(float(self))
+
+    __repr__ = __str__
+
+
+def _read_at(stream, offset, size):
+    stream.seek(offset)
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("EXIF field points past the end of the data")
+    return data
+
+def _field_value(stream, endian, field_type, count, value_field):
+    value_format, value_size = FIELD_TYPES[field_type]
+    size = value_size * count
+    data = value_field[:size] if size <= 4 else _read_at(stream, struct.unpack(endian + "I", value_field)[0], size)
+
+    if field_type == 2:
+        return (data[:-1] if data.endswith(b"\x00") else data).decode('latin-1', 'replace')
+    if field_type == 7:
+        return data
+    values = struct.unpack(endian + value_format * count, data)
+    if field_type in (5, 10):
+        values = tuple(Rational(values[i], values[i + 1]) for i in range(0, len(values), 2))
+    return values[0] if len(values) == 1 else values
+
+def _parse_ifd(stream, endian, offset, names, base, makernote):
+    """Returns ({tag name: value}, {tag id: raw pointer value}, offset of the next IFD)."""
+    entry_count = struct.unpack(endian + "H", _read_at(stream, offset, 2))[0]
+    if entry_count > MAX_IFD_ENTRIES:
+        raise ValueError("Implausible EXIF directory size")
+    entries = _read_at(stream, offset + 2, entry_count * 12 + 4)
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    tags, pointers = {}, {}
+    for index, (tag, field_type, count, value_field) in enumerate(IFD_ENTRY[endian].iter_unpack(entries[:-4])):
+        if field_type not in FIELD_TYPES:
+            continue
+        if tag == MAKERNOTE_TAG:
+            # Vendor-specific and often large: record where it is instead of copying it
+            size = FIELD_TYPES[field_type][1] * count
+            relative = struct.unpack(endian + "I", value_field)[0] if size > 4 else offset + 2 + index * 12 + 8
+            makernote.update(offset=base + relative, length=size)
+            continue
+        try:
+            value = _field_value(stream, endian, field_type, count, value_field)
+        except (ValueError, struct.error):
+            continue  # skip corrupt fields rather than losing the whole directory
+        # Damaged files can give a pointer several values or one past the end; don't follow those
+        if (tag in (EXIF_IFD_POINTER, GPS_IFD_POINTER, INTEROP_IFD_POINTER)
+                and isinstance(value, int) and 8 <= value < size):
+            pointers[tag] = value
+        tags[names.get(tag, f"0x{tag:04X}")] = value
+    next_offset = struct.unpack(endian + "I", entries[-4:])[0]
+    return tags, pointers, next_offset
+
+def _empty_metadata():
+    return {"ifd0": {}, "exif": {}, "gps": {}, "interop": {}, "ifd1": {}, "makernote": None}
+
+def parse_tiff(stream, base=0):
+    """
+    Parses a TIFF/EXIF structure from a seekable stream positioned at offset 0 of the TIFF
+    header. base is that header's offset in the original file and is only used to report the
+    MakerNote position.
+    """
+    header = _read_at(stream, 0, 8)
+    endian = "<" if header[:2] == b"II" else ">"
+    if header[:4] not in TIFF_HEADERS:
+        raise ValueError("Not a TIFF header")
+    makernote = {}
+    result = _empty_metadata()
+
+    ifd0, pointers, next_offset = _parse_ifd(stream, endian, struct.unpack(endian + "I", header[4:])[0],
+                                             TAGS, base, makernote)
+    result["ifd0"] = ifd0
+    if EXIF_IFD_POINTER in pointers:
+        result["exif"], exif_pointers, _ = _parse_ifd(stream, endian, pointers[EXIF_IFD_POINTER], TAGS, base, makernote)
+        if INTEROP_IFD_POINTER in exif_pointers:
+            result["interop"], _, _ = _parse_ifd(stream, endian, exif_pointers[INTEROP_IFD_POINTER],
+                                                 TAGS, base, makernote)
+    if GPS_IFD_POINTER in pointers:
+        result["gps"], _, _ = _parse_ifd(stream, endian, pointers[GPS_IFD_POINTER], GPSTAGS, base, makernote)
+    if next_offset:
+        try:
+            result["ifd1"], _, _ = _parse_ifd(stream, endian, next_offset, TAGS, base, makernote)
+        except (ValueError, struct.error):
+            pass  # a broken thumbnail directory doesn't invalidate the rest
+    result["makernote"] = makernote or None
+    return result
+
+def _jpeg_metadata(stream):
+    position = 2
+    stream.seek(position)
+    while True:
+        marker = stream.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            return None
+        if marker[1] in (0xDA, 0xD9):  # start of scan / end of image: no EXIF before the pixels
+            return None
+        segment_length = struct.unpack(">H", marker[2:])[0]
+        if marker[1] == 0xE1:  # APP1 holds EXIF, but also XMP
+            segment = stream.read(segment_length - 2)
+            if segment.startswith(EXIF_HEADER):
+                base = position + 4 + len(EXIF_HEADER)
+                return parse_tiff(BytesIO(segment[len(EXIF_HEADER):]), base)
+        position += 2 + segment_length
+        stream.seek(position)
+
+def _png_metadata(stream):
+    result = None
+    text = {}
+    position = len(PNG_SIGNATURE)
+    while True:
+        stream.seek(position)
+        header = stream.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type in (b"IDAT", b"IEND"):
+            break
+        if chunk_type in (b"eXIf", b"tEXt", b"zTXt", b"iTXt"):
+            data = stream.read(length)
+            try:
+                if chunk_type == b"eXIf":
+                    result = parse_tiff(BytesIO(data), position + 8)
+                elif chunk_type == b"tEXt":
+                    key, value = data.split(b"\x00", 1)
+                    text[key.decode('latin-1')] = value.decode('latin-1')
+                elif chunk_type == b"zTXt":
+                    key, value = data.split(b"\x00", 1)
+                    text[key.decode('latin-1')] = zlib.decompress(value[1:]).decode('latin-1')
+                else:
+                    key, rest = data.split(b"\x00", 1)
+                    compressed = rest[0]
+                    _, _, value = rest[2:].split(b"\x00", 2)
+                    text[key.decode('latin-1')] = (zlib.decompress(value) if compressed else value).decode('utf-8', 'replace')
+            except (ValueError, struct.error, zlib.error):
+                pass
+        position += 12 + length
+    if result is None:
+        result = _empty_metadata()
+    result["text"] = text
+    return result
+
+def parse_metadata(stream):
+    """
+    Parses the metadata of a JPEG, PNG or TIFF file from a seekable binary stream.
+
+    Returns a dict with "format", the tag dicts "ifd0", "exif", "gps", "interop" and "ifd1"
+    (keyed by tag name, values as int/str/bytes/Rational or tuples of them), "makernote"
+    ({"offset", "length"} in the file, or None) and, for PNG, the "text" chunks. The tag
+    dicts are empty when the file has no EXIF data. Returns None for other formats and for
+    metadata too damaged to parse.
+    """
+    stream.seek(0)
+    head = stream.read(8)
+    try:
+        if head.startswith(JPEG_SOI):
+            result = _jpeg_metadata(stream) or _empty_metadata()
+            file_format = "jpeg"
+        elif head.startswith(PNG_SIGNATURE):
+            result = _png_metadata(stream)
+            file_format = "png"
+        elif head[:4] in TIFF_HEADERS:
+            result = parse_tiff(stream)
+            file_format = "tiff"
+        else:
+            return None
+    except (ValueError, TypeError, struct.error):
+        return None
+    result["format"] = file_format
+    return result
+
+def read_metadata(image_path):
+    with open(image_path, 'rb') as image_file:
+        result = parse_metadata(image_file)
+        metrics.count("bytes_read", image_file.tell())  # how far parsing got
+        return result
+
+def metadata_from_buffer(buffer):
+    """parse_metadata for bytes or an mmap already in memory."""
+    if isinstance(buffer, mmap.mmap):
+        buffer.seek(0)
+        return parse_metadata(buffer)
+    return parse_metadata(BytesIO(buffer))
+
+def has_exif(metadata):
+    return bool(metadata and (metadata["ifd0"] or metadata["exif"] or metadata["gps"]))
+
+def to_json(value):
+    """Converts parsed metadata to JSON-friendly values: rationals become [numerator, denominator]."""
+    if isinstance(value, Rational):
+        return [value.numerator, value.denominator]
+    if isinstance(value, dict):
+        return {key: to_json(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [to_json(item) for item in value]
+    if isinstance(value, bytes):
+        return value.hex()
+    return value
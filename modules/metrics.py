@@ -0,0 +1,131 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Set in the environment, like the cache settings, so batch worker processes inherit it
+ENV_ENABLED = "INSPECTOR_METRICS"
+PROMETHEUS_PREFIX = "inspector"
+PROMETHEUS_EXTENSIONS = (".prom", ".txt")
+
+_lock = threading.Lock()
+_stages = {}  # stage name: [calls, seconds]
+_counters = {}  # counter name: total
+
+
+def configure(enabled):
+    """Turns recording on or off for this process and any worker processes it starts."""
+    if enabled:
+        os.environ[ENV_ENABLED] = "1"
+    else:
+        os.environ.pop(ENV_ENABLED, None)
+
+def is_enabled():
+    return bool(os.environ.get(ENV_ENABLED))
+
+def record(name, seconds):
+    with _lock:
+        totals = _stages.setdefault(name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+def count(name, amount=1):
+    """Adds amount to a counter, e.g. count("bytes_read", size). Does nothing while disabled."""
+    if not is_enabled():
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+@contextmanager
+def stage(name):
+    """Times the block as one call of the named stage. Stages may nest; each is timed inclusively."""
+    if not is_enabled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+def timed(name):
+    """Decorator form of stage()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _copy():
+    return {"stages": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in _stages.items()},
+            "counters": dict(_counters)}
+
+def snapshot():
+    """{"stages": {name: {"calls", "seconds"}}, "counters": {name: total}} recorded so far."""
+    with _lock:
+        return _copy()
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+def collect():
+    """Returns the snapshot and starts over, so a worker process can hand its share to the parent."""
+    with _lock:
+        result = _copy()
+        _stages.clear()
+        _counters.clear()
+    return result
+
+def merge(other):
+    """Adds a snapshot from another process to this one's totals."""
+    with _lock:
+        for name, values in other["stages"].items():
+            totals = _stages.setdefault(name, [0, 0.0])
+            totals[0] += values["calls"]
+            totals[1] += values["seconds"]
+        for name, amount in other["counters"].items():
+            _counters[name] = _counters.get(name, 0) + amount
+
+def describe(metrics, wall_seconds=None):
+    """Formats a snapshot as a table of stages, slowest first, and the counters."""
+    lines = [f"{'stage':<28} {'calls':>7} {'seconds':>10} {'share':>7}"]
+    for name, values in sorted(metrics["stages"].items(), key=lambda item: -item[1]["seconds"]):
+        share = f"{values['seconds'] / wall_seconds:7.1%}" if wall_seconds else ""
+        lines.append(f"{name:<28} {values['calls']:>7} {values['seconds']:>10.4f} {share}")
+    if wall_seconds is not None:
+        lines.append(f"{'wall time':<28} {'':>7} {wall_seconds:>10.4f}")
+    for name, amount in sorted(metrics["counters"].items()):
+        lines.append(f"{name:<28} {amount:>18}")
+    return "\n".join(lines)
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def to_prometheus(metrics, prefix=PROMETHEUS_PREFIX):
+    """The snapshot in the Prometheus text exposition format."""
+    lines = [f"# HELP {prefix}_stage_seconds_total Time spent in each stage.",
+             f"# TYPE {prefix}_stage_seconds_total counter"]
+    lines += [f'{prefix}_stage_seconds_total{{stage="{_label(name)}"}} {values["seconds"]}'
+              for name, values in sorted(metrics["stages"].items())]
+    lines += [f"# HELP {prefix}_stage_calls_total Times each stage ran.",
+              f"# TYPE {prefix}_stage_calls_total counter"]
+    lines += [f'{prefix}_stage_calls_total{{stage="{_label(name)}"}} {values["calls"]}'
+              for name, values in sorted(metrics["stages"].items())]
+    for name, amount in sorted(metrics["counters"].items()):
+        lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {amount}"]
+    return "\n".join(lines) + "\n"
+
+def write_metrics(metrics, output_path, wall_seconds=None):
+    """Writes a snapshot as Prometheus text (.prom or .txt) or JSON (anything else)."""
+    with open(output_path, 'w', encoding='utf-8') as output:
+        if output_path.lower().endswith(PROMETHEUS_EXTENSIONS):
+            output.write(to_prometheus(metrics))
+        else:
+            json.dump({**metrics, "wall_seconds": wall_seconds}, output, indent=2)
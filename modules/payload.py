@@ -0,0 +1,63 @@
+import struct
+import zlib
+from collections import namedtuple
+
+
+# Container layout: magic, format version, payload kind, body length, CRC-32 of the body
+MAGIC = b"IIMG"
+VERSION = 1
+HEADER = struct.Struct(">4sBBII")
+HEADER_SIZE = HEADER.size
+
+KIND_TEXT = 0  # UTF-8 text
+KIND_FILE = 1  # 2-byte name length, UTF-8 file name, raw file bytes
+
+Payload = namedtuple("Payload", ["kind", "name", "data"])
+
+
+class PayloadError(ValueError):
+    """Raised when a payload header or body is malformed."""
+
+
+def pack(kind, body):
+    return HEADER.pack(MAGIC, VERSION, kind, len(body), zlib.crc32(body)) + body
+
+def pack_text(text):
+    return pack(KIND_TEXT, text.encode('utf-8'))
+
+def pack_file(name, data):
+    name_bytes = name.encode('utf-8')
+    return pack(KIND_FILE, struct.pack(">H", len(name_bytes)) + name_bytes + data)
+
+def parse_header(header):
+    """Returns (kind, length, checksum) from the first HEADER_SIZE bytes of a payload."""
+    if len(header) < HEADER_SIZE:
+        raise PayloadError("Truncated payload header")
+    magic, version, kind, length, checksum = HEADER.unpack(header[:HEADER_SIZE])
+    if magic != MAGIC:
+        raise PayloadError("Not a payload container")
+    if version != VERSION:
+        raise PayloadError(f"Unsupported payload version {version}")
+    if kind not in (KIND_TEXT, KIND_FILE):
+        raise PayloadError(f"Unknown payload kind {kind}")
+    return kind, length, checksum
+
+def unpack(kind, body, checksum):
+    """Verifies the body against its checksum and returns a Payload."""
+    if zlib.crc32(body) != checksum:
+        raise PayloadError("Payload checksum mismatch")
+    # A body can pass the CRC and still be malformed, e.g. written by another tool
+    try:
+        if kind == KIND_TEXT:
+            return Payload(kind, None, body.decode('utf-8'))
+        name_length = struct.unpack(">H", body[:2])[0]
+        name = body[2:2 + name_length].decode('utf-8')
+    except (UnicodeDecodeError, struct.error) as e:
+        raise PayloadError(f"Corrupt payload body: {e}") from e
+    return Payload(kind, name, body[2 + name_length:])
+
+def describe(payload):
+    """Human-readable form of a payload: the text itself, or a summary of the embedded file."""
+    if payload.kind == KIND_TEXT:
+        return payload.data
+    return f"Hidden file: {payload.name or 'unnamed'} ({len(payload.data)} bytes)"
@@ -0,0 +1,380 @@
+import base64
+import json
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from modules import metrics
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+PENDING_PER_WORKER = 2  # default queue bound: requests running or waiting per worker process
+MAX_BODY_BYTES = 256 * 1024 * 1024
+REQUEST_TIMEOUT = 300  # seconds a request waits for its result
+RETRY_AFTER = 1  # seconds suggested to clients turned away while the queue is full
+ANALYSIS_ENDPOINTS = ("map", "steg", "allpgp", "carve", "decode", "detect", "exif", "metadata")
+TASK_ENDPOINTS = ANALYSIS_ENDPOINTS + ("analyze", "encode", "compare")
+TRUE_VALUES = ("1", "true", "yes", "on")
+# Only accepted in JSON bodies: browsers send those cross-origin only after a CORS preflight,
+# which this service never answers, so a web page can't make it read or write local files
+PATH_OPTIONS = ("path", "other_path", "output")
+
+
+class RequestError(Exception):
+    """A request that can't be served, with the HTTP status to answer it with."""
+
+    def __init__(self, status, message):
+        super().__init__(status, message)
+        self.status = status
+        self.message = message
+
+
+# Run in the worker processes
+
+def _warm_up():
+    """Pool initializer: imports everything the tasks use, so no request pays for it."""
+    import cv2  # noqa: F401
+    import modules.analysis, modules.comparison, modules.decode_encode  # noqa: F401
+
+def _ping():
+    return os.getpid()
+
+def _analysis(request):
+    from modules.analysis import ImageAnalysis
+    if request.get("image") is not None:
+        return ImageAnalysis.from_bytes(request["image"], request.get("name", "<upload>"))
+    return ImageAnalysis(request["path"])
+
+def _analyze(request):
+    from modules.decode_encode import decode_image
+    with _analysis(request) as analysis:
+        operations = [op for op in request["operations"] if not (op == "decode" and request.get("password"))]
+        result = analysis.run(operations)
+        if len(operations) < len(request["operations"]):
+            # Never cached, like decode_message with a password
+            try:
+                result["decode"] = decode_image(analysis.image, password=request["password"])
+            except Exception as e:
+                result.setdefault("errors", {})["decode"] = str(e)
+    return "application/json", result
+
+def _encode_to(source, data, output, request):
+    from modules.decode_encode import encode_image
+    try:
+        encode_image(source, data, output, request["compress"], password=request.get("password"),
+                     bits_per_channel=request["bits"], alpha=request["alpha"])
+    except ValueError as e:  # too small for the payload, or no alpha channel
+        raise RequestError(422, str(e))
+
+def _encode(request):
+    from io import BytesIO
+    from modules import payload as container
+    from modules.decode_encode import unique_file_path
+    if request.get("file") is not None:
+        data = container.pack_file(request.get("file_name") or "", request["file"])
+    else:
+        data = container.pack_text(request["message"])
+    source = request["image"] if request.get("image") is not None else request["path"]
+    if not request.get("output"):
+        output = BytesIO()
+        _encode_to(source, data, output, request)
+        return "image/png", output.getvalue()
+    # Never overwrites: like the CLI, an existing name gets a numbered suffix
+    output_path = unique_file_path(request["output"])
+    try:
+        with open(output_path, 'xb') as output:
+            _encode_to(source, data, output, request)
+    except FileExistsError:  # created by someone else since unique_file_path looked
+        raise RequestError(409, f"{output_path} already exists.")
+    except BaseException:
+        os.remove(output_path)
+        raise
+    return "application/json", {"output": output_path}
+
+def _image_file(request, key, path_key, stack):
+    """A path for the image under key, writing uploads to a temporary file for the path-based comparison."""
+    if request.get(key) is None:
+        return request[path_key]
+    handle, path = tempfile.mkstemp(prefix="inspector-upload-")
+    with os.fdopen(handle, 'wb') as upload:
+        upload.write(request[key])
+    stack.callback(os.remove, path)
+    return path
+
+def _compare(request):
+    from contextlib import ExitStack
+    import numpy as np
+    from modules.comparison import compare_scores, DIFF_THRESHOLD
+    with ExitStack() as stack:
+        # Scores only: the preview image would be thrown away
+        result = compare_scores(_image_file(request, "image", "path", stack),
+                                _image_file(request, "other", "other_path", stack),
+                                tile_size=request["tile"], refine=request["refine"],
+                                align=request["align"], workers=1)
+    return "application/json", {
+        "score": result.score, "resized": result.resized,
+        "differing_tiles": int(np.count_nonzero(1 - result.heatmap < DIFF_THRESHOLD)),
+        "tiles": int(result.heatmap.size),
+    }
+
+TASKS = {"analyze": _analyze, "encode": _encode, "compare": _compare}
+
+def run_task(endpoint, request):
+    """Runs one request in a worker process. Returns (content type, body, metrics recorded meanwhile)."""
+    metrics.reset()
+    content_type, body = TASKS[endpoint](request)
+    return content_type, body, metrics.collect()
+
+
+# Run in the server process
+
+def _flag(value):
+    if isinstance(value, str):
+        return value.lower() in TRUE_VALUES
+    return bool(value)
+
+def _integer(request, name, default, low=None, high=None):
+    value = request.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise RequestError(400, f"{name} must be an integer.")
+    if low is not None and value < low:
+        raise RequestError(400, f"{name} must be at least {low}.")
+    if high is not None and value > high:
+        raise RequestError(400, f"{name} must be at most {high}.")
+    return value
+
+def _check_path(path, roots):
+    """The absolute form of a local path, if it's under one of roots (any path when roots is empty)."""
+    if not isinstance(path, str) or not path:
+        raise RequestError(400, "Paths must be non-empty strings.")
+    real = os.path.realpath(path)
+    if roots and not any(os.path.commonpath([real, root]) == root for root in roots):
+        raise RequestError(403, f"{path} is outside the directories this service may read.")
+    return real
+
+def _decode_base64(request, name):
+    try:
+        return base64.b64decode(request[name], validate=True)
+    except (TypeError, ValueError):
+        raise RequestError(400, f"{name} must be base64.")
+
+def parse_request(endpoint, query, content_type, body, roots=()):
+    """
+    Turns a POST to endpoint into the request dict passed to run_task. A JSON body holds
+    the options, with the image as a local "path" or base64 "image" (and "other_path" or
+    "other" for compare). Any other body is the image itself, with the options in the
+    query string; local paths aren't accepted there. An encode "output" path is only
+    accepted when roots are set. Returns (task name, request).
+    """
+    if content_type.split(";")[0].strip() == "application/json":
+        try:
+            request = json.loads(body)
+        except ValueError as e:
+            raise RequestError(400, f"Invalid JSON: {e}")
+        if not isinstance(request, dict):
+            raise RequestError(400, "The JSON body must be an object.")
+        for name in ("image", "other", "file"):
+            if request.get(name) is not None:
+                request[name] = _decode_base64(request, name)
+    else:
+        request = {name: values[-1] for name, values in parse_qs(query).items()}
+        given = [name for name in PATH_OPTIONS if name in request]
+        if given:
+            raise RequestError(400, f"{', '.join(given)} can only be given in an application/json body.")
+        if not body:
+            raise RequestError(400, "The body is empty; send the image as the body.")
+        request["image"] = body
+    if request.get("output") is not None and not roots:
+        raise RequestError(403, "Writing to an output path needs the service to be started with -root.")
+    for name in PATH_OPTIONS:
+        if request.get(name) is not None:
+            request[name] = _check_path(request[name], roots)
+    if request.get("image") is None and request.get("path") is None:
+        raise RequestError(400, "Send the image as the body, as base64 \"image\" or as a local \"path\".")
+
+    if endpoint == "compare":
+        if request.get("other") is None and request.get("other_path") is None:
+            raise RequestError(400, "compare needs a second image: \"other\" or \"other_path\".")
+        from modules.comparison import DEFAULT_TILE_SIZE
+        request["tile"] = _integer(request, "tile", DEFAULT_TILE_SIZE, low=8)
+        request["refine"] = _flag(request.get("refine", False))
+        request["align"] = _flag(request.get("align", False))
+        return "compare", request
+    if endpoint == "encode":
+        if request.get("message") is None and request.get("file") is None:
+            raise RequestError(400, "encode needs a \"message\" or a base64 \"file\".")
+        from modules.decode_encode import DEFAULT_COMPRESS_LEVEL, MAX_BITS_PER_CHANNEL
+        request["compress"] = _integer(request, "compress", DEFAULT_COMPRESS_LEVEL, low=0, high=9)
+        request["bits"] = _integer(request, "bits", 1, low=1, high=MAX_BITS_PER_CHANNEL)
+        request["alpha"] = _flag(request.get("alpha", False))
+        return "encode", request
+
+    operations = request.get("operations", []) if endpoint == "analyze" else [endpoint]
+    if isinstance(operations, str):
+        operations = [op for op in operations.split(",") if op]
+    unknown = [op for op in operations if op not in ANALYSIS_ENDPOINTS]
+    if unknown or not operations:
+        raise RequestError(400, f"operations must be a list of: {', '.join(ANALYSIS_ENDPOINTS)}.")
+    request["operations"] = operations
+    return "analyze", request
+
+
+class InspectorServer(ThreadingHTTPServer):
+    """
+    Serves the analyses over HTTP. Each request is handled on its own thread, which hands
+    the CPU work to a pool of worker processes started (and warmed up) once. At most
+    max_pending requests run or wait at a time; beyond that the server answers 503 with
+    Retry-After instead of queueing without bound.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, workers=None, max_pending=None, roots=(), timeout=REQUEST_TIMEOUT):
+        super().__init__(address, InspectorHandler)
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * PENDING_PER_WORKER
+        self.roots = [os.path.realpath(root) for root in roots]
+        self.timeout = timeout
+        self.pool = self._start_pool()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self.pending = 0
+
+    def _start_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_warm_up)
+
+    def replace_pool(self, broken):
+        """Starts a new pool after a worker process died, which breaks the whole pool."""
+        with self._lock:
+            if self.pool is broken:
+                self.pool = self._start_pool()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def warm_up(self):
+        """Starts every worker process now, rather than on the first requests."""
+        # Submitted together, before any worker is idle, so the pool starts one process per task
+        for future in [self.pool.submit(_ping) for _ in range(self.workers)]:
+            future.result()
+
+    def reserve(self):
+        """Takes one of the max_pending slots; False when they're all in use."""
+        if not self._slots.acquire(blocking=False):
+            return False
+        with self._lock:
+            self.pending += 1
+        return True
+
+    def submit(self, task, request):
+        """Queues the task on a reserved slot and returns its future. The slot is released when the work ends."""
+        future = self.pool.submit(run_task, task, request)
+        # Even if the client stopped waiting for it
+        future.add_done_callback(lambda _: self.release())
+        return future
+
+    def release(self):
+        with self._lock:
+            self.pending -= 1
+        self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class InspectorHandler(BaseHTTPRequestHandler):
+    server_version = "inspector-image"
+
+    def _send(self, status, content_type, body, headers=()):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message, headers=()):
+        self._send(status, "application/json", {"error": message}, headers)
+
+    def do_GET(self):
+        endpoint = urlsplit(self.path).path.strip("/")
+        if endpoint == "health":
+            self._send(200, "application/json", {"status": "ok", "workers": self.server.workers,
+                                                 "pending": self.server.pending,
+                                                 "max_pending": self.server.max_pending})
+        elif endpoint == "metrics":
+            self._send(200, "text/plain; version=0.0.4", metrics.to_prometheus(metrics.snapshot()).encode('utf-8'))
+        else:
+            self._error(404, f"Unknown endpoint {self.path}")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        endpoint = url.path.strip("/")
+        if endpoint not in TASK_ENDPOINTS:
+            self._error(404, f"Unknown endpoint {url.path}; use one of: {', '.join(TASK_ENDPOINTS)}")
+            return
+        length = self.headers.get("Content-Length")
+        if length is None or not length.isdigit():
+            self._error(411, "Content-Length is required.")
+            return
+        if int(length) > MAX_BODY_BYTES:
+            self._error(413, f"The body is larger than {MAX_BODY_BYTES} bytes.")
+            return
+        # Reserved before the body is read, so -queue also bounds the memory held by uploads
+        if not self.server.reserve():
+            self.close_connection = True  # the unread body can't be followed by another request
+            self._error(503, "The service is busy; retry later.", [("Retry-After", str(RETRY_AFTER))])
+            return
+
+        with metrics.stage(f"service.{endpoint}"):
+            pool = self.server.pool
+            try:
+                try:
+                    body = self.rfile.read(int(length))
+                    task, request = parse_request(endpoint, url.query, self.headers.get("Content-Type", ""),
+                                                  body, self.server.roots)
+                    future = self.server.submit(task, request)
+                except BaseException:
+                    self.server.release()  # never submitted, so no callback will
+                    raise
+                content_type, result, worker_metrics = future.result(self.server.timeout)
+            except RequestError as e:
+                self._error(e.status, e.message)
+                return
+            except BrokenProcessPool:
+                self.server.replace_pool(pool)
+                self._error(500, "A worker process died; the worker pool was restarted.")
+                return
+            except FutureTimeout:
+                self._error(504, f"The analysis took longer than {self.server.timeout} seconds.")
+                return
+            except Exception as e:  # a crashed worker or an unexpected failure; keep serving
+                self._error(500, f"{type(e).__name__}: {e}")
+                return
+        metrics.merge(worker_metrics)
+        self._send(200, content_type, result)
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=None, max_pending=None, roots=()):
+    """Runs the service until interrupted. Stage timings are always recorded and served at /metrics."""
+    metrics.configure(enabled=True)
+    with InspectorServer((host, port), workers, max_pending, roots) as server:
+        server.warm_up()
+        print(f"Serving on http://{host}:{server.server_address[1]} with {server.workers} workers "
+              f"(at most {server.max_pending} requests at a time)", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -1,25 +1,98 @@
+import mmap
+import os
+from collections import namedtuple
 import piexif
 from PIL import Image, ExifTags
-import cv2
 #import numpy as np
-from skimage.metrics import structural_similarity as ssim
+from modules import metrics
+from modules.cache import cached
+from modules.metadata import read_metadata, has_exif
 
 
 
+ARMOR_BEGIN = b"-----BEGIN PGP "
+ARMOR_DASHES = b"-----"
+MAX_ARMOR_LABEL = 64  # e.g. "PUBLIC KEY BLOCK", "SIGNED MESSAGE", "MESSAGE, PART 1/2"
+SCAN_CHUNK_SIZE = 4 * 1024 * 1024  # bytes searched per find() call
+
+ArmoredBlock = namedtuple("ArmoredBlock", ["label", "start", "end"])
+
+
+def _find_chunked(buffer, marker, start, end, chunk_size=SCAN_CHUNK_SIZE):
+    """
+    Finds marker in buffer[start:end] one bounded window at a time. Windows overlap by
+    len(marker) - 1 bytes so a marker split across a chunk boundary is still found.
+    """
+    position = start
+    while position < end:
+        window_end = min(position + chunk_size + len(marker) - 1, end)
+        found = buffer.find(marker, position, window_end)
+        if found != -1:
+            return found
+        position += chunk_size
+    return -1
+
+def scan_pgp_blocks(buffer, chunk_size=SCAN_CHUNK_SIZE):
+    """
+    Yields an ArmoredBlock (label, start offset, end offset) for every ASCII-armored PGP
+    block in buffer: public and private keys, signatures, messages. buffer can be bytes or
+    an mmap; it is searched in place, so memory use doesn't grow with its size.
+    """
+    size = len(buffer)
+    position = 0
+    while True:
+        begin = _find_chunked(buffer, ARMOR_BEGIN, position, size, chunk_size)
+        if begin == -1:
+            return
+        label_start = begin + len(ARMOR_BEGIN)
+        label_end = buffer.find(ARMOR_DASHES, label_start, min(label_start + MAX_ARMOR_LABEL, size))
+        label = bytes(buffer[label_start:label_end]) if label_end != -1 else b""
+        if not label or not label.replace(b" ", b"").replace(b",", b"").replace(b"/", b"").isalnum():
+            position = label_start  # not a real armor header
+            continue
+
+        end_marker = b"-----END PGP " + label + ARMOR_DASHES
+        end = _find_chunked(buffer, end_marker, label_end, size, chunk_size)
+        if end == -1:
+            position = label_end  # unterminated block
+            continue
+        yield ArmoredBlock(label.decode('ascii'), begin, end + len(end_marker))
+        position = end + len(end_marker)
+
+def _map_file(ImageFile):
+    """Memory-maps an open file read-only. Empty files can't be mapped, so they yield b""."""
+    if os.fstat(ImageFile.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(ImageFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+def find_pgp_key(content):
+    for block in scan_pgp_blocks(content):
+        if block.label == "PUBLIC KEY BLOCK":
+            return bytes(content[block.start:block.end]).decode('utf-8', errors='ignore')
+    return "No PGP key found"
+
+@cached("steg")
 def extract_pgp_key(image_path):
     with open(image_path, 'rb') as ImageFile:
-        content = ImageFile.read()
-        start_marker = b"-----BEGIN PGP PUBLIC KEY BLOCK-----"
-        end_marker = b"-----END PGP PUBLIC KEY BLOCK-----"
-        start_offset = content.find(start_marker)
-        end_offset = content.find(end_marker, start_offset)
-        
-        if start_offset != -1 and end_offset != -1:
-            # Add the length of the end_marker to include it in the extracted content
-            pgp_key_block = content[start_offset:end_offset+len(end_marker)].decode('utf-8', errors='ignore')
-            return pgp_key_block
-        else:
-            return "No PGP key found"
+        content = _map_file(ImageFile)
+        metrics.count("bytes_read", len(content))
+        try:
+            with metrics.stage("steg.extract"):
+                return find_pgp_key(content)
+        finally:
+            if isinstance(content, mmap.mmap):
+                content.close()
+
+@cached("allpgp")
+def extract_pgp_blocks(image_path):
+    """Returns every armored PGP block in the file as a list of ArmoredBlock offsets."""
+    with open(image_path, 'rb') as ImageFile:
+        content = _map_file(ImageFile)
+        try:
+            return list(scan_pgp_blocks(content))
+        finally:
+            if isinstance(content, mmap.mmap):
+                content.close()
         
 
 def get_decimal_from_dms(dms, ref):
@@ -54,62 +127,96 @@ def decimal_to_dms(decimal_degree, direction):
 
     return f"{degrees}° {minutes}' {seconds:.2f}\" {cardinal}"
 
-def GPSInfo_to_coordinates(gps_info):
+def GPSInfo_to_decimal(gps_info):
+    """Signed decimal degrees (latitude, longitude) from a piexif GPS dict."""
     lat_ref = gps_info[piexif.GPSIFD.GPSLatitudeRef].decode('utf-8')
     lon_ref = gps_info[piexif.GPSIFD.GPSLongitudeRef].decode('utf-8')
 
     lat = gps_info[piexif.GPSIFD.GPSLatitude]
     lon = gps_info[piexif.GPSIFD.GPSLongitude]
 
-    lat_decimal = get_decimal_from_dms(lat, lat_ref)
-    lon_decimal = get_decimal_from_dms(lon, lon_ref)
-    
+    return get_decimal_from_dms(lat, lat_ref), get_decimal_from_dms(lon, lon_ref)
+
+def GPSInfo_to_coordinates(gps_info, decimal=False):
+    lat_decimal, lon_decimal = GPSInfo_to_decimal(gps_info)
+    if decimal:
+        return lat_decimal, lon_decimal
+
     # Convert decimal degrees to human-readable format (DMS with cardinal direction)
     lat_readable = decimal_to_dms(lat_decimal, 'Latitude')
     lon_readable = decimal_to_dms(lon_decimal, 'Longitude')
 
     return lat_readable,lon_readable
 
-def get_image_location(image_path):
+def location_from_exif(exif_bytes, decimal=False):
+    """
+    Returns the DMS coordinates from raw EXIF bytes, or (None, reason) when there are none.
+    With decimal=True the coordinates are signed decimal degrees instead.
+    """
     try:
-        img = Image.open(image_path)
-        exif_dict = piexif.load(img.info.get('exif', {}))  # Use .get to avoid KeyError
-
-        if not exif_dict:
+        if not exif_bytes:
             return None, "No EXIF data found"
-        
+        exif_dict = piexif.load(exif_bytes)
+
         gps_info = exif_dict.get('GPS')
         if gps_info:
-            coordinates = GPSInfo_to_coordinates(gps_info)
+            coordinates = GPSInfo_to_coordinates(gps_info, decimal)
             #print(f'GPS coordinates 1111: {coordinates}')
             return coordinates
         else:
             return None, "No GPS data found"
     except Exception as e:
         return None, str(e)  # Return the error message
-    
-def get_image_exif(image_path):
-    img = Image.open(image_path)
-    exif_data = img._getexif()
 
-    if not exif_data:
-        return "No EXIF data found."
+def location_from_metadata(metadata, decimal=False):
+    """Same as location_from_exif, for the output of modules.metadata."""
+    if not has_exif(metadata):
+        return None, "No EXIF data found"
+    gps = metadata['gps']
+    if not gps:
+        return None, "No GPS data found"
+    try:
+        # GPSInfo_to_coordinates takes piexif's layout: numeric keys and byte-string references
+        gps_info = {getattr(piexif.GPSIFD, name): gps[name] for name in
+                    ('GPSLatitude', 'GPSLongitude', 'GPSLatitudeRef', 'GPSLongitudeRef')}
+        gps_info[piexif.GPSIFD.GPSLatitudeRef] = gps_info[piexif.GPSIFD.GPSLatitudeRef].encode('latin-1')
+        gps_info[piexif.GPSIFD.GPSLongitudeRef] = gps_info[piexif.GPSIFD.GPSLongitudeRef].encode('latin-1')
+        return GPSInfo_to_coordinates(gps_info, decimal)
+    except Exception as e:
+        return None, str(e)  # Return the error message
 
-    tags = {ExifTags.TAGS[k]: v for k, v in exif_data.items() if k in ExifTags.TAGS}
+# Not cached: hashing the whole file for the key would cost far more than parsing its header
+def get_image_location(image_path, decimal=False):
+    """
+    Returns the (latitude, longitude) where the photo was taken, as DMS strings or, with
+    decimal=True, as signed decimal degrees. Returns (None, reason) when there are none.
+    """
+    # Parse just the EXIF segment at the head of the file; fall back to PIL for other formats
+    with metrics.stage("map.extract"):
+        try:
+            metadata = read_metadata(image_path)
+            if metadata is not None:
+                return location_from_metadata(metadata, decimal)
+            img = Image.open(image_path)
+        except Exception as e:
+            return None, str(e)  # Return the error message
+        return location_from_exif(img.info.get('exif'), decimal)
 
-    desired_tags = [
-        'DateTimeOriginal', 'Make', 'Model', 'LensModel', 'GPSAltitude',
-        'Software', 'RunTimeSincePowerUp', 'FocalLength', 'FNumber', 'ExposureTime',
-        'ISOSpeedRatings', 'ExposureBiasValue', 'ExposureProgram', 'MeteringMode',
-        'Flash', 'FocalLengthIn35mmFilm', 'SceneCaptureType', 'Contrast', 'Saturation',
-        'Sharpness', 'SubjectDistanceRange', 'ExposureMode', 'WhiteBalance', 'GainControl',
-        'LightSource', 'SensingMethod', 'ExposureIndex', 'FileSource', 'SceneType',
-        'CustomRendered', 'DigitalZoomRatio'
-    ]
+DESIRED_EXIF_TAGS = [
+    'DateTimeOriginal', 'Make', 'Model', 'LensModel', 'GPSAltitude',
+    'Software', 'RunTimeSincePowerUp', 'FocalLength', 'FNumber', 'ExposureTime',
+    'ISOSpeedRatings', 'ExposureBiasValue', 'ExposureProgram', 'MeteringMode',
+    'Flash', 'FocalLengthIn35mmFilm', 'SceneCaptureType', 'Contrast', 'Saturation',
+    'Sharpness', 'SubjectDistanceRange', 'ExposureMode', 'WhiteBalance', 'GainControl',
+    'LightSource', 'SensingMethod', 'ExposureIndex', 'FileSource', 'SceneType',
+    'CustomRendered', 'DigitalZoomRatio'
+]
 
+def format_exif_tags(tags):
+    """Formats the interesting tags of a {tag name: value} dict as text."""
     found_data = False  # Flag to track if any data is found
     exif_str = ""
-    for tag in desired_tags:
+    for tag in DESIRED_EXIF_TAGS:
         if tag in tags:
             exif_str += f"{tag}: {tags[tag]}\n"
             found_data = True
@@ -121,31 +228,73 @@ def get_image_exif(image_path):
 
     return exif_str
 
-def compare_images(image_path_1, image_path_2):
-    # Load the two images
-    image1 = cv2.imread(image_path_1)
-    image2 = cv2.imread(image_path_2)
+def exif_summary(img):
+    """Formats the interesting EXIF tags of an opened image as text."""
+    exif_data = img._getexif() if hasattr(img, '_getexif') else None
+
+    if not exif_data:
+        return "No EXIF data found."
 
-    # Convert the images to grayscale
-    gray1 = cv2.cvtColor(image1, cv2.COLOR_BGR2GRAY)
-    gray2 = cv2.cvtColor(image2, cv2.COLOR_BGR2GRAY)
+    tags = {ExifTags.TAGS[k]: v for k, v in exif_data.items() if k in ExifTags.TAGS}
+    return format_exif_tags(tags)
+
+def metadata_summary(metadata):
+    """Same as exif_summary, for the output of modules.metadata."""
+    if not has_exif(metadata):
+        return "No EXIF data found."
+    return format_exif_tags({**metadata['ifd0'], **metadata['exif']})
+
+# Not cached, like get_image_location
+@metrics.timed("exif.extract")
+def get_image_exif(image_path):
+    metadata = read_metadata(image_path)
+    if metadata is not None:
+        return metadata_summary(metadata)
+    return exif_summary(Image.open(image_path))
+
+# Not cached: the result image is as large as the input, and would soon evict every other result
+def compare_images(image_path_1, image_path_2, progress=None):
+    """
+    SSIM of two images of the same size; returns (the first image with the differences outlined,
+    score). progress(fraction) is called between steps and may raise to cancel.
+    """
+    # OpenCV and scikit-image take hundreds of milliseconds to import, so only load them here
+    import cv2
+    from skimage.metrics import structural_similarity as ssim
+
+    with metrics.stage("compare.decode"):
+        # Load the two images
+        image1 = cv2.imread(image_path_1)
+        image2 = cv2.imread(image_path_2)
+
+        # Convert the images to grayscale
+        gray1 = cv2.cvtColor(image1, cv2.COLOR_BGR2GRAY)
+        gray2 = cv2.cvtColor(image2, cv2.COLOR_BGR2GRAY)
+    if metrics.is_enabled():
+        metrics.count("bytes_read", os.path.getsize(image_path_1) + os.path.getsize(image_path_2))
+    if progress:
+        progress(0.3)
 
     # Compute the Structural Similarity Index (SSI) between the two images
-    score, diff = ssim(gray1, gray2, full=True)
+    with metrics.stage("compare.ssim"):
+        score, diff = ssim(gray1, gray2, full=True)
     print("Image similarity:", score)
+    if progress:
+        progress(0.8)
 
-    # Normalize the difference image for displaying
-    diff = (diff * 255).astype("uint8")
-    
-    # Threshold the diff image to get the contours of the differences
-    thresh = cv2.threshold(diff, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
-    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    with metrics.stage("compare.postprocess"):
+        # Normalize the difference image for displaying
+        diff = (diff * 255).astype("uint8")
 
-    # Draw the contours on the first image
-    result = image1.copy()
-    cv2.drawContours(result, contours, -1, (0,0,255), 2)
+        # Threshold the diff image to get the contours of the differences
+        thresh = cv2.threshold(diff, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        # Draw the contours on the first image
+        result = image1.copy()
+        cv2.drawContours(result, contours, -1, (0,0,255), 2)
+
+        # Convert the OpenCV result image to a PIL.Image object for Tkinter
+        result_pil = Image.fromarray(cv2.cvtColor(result, cv2.COLOR_BGR2RGB))
 
-    # Convert the OpenCV result image to a PIL.Image object for Tkinter
-    result_pil = Image.fromarray(cv2.cvtColor(result, cv2.COLOR_BGR2RGB))
-    
     return result_pil, score
\ No newline at end of file
@@ -0,0 +1,225 @@
+import math
+import numpy as np
+from PIL import Image
+from modules.cache import cached
+from modules.decode_encode import normalize_mode
+
+
+CHANNEL_NAMES = ("red", "green", "blue")
+DEFAULT_MAX_PIXELS = 4_000_000  # larger images are sub-sampled by rows
+CHI_SQUARE_STEPS = 20  # blocks of the image tested separately by the chi-square attack
+CHI_SQUARE_CLEAN_P = 0.01  # p-value below which a sample is taken to carry no embedding
+DETECTION_THRESHOLD = 0.05  # estimated embedding rate above which an image is flagged
+SATURATED_RATE = 0.9  # chi-square rate from which RS and SPA can't be trusted, see detect_image
+RS_MASK = np.array([0, 1, 1, 0], dtype=np.int16)
+# Low-frequency DCT coefficients of the 8x8 luma blocks, which JPEG quantizes with small steps
+JPEG_COEFFICIENTS = ((0, 1), (1, 0), (1, 1), (0, 2), (2, 0), (1, 2), (2, 1))
+JPEG_MAX_STEP = 16
+JPEG_MIN_SAMPLES = 100  # coefficients needed to test a step
+JPEG_PEAK_RATIO = 2.0  # coefficients near multiples of a step vs. between them, about 1 for natural images
+JPEG_MIN_PEAKS = 2  # coefficient positions that must show a step
+
+
+def dct_matrix(size=8):
+    """The orthonormal DCT-II matrix, as used by JPEG: M @ X @ M.T is the 2-D DCT of X."""
+    k, n = np.meshgrid(np.arange(size), np.arange(size), indexing='ij')
+    matrix = np.sqrt(2 / size) * np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+DCT_MATRIX = dct_matrix()
+
+
+def _channels(img, max_pixels=DEFAULT_MAX_PIXELS):
+    """
+    The R, G and B channels as 2-D int16 arrays. Images over max_pixels keep only every n-th
+    row, which preserves the horizontal neighbours the pair statistics need.
+    """
+    img = normalize_mode(img)
+    step = max(1, math.ceil(img.width * img.height / max_pixels)) if max_pixels else 1
+    pixels = np.asarray(img)[::step, :, :3]
+    return [pixels[..., channel].astype(np.int16) for channel in range(3)]
+
+def _chi_square_p(chi_square, degrees):
+    """Chi-square survival function via the Wilson-Hilferty approximation, to avoid a SciPy dependency."""
+    if degrees <= 0:
+        return 0.0
+    z = ((chi_square / degrees) ** (1 / 3) - (1 - 2 / (9 * degrees))) / math.sqrt(2 / (9 * degrees))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+def _chi_square(histograms):
+    """
+    P-value of each histogram row against (2k, 2k + 1) pairs that all split in the same ratio.
+    LSB replacement with message bits that are 1 with probability b splits every pair b : 1 - b,
+    and b is only 0.5 for random-looking data: text leaves the top bit of each byte 0.
+    """
+    even, odd = histograms[:, 0::2].astype(np.float64), histograms[:, 1::2]
+    total = even + odd
+    ratio = even.sum(axis=1, keepdims=True) / np.maximum(total.sum(axis=1, keepdims=True), 1)
+    variance = total * ratio * (1 - ratio)  # of a binomial even count, given the pair's total
+    valid = (total > 8) & (variance > 0)  # sparse pairs make the statistic meaningless
+    statistic = np.where(valid, (even - total * ratio) ** 2 / np.where(valid, variance, 1), 0).sum(axis=1)
+    # One degree of freedom is spent on estimating the ratio
+    return [_chi_square_p(chi_square, count - 2) for chi_square, count in zip(statistic, valid.sum(axis=1))]
+
+def chi_square_attack(values, steps=CHI_SQUARE_STEPS):
+    """
+    Westfeld and Pfitzmann's chi-square attack on the pairs of values (2k, 2k + 1), which
+    LSB replacement equalizes. Returns (p-value over all values, estimated rate). The test
+    is repeated on growing samples from the start of the scan order, and the rate is the
+    fraction of them up to the last with a p-value of at least CHI_SQUARE_CLEAN_P, i.e. the
+    length of a sequentially embedded message. Once the sample reaches past the message,
+    the clean values make the p-value collapse and it stays low.
+    """
+    values = values.reshape(-1)
+    blocks = np.minimum(np.arange(len(values)) * steps // max(len(values), 1), steps - 1)
+    # One bincount gives the histogram of every block at once, and their running sums the samples
+    histograms = np.bincount(blocks * 256 + values, minlength=steps * 256).reshape(steps, 256)
+    p_values = _chi_square(np.cumsum(histograms, axis=0))
+    embedded = max((sample + 1 for sample, p_value in enumerate(p_values) if p_value >= CHI_SQUARE_CLEAN_P),
+                   default=0)
+    return p_values[-1], embedded / steps
+
+def _flip(values, mask):
+    """Applies F1 (flip the LSB) where mask is 1 and F-1 (flip shifted by one) where it is -1."""
+    lsb = values & 1
+    positive = values + 1 - 2 * lsb
+    negative = values - 1 + 2 * lsb
+    return np.where(mask == 1, positive, np.where(mask == -1, negative, values))
+
+def _regular_singular(groups, mask):
+    """Fractions of regular and singular groups under the flipping mask."""
+    smoothness = np.abs(np.diff(groups, axis=1)).sum(axis=1)
+    flipped = np.abs(np.diff(_flip(groups, mask), axis=1)).sum(axis=1)
+    return np.mean(flipped > smoothness), np.mean(flipped < smoothness)
+
+def rs_analysis(values):
+    """Fridrich's RS analysis on groups of 4 horizontal neighbours. Returns the estimated embedding rate."""
+    width = values.shape[1] - values.shape[1] % 4
+    groups = values[:, :width].reshape(-1, 4)
+    if not len(groups):
+        return 0.0
+    r_m, s_m = _regular_singular(groups, RS_MASK)
+    r_neg, s_neg = _regular_singular(groups, -RS_MASK)
+    flipped = groups ^ 1
+    r_m1, s_m1 = _regular_singular(flipped, RS_MASK)
+    r_neg1, s_neg1 = _regular_singular(flipped, -RS_MASK)
+
+    d0, d1 = r_m - s_m, r_m1 - s_m1
+    n0, n1 = r_neg - s_neg, r_neg1 - s_neg1
+    a, b, c = 2 * (d1 + d0), n0 - n1 - d1 - 3 * d0, d0 - n0
+    if abs(a) < 1e-12:
+        z = -c / b if b else 0.0
+    else:
+        discriminant = b * b - 4 * a * c
+        if discriminant < 0:
+            return 0.0
+        roots = ((-b + math.sqrt(discriminant)) / (2 * a), (-b - math.sqrt(discriminant)) / (2 * a))
+        z = min(roots, key=abs)
+    return float(min(max(z / (z - 0.5), 0.0), 1.0)) if z != 0.5 else 1.0
+
+def sample_pair_analysis(values):
+    """Dumitrescu, Wu and Wang's sample pair analysis on horizontal neighbours. Returns the estimated embedding rate."""
+    left, right = values[:, :-1].reshape(-1), values[:, 1:].reshape(-1)
+    size = len(left)
+    if not size:
+        return 0.0
+    right_even = (right & 1) == 0
+    x = np.count_nonzero(np.where(right_even, left < right, left > right))
+    y = np.count_nonzero(np.where(right_even, left > right, left < right))
+    k = np.count_nonzero((left >> 1) == (right >> 1))
+    if k == 0:
+        return 0.0
+    a, b, c = 2 * k, 2 * (2 * x - size), y - x
+    discriminant = b * b - 4 * a * c
+    if discriminant < 0:
+        return 0.0
+    beta = min((-b + math.sqrt(discriminant)) / (2 * a), (-b - math.sqrt(discriminant)) / (2 * a))
+    return float(min(max(2 * beta, 0.0), 1.0))
+
+def _quantization_step(coefficients):
+    """
+    The step that the coefficients cluster on, or None. For each step, values within a quarter
+    step of a non-zero multiple are compared with those in the other half; smooth distributions
+    give a ratio near 1 at any step, rounding to multiples of a step gives a far higher one.
+    """
+    coefficients = np.abs(coefficients)
+    best_step, best_ratio = None, JPEG_PEAK_RATIO
+    for step in range(2, JPEG_MAX_STEP + 1):
+        multiples = coefficients / step
+        # Whole periods centered on 1, 2, ..., skipping the peak at 0 that every image has
+        multiples = multiples[(multiples >= 0.5) & (multiples < 8.5)]
+        if len(multiples) < JPEG_MIN_SAMPLES:
+            break
+        near = np.count_nonzero(np.abs(multiples - np.round(multiples)) < 0.25)
+        ratio = near / max(len(multiples) - near, 1)
+        if ratio > best_ratio:
+            best_step, best_ratio = step, ratio
+    return best_step
+
+def jpeg_history(img, max_pixels=DEFAULT_MAX_PIXELS):
+    """
+    Whether a PIL image was decoded from a JPEG, e.g. a photo saved again as PNG: the DCT
+    coefficients of its 8x8 luma blocks are still close to multiples of the quantization
+    steps. Resizing or cropping off the block grid erases the trace.
+    """
+    pixels = np.asarray(normalize_mode(img))
+    height, width = pixels.shape[0] - pixels.shape[0] % 8, pixels.shape[1] - pixels.shape[1] % 8
+    if not height or not width:
+        return False
+    step = max(1, math.ceil(width * height / max_pixels)) if max_pixels else 1
+    rows = pixels[:height, :width, :3].reshape(height // 8, 8, width // 8, 8, 3)[::step]
+    luma = rows.astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32) - 128
+    blocks = luma.transpose(0, 2, 1, 3).reshape(-1, 8, 8)
+    coefficients = DCT_MATRIX @ blocks @ DCT_MATRIX.T
+    peaks = sum(_quantization_step(coefficients[:, u, v]) is not None for u, v in JPEG_COEFFICIENTS)
+    return peaks >= JPEG_MIN_PEAKS
+
+def detect_image(img, max_pixels=DEFAULT_MAX_PIXELS):
+    """
+    Screens a PIL image for LSB embedding. Returns {"channels": {name: {"chi_square_p",
+    "chi_square_rate", "rs", "spa"}}, "score", "lossy", "jpeg_history", "suspicious"}, where
+    the rates estimate the fraction of values carrying message bits. score is the highest
+    estimate over the channels, the RS/SPA average, or the chi-square rate where that is at
+    least SATURATED_RATE, since RS and SPA break down when nearly every value carries message
+    bits. JPEG images are never flagged: a pixel LSB payload can't survive lossy compression.
+    Lossless images decoded from a JPEG are flagged on the chi-square rate alone, the lowest
+    over the channels, because the JPEG artifacts skew the RS and SPA estimates as much as
+    embedding does.
+    """
+    lossy = img.format == 'JPEG'
+    history = not lossy and jpeg_history(img, max_pixels)
+    channels = {}
+    for name, values in zip(CHANNEL_NAMES, _channels(img, max_pixels)):
+        p_value, chi_rate = chi_square_attack(values)
+        channels[name] = {
+            "chi_square_p": p_value,
+            "chi_square_rate": chi_rate,
+            "rs": rs_analysis(values),
+            "spa": sample_pair_analysis(values),
+        }
+    score = max(channel["chi_square_rate"] if channel["chi_square_rate"] >= SATURATED_RATE
+                else (channel["rs"] + channel["spa"]) / 2 for channel in channels.values())
+    evidence = min(channel["chi_square_rate"] for channel in channels.values()) if history else score
+    return {"channels": channels, "score": score, "lossy": lossy, "jpeg_history": history,
+            "suspicious": not lossy and evidence > DETECTION_THRESHOLD}
+
+@cached("detect")
+def detect_file(image_path, max_pixels=DEFAULT_MAX_PIXELS):
+    with Image.open(image_path) as img:
+        return detect_image(img, max_pixels)
+
+def describe_detection(result):
+    """Formats a detect_image result as text."""
+    if result["lossy"]:
+        verdict = "lossy format, LSB embedding can't survive"
+    elif result["jpeg_history"] and not result["suspicious"] and result["score"] > DETECTION_THRESHOLD:
+        verdict = "inconclusive, JPEG artifacts skew the RS and SPA estimates"
+    else:
+        verdict = "possible LSB embedding" if result["suspicious"] else "no LSB embedding detected"
+    lines = [f"Steganalysis score: {result['score']:.3f} ({verdict})"]
+    for name, channel in result["channels"].items():
+        lines.append(f"  {name:<5} chi-square p={channel['chi_square_p']:.3f} "
+                     f"(sequential rate {channel['chi_square_rate']:.2f}), "
+                     f"RS rate {channel['rs']:.3f}, SPA rate {channel['spa']:.3f}")
+    return "\n".join(lines)
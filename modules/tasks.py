@@ -0,0 +1,109 @@
+import queue
+import threading
+
+
+class TaskCancelled(Exception):
+    """Raised inside a task's progress callback once the task has been cancelled."""
+
+
+class Task:
+    """
+    One queued job. The function runs on the worker thread; its progress callback records
+    the fraction done and raises TaskCancelled once cancel() has been called, which unwinds
+    the pixel loop that reported it.
+    """
+
+    def __init__(self, description, func, args, kwargs, on_done, on_error):
+        self.description = description
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.on_done = on_done
+        self.on_error = on_error
+        self.fraction = None  # None until the task reports progress
+        self._cancelled = threading.Event()
+
+    def progress(self, fraction):
+        if self._cancelled.is_set():
+            raise TaskCancelled(self.description)
+        self.fraction = fraction
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+
+class TaskRunner:
+    """
+    Runs tasks one at a time on a background thread, in the order they were submitted.
+    Callbacks are never called on the worker thread: the UI thread calls poll() (e.g. from
+    Tk's after()) and the callbacks of finished tasks run there.
+    """
+
+    def __init__(self):
+        self._pending = queue.Queue()
+        self._finished = queue.Queue()
+        self._lock = threading.Lock()
+        self._queued = []
+        self.current = None
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def submit(self, description, func, *args, on_done=None, on_error=None, **kwargs):
+        """Queues func(*args, progress=task.progress, **kwargs) and returns the Task."""
+        task = Task(description, func, args, kwargs, on_done, on_error)
+        with self._lock:
+            self._queued.append(task)
+        self._pending.put(task)
+        return task
+
+    def _work(self):
+        while True:
+            task = self._pending.get()
+            with self._lock:
+                self._queued.remove(task)
+                self.current = task
+            try:
+                if task.cancelled:
+                    raise TaskCancelled(task.description)
+                result, error = task.func(*task.args, progress=task.progress, **task.kwargs), None
+            except Exception as e:  # handed to the UI thread, never lost on the worker
+                result, error = None, e
+            with self._lock:
+                self.current = None
+            self._finished.put((task, result, error))
+
+    @property
+    def queued(self):
+        """Tasks waiting to run, oldest first."""
+        with self._lock:
+            return list(self._queued)
+
+    def cancel_current(self):
+        with self._lock:
+            if self.current is not None:
+                self.current.cancel()
+
+    def cancel_all(self):
+        with self._lock:
+            for task in [self.current, *self._queued]:
+                if task is not None:
+                    task.cancel()
+
+    def poll(self):
+        """Runs the callbacks of tasks that finished since the last call. Call from the UI thread."""
+        while True:
+            try:
+                task, result, error = self._finished.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(error, TaskCancelled):
+                continue
+            if error is not None:
+                if task.on_error:
+                    task.on_error(error)
+            elif task.on_done:
+                task.on_done(result)
@@ -0,0 +1,374 @@
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import json
+import os
+import select
+import sqlite3
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from modules import metrics
+from modules.analysis import ImageAnalysis
+from modules.batch import IMAGE_EXTENSIONS, collect_images
+from modules.cache import DEFAULT_CACHE_PATH
+
+
+DEFAULT_MANIFEST_PATH = os.path.join(os.path.dirname(DEFAULT_CACHE_PATH), "manifest.sqlite")
+DEFAULT_INTERVAL = 5.0  # seconds between stat scans when inotify isn't used
+DEBOUNCE_SECONDS = 0.5  # inotify events are gathered this long, so a burst of copies is one pass
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT = struct.Struct("iIII")  # watch descriptor, mask, cookie, name length
+READ_SIZE = 64 * 1024
+
+
+class Manifest:
+    """
+    The last analysis of every image, stored in SQLite: its size, modification time and
+    SHA-256, the operations that ran and their results. Tells which files are new or have
+    changed since, without reading the unchanged ones.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_MANIFEST_PATH
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, "
+                                "mtime INTEGER, digest TEXT, operations TEXT, record TEXT)")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def entries(self):
+        """{path: (size, mtime, digest, operations)} for every file in the manifest."""
+        return {path: (size, mtime, digest, operations) for path, size, mtime, digest, operations in
+                self.connection.execute("SELECT path, size, mtime, digest, operations FROM files")}
+
+    def result(self, path):
+        """The last record emitted for path, or None."""
+        row = self.connection.execute("SELECT record FROM files WHERE path = ?", (path,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def update(self, path, size, mtime, digest, operations, record=None):
+        """Stores a file's new state; without a record, the previous results are kept (the content didn't change)."""
+        with self.connection:
+            if record is None:
+                self.connection.execute("UPDATE files SET size = ?, mtime = ? WHERE path = ?", (size, mtime, path))
+            else:
+                self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                        (path, size, mtime, digest, operations, json.dumps(record, default=str)))
+
+    def remove(self, paths):
+        with self.connection:
+            self.connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in paths])
+
+
+def _operations_key(operations):
+    return ",".join(sorted(operations))
+
+def _process(image_path, operations, known_digest):
+    """
+    Hashes and analyzes one image in a worker process. Returns (record, size, mtime, digest);
+    the record is None when the content is known_digest, i.e. the file was only touched.
+    """
+    if metrics.is_enabled():
+        metrics.reset()  # a forked worker starts with a copy of the parent's totals
+    # Stat before reading: if the file changes meanwhile, the next scan sees a newer mtime
+    try:
+        stat = os.stat(image_path)
+    except OSError as e:
+        return {"path": image_path, "errors": {operation: str(e) for operation in operations}}, None, None, None
+    try:
+        with ImageAnalysis(image_path) as analysis:
+            digest = analysis.digest
+            if digest == known_digest:
+                return None, stat.st_size, stat.st_mtime_ns, digest
+            record = analysis.run(operations)
+        record["sha256"] = digest
+    except Exception as e:  # e.g. the file can't be read at all
+        digest, record = None, {"path": image_path, "errors": {operation: str(e) for operation in operations}}
+    if metrics.is_enabled():
+        record["metrics"] = metrics.collect()
+    return record, stat.st_size, stat.st_mtime_ns, digest
+
+def _glob_match(parts, pattern_parts):
+    """Whether path components match glob pattern components, with ** spanning any number of them."""
+    if not pattern_parts:
+        return not parts
+    if pattern_parts[0] == "**":
+        return any(_glob_match(parts[index:], pattern_parts[1:]) for index in range(len(parts) + 1))
+    return (bool(parts) and fnmatch.fnmatchcase(parts[0], pattern_parts[0])
+            and _glob_match(parts[1:], pattern_parts[1:]))
+
+def _scope(roots):
+    """
+    Whether a path lies under one of the roots, the directories and glob patterns a scan
+    covered. Directories that don't exist, such as an unmounted share, cover nothing.
+    """
+    directories = tuple(os.path.join(os.path.abspath(root), "") for root in roots if os.path.isdir(root))
+    patterns = [os.path.abspath(root).split(os.sep) for root in roots if glob.has_magic(root)]
+    return lambda path: (path.startswith(directories)
+                         or any(_glob_match(path.split(os.sep), pattern) for pattern in patterns))
+
+def find_changes(image_paths, entries, operations, roots=()):
+    """
+    Compares the files with the manifest entries by size and modification time only.
+    Returns [(path, event, known digest)] for files that are "added", "modified", or to be
+    "reanalyzed" because they were analyzed with other operations, and the paths of
+    entries whose files are gone. Only entries among image_paths or under the roots (the
+    directories and glob patterns the paths were collected from) can be gone: the manifest
+    is shared with scans of other sources.
+    """
+    key = _operations_key(operations)
+    changes, listed, seen = [], set(), set()
+    for path in image_paths:
+        path = os.path.abspath(path)
+        listed.add(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # reported as removed below if it was known
+        seen.add(path)
+        known = entries.get(path)
+        if known is None:
+            changes.append((path, "added", None))
+        elif known[3] != key:
+            changes.append((path, "reanalyzed", None))
+        elif known[:2] != (stat.st_size, stat.st_mtime_ns):
+            changes.append((path, "modified", known[2]))
+    in_scope = _scope(roots)
+    removed = [path for path in entries
+               if path not in seen and (path in listed or in_scope(path)) and not os.path.exists(path)]
+    return changes, removed
+
+
+class IncrementalRun:
+    """
+    Analyzes only the new and changed images of a set, keeping the manifest up to date, and
+    appends one JSON Lines record per added, modified or removed image to output. Records
+    carry an "event" field; files whose content turns out unchanged (touched or copied
+    over with the same bytes) emit nothing.
+    """
+
+    def __init__(self, manifest, operations, executor, output=sys.stdout):
+        self.manifest = manifest
+        self.operations = operations
+        self.executor = executor
+        self.output = output
+        self.failed = 0
+
+    def _emit(self, record):
+        self.output.write(json.dumps(record, default=str) + "\n")
+        self.output.flush()  # readers tail the stream
+
+    def process(self, changes, removed=()):
+        """Analyzes the changes and records the removals. Returns the number of records emitted."""
+        emitted = 0
+        for path in removed:
+            self._emit({"path": path, "event": "removed"})
+            emitted += 1
+        self.manifest.remove(removed)
+
+        key = _operations_key(self.operations)
+        futures = {self.executor.submit(_process, path, self.operations, known_digest): (path, event)
+                   for path, event, known_digest in changes}
+        for future in as_completed(futures):
+            path, event = futures[future]
+            try:
+                record, size, mtime, digest = future.result()
+            except Exception as e:  # the worker itself died
+                record, size, mtime, digest = {"path": path, "errors": {"worker": str(e)}}, None, None, None
+            if record is None:
+                self.manifest.update(path, size, mtime, digest, key)
+                continue
+            if "metrics" in record:
+                metrics.merge(record.pop("metrics"))
+            record = {"path": path, "event": event, **{k: v for k, v in record.items() if k != "path"}}
+            if "errors" in record:
+                self.failed += 1
+            if size is not None:
+                # Failures are stored too, so they're retried when the file changes rather than on every pass
+                self.manifest.update(path, size, mtime, digest, key, record)
+            self._emit(record)
+            emitted += 1
+        return emitted
+
+    def scan(self, image_paths, roots=()):
+        """
+        A full pass: stats every file and processes what changed, including files gone from
+        under the roots (see find_changes). Returns the number of records emitted.
+        """
+        changes, removed = find_changes(image_paths, self.manifest.entries(), self.operations, roots)
+        return self.process(changes, removed)
+
+
+class Inotify:
+    """
+    Linux inotify through ctypes. Watches directory trees and reports the image files
+    written, moved in, moved out or deleted under them.
+    """
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories = {}  # watch descriptor: directory
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_tree(self, directory):
+        """Watches directory and everything below it. Raises OSError, e.g. past fs.inotify.max_user_watches."""
+        # Absolute, like the manifest keys, so event paths can be looked up there
+        for root, _, _ in os.walk(os.path.abspath(directory)):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                raise OSError(error, f"Can't watch {root}: {os.strerror(error)}")
+            self._directories[wd] = root
+
+    def _read_events(self):
+        data = b""
+        while True:
+            try:
+                chunk = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return data
+            if not chunk:
+                return data
+            data += chunk
+
+    def wait(self, timeout=None):
+        """
+        Waits for events, then gathers more for DEBOUNCE_SECONDS. Returns (changed paths,
+        removed paths, rescan); rescan is True when the kernel dropped events or a
+        directory was moved or deleted, and only a full scan can tell what happened.
+        """
+        changed, removed, rescan = set(), set(), False
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changed, removed, rescan
+        deadline = time.monotonic() + DEBOUNCE_SECONDS
+        while True:
+            data = self._read_events()
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+                offset += EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    rescan = True
+                    continue
+                directory = self._directories.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_DELETE_SELF:
+                    del self._directories[wd]
+                    continue
+                path = os.path.abspath(os.path.join(directory, os.fsdecode(name)))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        try:
+                            self.add_tree(path)
+                        except OSError:
+                            rescan = True
+                        # Files may have landed before the watch was added
+                        changed.update(collect_images([path]))
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        rescan = True
+                elif path.lower().endswith(IMAGE_EXTENSIONS):
+                    if mask & (IN_DELETE | IN_MOVED_FROM):
+                        removed.add(path)
+                        changed.discard(path)
+                    elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        changed.add(path)
+                        removed.discard(path)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                return changed, removed, rescan
+
+
+def inotify_available():
+    return sys.platform.startswith("linux") and hasattr(ctypes.CDLL(ctypes.util.find_library("c")), "inotify_init1")
+
+def _start_inotify(sources):
+    """An Inotify watching the source directories, or None to fall back to stat scans."""
+    if not sources or not all(os.path.isdir(source) for source in sources) or not inotify_available():
+        return None
+    try:
+        inotify = Inotify()
+    except OSError as e:
+        print(f"inotify unavailable ({e}); scanning every interval instead", file=sys.stderr)
+        return None
+    try:
+        for source in sources:
+            inotify.add_tree(source)
+    except OSError as e:
+        inotify.close()
+        print(f"{e}; scanning every interval instead", file=sys.stderr)
+        return None
+    return inotify
+
+def watch_images(sources, operations, manifest, output=sys.stdout, file_list=None, workers=None,
+                 interval=DEFAULT_INTERVAL, once=False, poll=False):
+    """
+    Analyzes the new and changed images among the sources (as for collect_images), then,
+    unless once is set, keeps watching them until interrupted. Directory sources are
+    watched with inotify where available; otherwise, with poll, or for glob patterns and
+    file lists, they're stat-scanned every interval seconds. Returns the number of images
+    that had an error.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        run = IncrementalRun(manifest, operations, executor, output)
+        # Watch before the first scan, so nothing written during it is missed
+        inotify = None if once or poll or file_list else _start_inotify(sources)
+        try:
+            emitted = run.scan(collect_images(sources, file_list), sources)
+            print(f"{len(manifest)} images in the manifest, {emitted} records written", file=sys.stderr)
+            if once:
+                return run.failed
+            print(f"Watching {', '.join(sources)} with {'inotify' if inotify else 'stat scans'}", file=sys.stderr)
+            while True:
+                if inotify is None:
+                    time.sleep(interval)
+                    run.scan(collect_images(sources, file_list), sources)
+                    continue
+                changed, removed, rescan = inotify.wait()
+                if rescan:
+                    run.scan(collect_images(sources), sources)
+                    continue
+                entries = manifest.entries()
+                changes, _ = find_changes(sorted(changed), entries, operations)
+                run.process(changes, [path for path in removed if path in entries and not os.path.exists(path)])
+        except KeyboardInterrupt:
+            return run.failed
+        finally:
+            if inotify is not None:
+                inotify.close()
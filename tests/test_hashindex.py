@@ -0,0 +1,44 @@
+import random
+import unittest
+import numpy as np
+from modules.hashindex import MultiIndex, hamming, hamming_array
+
+
+class MultiIndexTest(unittest.TestCase):
+    """MultiIndex finds exactly the hashes a full scan finds."""
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.hashes = [rng.getrandbits(64) for _ in range(2000)]
+        # Near duplicates of the first hashes
+        for index in range(0, 200, 2):
+            value = self.hashes[index]
+            for bit in rng.sample(range(64), rng.randint(0, 12)):
+                value ^= 1 << bit
+            self.hashes[index + 1] = value
+        self.array = np.array(self.hashes, dtype=np.uint64)
+
+    def test_hamming_array(self):
+        value = self.hashes[7]
+        self.assertEqual(hamming_array(self.array, value).tolist(), [hamming(value, other) for other in self.hashes])
+
+    def test_search(self):
+        for max_distance in (0, 4, 10, 20):  # 20 leaves bands too narrow and scans everything
+            index = MultiIndex(self.array, max_distance)
+            for value in self.hashes[:50]:
+                indexes, distances = index.search(value)
+                expected = [item for item, other in enumerate(self.hashes) if hamming(value, other) <= max_distance]
+                self.assertEqual(sorted(indexes.tolist()), expected)
+                self.assertEqual(distances.tolist(), [hamming(value, self.hashes[item]) for item in indexes])
+
+    def test_matches_after(self):
+        for max_distance in (10, 20):
+            index = MultiIndex(self.array, max_distance)
+            for item in range(0, 200, 7):
+                expected = [other for other in range(item + 1, len(self.hashes))
+                            if hamming(self.hashes[item], self.hashes[other]) <= max_distance]
+                self.assertEqual(sorted(set(index.matches_after(item).tolist())), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
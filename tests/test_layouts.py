@@ -0,0 +1,97 @@
+import unittest
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from modules import payload
+from modules.decode_encode import decode_image_payload, encode_image, MAX_BITS_PER_CHANNEL
+from modules.payload import PayloadError
+
+
+MESSAGE = "The quick brown fox jumps over the lazy dog. " * 8
+
+
+def cover(mode, size=(64, 48)):
+    """PNG bytes of a noisy image in the given mode ('RGB', 'RGBA' or 'I;16')."""
+    rng = np.random.default_rng(0)
+    if mode == 'I;16':
+        img = Image.fromarray(rng.integers(0, 1 << 16, size[::-1], dtype=np.uint16))
+    else:
+        img = Image.fromarray(rng.integers(0, 256, (size[1], size[0], len(mode)), dtype=np.uint8), mode)
+    output = BytesIO()
+    img.save(output, 'PNG')
+    return output.getvalue()
+
+
+class LayoutRoundTripTest(unittest.TestCase):
+    """Every layout encode_image can write decodes without being told the settings."""
+
+    def encode(self, source, data=None, **options):
+        output = BytesIO()
+        encode_image(source, payload.pack_text(MESSAGE) if data is None else data, output, **options)
+        output.seek(0)
+        return Image.open(output)
+
+    def assertDecodes(self, img, password=None):
+        self.assertEqual(decode_image_payload(img, password=password),
+                         payload.Payload(payload.KIND_TEXT, None, MESSAGE))
+
+    def test_bits_per_channel(self):
+        for bits in range(1, MAX_BITS_PER_CHANNEL + 1):
+            with self.subTest(bits=bits):
+                self.assertDecodes(self.encode(cover('RGB'), bits_per_channel=bits))
+
+    def test_more_bits_use_fewer_pixels(self):
+        original = np.asarray(Image.open(BytesIO(cover('RGB'))))
+        changed_rows = []
+        for bits in (1, 4):
+            encoded = np.asarray(self.encode(cover('RGB'), bits_per_channel=bits))
+            changed_rows.append(np.flatnonzero((encoded != original).any(axis=(1, 2))).max())
+        self.assertLess(changed_rows[1], changed_rows[0])
+
+    def test_alpha(self):
+        for bits in (1, 3):
+            with self.subTest(bits=bits):
+                img = self.encode(cover('RGBA'), bits_per_channel=bits, alpha=True)
+                self.assertEqual(img.mode, 'RGBA')
+                self.assertDecodes(img)
+        original = np.asarray(Image.open(BytesIO(cover('RGBA'))))
+        encoded = np.asarray(self.encode(cover('RGBA'), alpha=True))
+        self.assertTrue((encoded[..., 3] != original[..., 3]).any())
+
+    def test_alpha_needs_an_alpha_channel(self):
+        with self.assertRaises(ValueError):
+            self.encode(cover('RGB'), alpha=True)
+
+    def test_sixteen_bit_gray(self):
+        for bits in (1, 4):
+            with self.subTest(bits=bits):
+                img = self.encode(cover('I;16'), bits_per_channel=bits)
+                self.assertIn(img.mode, ('I;16', 'I'))  # kept at full depth
+                self.assertDecodes(img)
+
+    def test_keyed(self):
+        for bits, mode, alpha in ((1, 'RGB', False), (2, 'RGB', False), (1, 'RGBA', True), (2, 'I;16', False)):
+            with self.subTest(bits=bits, mode=mode, alpha=alpha):
+                img = self.encode(cover(mode), password="hunter2", bits_per_channel=bits, alpha=alpha)
+                self.assertDecodes(img, password="hunter2")
+                self.assertIsNone(decode_image_payload(img, password="wrong"))
+
+    def test_keyed_payload_is_scattered(self):
+        img = self.encode(cover('RGB'), password="hunter2")
+        self.assertIsNone(decode_image_payload(img))
+
+    def test_crc_mismatch(self):
+        img = self.encode(cover('RGB'))
+        pixels = np.array(img)
+        # The header takes the first 112 bits, 38 pixels at 3 bits each; flip a bit of the body
+        pixels[1, 0, 0] ^= 1
+        with self.assertRaisesRegex(PayloadError, "checksum"):
+            decode_image_payload(Image.fromarray(pixels))
+
+    def test_capacity(self):
+        with self.assertRaises(ValueError):
+            self.encode(cover('RGB', (8, 8)))
+
+
+if __name__ == "__main__":
+    unittest.main()
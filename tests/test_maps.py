@@ -0,0 +1,148 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from modules.maps import MapFetcher
+
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\0" * 1024
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            failure = server.failures.pop(0) if server.failures else None
+        if failure == "timeout":
+            time.sleep(server.delay)
+        elif failure is not None:
+            self.send_response(failure)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = PNG + self.path.encode('utf-8')  # a different image per request
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass  # the client gave up after a timeout
+
+    def log_message(self, *args):
+        pass
+
+
+class MapFetcherTest(unittest.TestCase):
+    """MapFetcher against a local stub of the static map API."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.failures = []  # an HTTP status or "timeout" for each of the next requests
+        self.server.delay = 1.0
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/staticmap"
+        self.cache_dir = tempfile.mkdtemp(prefix="inspector-maps-test-")
+        self.fetchers = []
+
+    def tearDown(self):
+        for fetcher in self.fetchers:
+            fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def fetcher(self, **options):
+        options = {"base_url": self.base_url, "cache_dir": self.cache_dir, "timeout": (1, 0.3), **options}
+        fetcher = MapFetcher("test-key", **options)
+        self.fetchers.append(fetcher)
+        return fetcher
+
+    def test_memory_cache_hit(self):
+        fetcher = self.fetcher()
+        first = fetcher.fetch(48.858, 2.294, 14)
+        self.assertTrue(first.startswith(PNG))
+        self.assertEqual(fetcher.fetch(48.858, 2.294, 14), first)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_nearby_positions_share_an_entry(self):
+        fetcher = self.fetcher()
+        fetcher.fetch(48.85801, 2.29401, 14)
+        fetcher.fetch(48.85802, 2.29402, 14)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_request_uses_exact_coordinates(self):
+        self.fetcher().fetch(48.858123, 2.294456, 14)
+        query = parse_qs(urlsplit(self.server.requests[0]).query)
+        self.assertEqual(query["center"], ["lonlat:2.294456,48.858123"])
+
+    def test_disk_cache_hit(self):
+        data = self.fetcher().fetch(48.858, 2.294, 14)
+        # A new fetcher starts with an empty memory cache
+        self.assertEqual(self.fetcher().fetch(48.858, 2.294, 14), data)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_retries_server_errors(self):
+        self.server.failures = [503, 500]
+        fetcher = self.fetcher()
+        self.assertIsNotNone(fetcher.fetch(48.858, 2.294, 14))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_gives_up_after_retries(self):
+        self.server.failures = [503] * 10
+        fetcher = self.fetcher(retries=2)
+        self.assertIsNone(fetcher.fetch(48.858, 2.294, 14))
+        self.assertIn("503", fetcher.last_error)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_retries_timeouts(self):
+        self.server.failures = ["timeout"]
+        fetcher = self.fetcher()
+        self.assertIsNotNone(fetcher.fetch(48.858, 2.294, 14))
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_offline_without_cache(self):
+        fetcher = self.fetcher(offline=True)
+        self.assertIsNone(fetcher.fetch(48.858, 2.294, 14))
+        self.assertIn("offline", fetcher.last_error)
+        self.assertEqual(self.server.requests, [])
+
+    def test_offline_serves_cached_maps(self):
+        data = self.fetcher().fetch(48.858, 2.294, 14)
+        self.assertEqual(self.fetcher(offline=True).fetch(48.858, 2.294, 14), data)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_memory_lru_eviction(self):
+        fetcher = self.fetcher(cache_dir=None, memory_items=2)
+        fetcher.fetch(1, 1, 14)
+        fetcher.fetch(2, 2, 14)
+        fetcher.fetch(1, 1, 14)  # now the most recently used
+        fetcher.fetch(3, 3, 14)  # evicts (2, 2)
+        self.assertEqual(len(self.server.requests), 3)
+        fetcher.fetch(1, 1, 14)
+        self.assertEqual(len(self.server.requests), 3)
+        fetcher.fetch(2, 2, 14)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_disk_lru_eviction(self):
+        fetcher = self.fetcher(max_disk_bytes=2 * (len(PNG) + 200))
+        for position in (1, 2, 3):
+            fetcher.fetch(position, position, 14)
+            time.sleep(0.01)  # distinct modification times
+        cached = [name for name in os.listdir(self.cache_dir) if name.endswith(".png")]
+        self.assertEqual(len(cached), 2)
+        self.assertFalse(os.path.exists(fetcher._disk_path(fetcher.cache_key(1, 1, 14))))
+        self.assertTrue(os.path.exists(fetcher._disk_path(fetcher.cache_key(3, 3, 14))))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import struct
+import unittest
+from io import BytesIO
+from modules.metadata import parse_metadata, EXIF_IFD_POINTER, GPS_IFD_POINTER
+
+
+def tiff(*entries):
+    """A little-endian TIFF whose IFD0 holds the given (tag, type, count, value field) entries."""
+    ifd = struct.pack("<H", len(entries))
+    ifd += b"".join(struct.pack("<HHI4s", *entry) for entry in entries)
+    return b"II*\x00" + struct.pack("<I", 8) + ifd + struct.pack("<I", 0)
+
+
+class MalformedIfdTest(unittest.TestCase):
+    """Damaged sub-IFD pointers are skipped instead of followed."""
+
+    def test_pointer_with_several_values(self):
+        # Two SHORT values fit in the value field, so the pointer parses as a tuple
+        data = tiff((0x010F, 2, 4, b"Cam\x00"), (EXIF_IFD_POINTER, 3, 2, struct.pack("<HH", 8, 8)))
+        result = parse_metadata(BytesIO(data))
+        self.assertEqual(result["ifd0"]["Make"], "Cam")
+        self.assertEqual(result["exif"], {})
+
+    def test_pointer_past_the_end(self):
+        data = tiff((GPS_IFD_POINTER, 4, 1, struct.pack("<I", 0xFFFFFF)))
+        result = parse_metadata(BytesIO(data))
+        self.assertEqual(result["format"], "tiff")
+        self.assertEqual(result["gps"], {})
+
+    def test_jpeg_with_malformed_exif(self):
+        exif = b"Exif\x00\x00" + tiff((EXIF_IFD_POINTER, 4, 2, struct.pack("<I", 8)))
+        data = b"\xff\xd8\xff\xe1" + struct.pack(">H", len(exif) + 2) + exif + b"\xff\xda"
+        result = parse_metadata(BytesIO(data))
+        self.assertEqual(result["format"], "jpeg")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+import zlib
+from io import BytesIO
+from PIL import Image
+from modules import payload
+from modules.decode_encode import decode_image, encode_image
+from modules.payload import PayloadError
+
+
+def _cover():
+    output = BytesIO()
+    Image.new('RGB', (32, 32), (120, 80, 40)).save(output, 'PNG')
+    return output.getvalue()
+
+COVER = _cover()
+
+
+def split(data):
+    """(kind, body, checksum) of a packed container, as the decoder passes them to unpack."""
+    kind, length, checksum = payload.parse_header(data[:payload.HEADER_SIZE])
+    return kind, data[payload.HEADER_SIZE:payload.HEADER_SIZE + length], checksum
+
+
+class PayloadTest(unittest.TestCase):
+    """The IIMG container: header, CRC-32 and the text and file kinds."""
+
+    def test_text_round_trip(self):
+        result = payload.unpack(*split(payload.pack_text("héllo ~~~ wörld")))
+        self.assertEqual(result, payload.Payload(payload.KIND_TEXT, None, "héllo ~~~ wörld"))
+
+    def test_file_round_trip(self):
+        data = bytes(range(256)) * 4
+        result = payload.unpack(*split(payload.pack_file("report.pdf", data)))
+        self.assertEqual(result, payload.Payload(payload.KIND_FILE, "report.pdf", data))
+
+    def test_header_fields(self):
+        data = payload.pack_text("abc")
+        self.assertEqual(data[:4], payload.MAGIC)
+        self.assertEqual(payload.parse_header(data), (payload.KIND_TEXT, 3, zlib.crc32(b"abc")))
+
+    def test_crc_mismatch(self):
+        kind, body, checksum = split(payload.pack_text("secret"))
+        with self.assertRaisesRegex(PayloadError, "checksum"):
+            payload.unpack(kind, b"Secret", checksum)
+
+    def test_invalid_utf8_with_valid_crc(self):
+        body = b"\xff\xfe not utf-8"
+        with self.assertRaisesRegex(PayloadError, "Corrupt"):
+            payload.unpack(payload.KIND_TEXT, body, zlib.crc32(body))
+
+    def test_truncated_file_body_with_valid_crc(self):
+        body = b"\x01"  # too short for the name length
+        with self.assertRaises(PayloadError):
+            payload.unpack(payload.KIND_FILE, body, zlib.crc32(body))
+
+    def test_bad_headers(self):
+        good = payload.pack_text("abc")
+        for header in (good[:5], b"JUNK" + good[4:], good[:4] + b"\x09" + good[5:],
+                       good[:5] + b"\x07" + good[6:]):
+            with self.assertRaises(PayloadError):
+                payload.parse_header(header)
+
+    def test_decode_reports_corrupt_text(self):
+        output = BytesIO()
+        encode_image(BytesIO(COVER), payload.pack(payload.KIND_TEXT, b"\xff\xfe not utf-8"), output)
+        with Image.open(output) as img:
+            self.assertTrue(decode_image(img).startswith("Hidden message is corrupted"))
+
+
+if __name__ == "__main__":
+    unittest.main()
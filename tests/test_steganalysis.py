@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+from modules.decode_encode import encode_message
+from modules.steganalysis import detect_image, DETECTION_THRESHOLD
+
+
+RESOURCES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "resources")
+COVER = os.path.join(RESOURCES, "DSCN0010.jpg")
+
+
+class DetectImageTest(unittest.TestCase):
+    """detect_image on clean images and on this tool's own -encode output."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="inspector-detect-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def detect(self, path):
+        with Image.open(path) as img:
+            return detect_image(img)
+
+    def encoded(self, fraction):
+        """The cover with a text message filling about fraction of its capacity."""
+        with Image.open(COVER) as img:
+            capacity = img.width * img.height * 3 // 8
+        rng = np.random.default_rng(0)
+        message = "".join(map(chr, rng.integers(32, 127, int(capacity * fraction))))
+        output = os.path.join(self.directory, f"encoded_{fraction}.png")
+        encode_message(COVER, message, output)
+        return output
+
+    def test_clean_png_below_threshold(self):
+        rng = np.random.default_rng(1)
+        pixels = np.linspace(30, 200, 640)[None, :, None] + rng.normal(0, 3, (480, 640, 3))
+        path = os.path.join(self.directory, "clean.png")
+        Image.fromarray(pixels.round().astype(np.uint8)).save(path)
+        result = self.detect(path)
+        self.assertLess(result["score"], DETECTION_THRESHOLD)
+        self.assertFalse(result["suspicious"])
+
+    def test_clean_png_from_jpeg_not_flagged(self):
+        path = os.path.join(self.directory, "plain.png")
+        with Image.open(COVER) as img:
+            img.save(path)
+        result = self.detect(path)
+        self.assertTrue(result["jpeg_history"])
+        self.assertFalse(result["suspicious"])
+        for channel in result["channels"].values():
+            self.assertEqual(channel["chi_square_rate"], 0)
+
+    def test_partial_message_flagged(self):
+        result = self.detect(self.encoded(0.1))
+        self.assertGreater(result["score"], DETECTION_THRESHOLD)
+        self.assertTrue(result["suspicious"])
+
+    def test_full_message_flagged(self):
+        result = self.detect(self.encoded(0.95))
+        self.assertTrue(result["jpeg_history"])  # the cover is a JPEG
+        self.assertTrue(result["suspicious"])
+        self.assertGreater(result["score"], 0.9)
+        for channel in result["channels"].values():
+            self.assertGreater(channel["chi_square_rate"], 0.9)
+
+    def test_jpeg_never_flagged(self):
+        result = self.detect(COVER)
+        self.assertTrue(result["lossy"])
+        self.assertFalse(result["suspicious"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+from modules.watch import find_changes
+
+
+OPERATIONS = ["exif"]
+
+
+class FindChangesTest(unittest.TestCase):
+    """Removals are limited to the sources being scanned, since the manifest is shared."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="inspector-watch-test-")
+        self.entries = {}
+        for name in ("a", "b"):
+            os.mkdir(os.path.join(self.directory, name))
+            # Known to the manifest, but deleted since
+            self.entries[self.path(name, "gone.jpg")] = (1, 1, "digest", "exif")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def test_removals_under_scanned_directory_only(self):
+        _, removed = find_changes([], self.entries, OPERATIONS, [self.path("b")])
+        self.assertEqual(removed, [self.path("b", "gone.jpg")])
+
+    def test_removals_matching_glob(self):
+        _, removed = find_changes([], self.entries, OPERATIONS, [self.path("*", "*.jpg")])
+        self.assertEqual(sorted(removed), sorted(self.entries))
+        _, removed = find_changes([], self.entries, OPERATIONS, [self.path("a", "*.png")])
+        self.assertEqual(removed, [])
+
+    def test_removals_of_listed_files(self):
+        _, removed = find_changes([self.path("a", "gone.jpg")], self.entries, OPERATIONS)
+        self.assertEqual(removed, [self.path("a", "gone.jpg")])
+
+    def test_missing_directory_removes_nothing(self):
+        shutil.rmtree(self.path("a"))  # e.g. an unmounted share
+        _, removed = find_changes([], self.entries, OPERATIONS, [self.path("a")])
+        self.assertEqual(removed, [])
+
+    def test_new_file_added(self):
+        path = self.path("a", "new.jpg")
+        open(path, 'wb').close()
+        changes, _ = find_changes([path], self.entries, OPERATIONS, [self.path("a")])
+        self.assertEqual(changes, [(path, "added", None)])
+
+
+if __name__ == "__main__":
+    unittest.main()